@@ -0,0 +1,65 @@
+import os
+import subprocess
+import sys
+import time
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, List, Optional
+
+import orjson
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BENCHMARKS_DIR)
+RESULTS_DIR = os.path.join(BENCHMARKS_DIR, 'results')
+
+# Код приложения импортируется так же, как при запуске из src
+if os.path.join(ROOT_DIR, 'src') not in sys.path:
+    sys.path.insert(0, os.path.join(ROOT_DIR, 'src'))
+
+
+def git_revision() -> str:
+    try:
+        revision = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT_DIR, capture_output=True,
+                                  text=True, check=True).stdout.strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no', '--', 'src'], cwd=ROOT_DIR,
+                               capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+    return f'{revision}-dirty' if dirty else revision
+
+
+def results_path(name: Optional[str] = None) -> str:
+    return os.path.join(RESULTS_DIR, f'{name or git_revision()}.json')
+
+
+def save_results(section: str, results: Dict[str, Any], name: Optional[str] = None) -> str:
+    # Результаты одного коммита лежат в одном файле, load.py и micro.py пишут свои разделы
+    path = results_path(name)
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    data: Dict[str, Any] = {}
+    if os.path.exists(path):
+        with open(path, 'rb') as file:
+            data = orjson.loads(file.read())
+    data.update({
+        'revision': name or git_revision(),
+        'python': sys.version.split()[0],
+        section: {'created_at': datetime.now(timezone.utc).isoformat(timespec='seconds'), **results},
+    })
+    with open(path, 'wb') as file:
+        file.write(orjson.dumps(data, option=orjson.OPT_INDENT_2 | orjson.OPT_SORT_KEYS))
+    return path
+
+
+def measure(func: Callable[[], Any], iterations: int) -> float:
+    # Среднее время одного вызова в микросекундах
+    func()
+    started = time.perf_counter()
+    for _ in range(iterations):
+        func()
+    return (time.perf_counter() - started) / iterations * 10 ** 6
+
+
+def percentile(values: List[float], share: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(int(len(ordered) * share), len(ordered) - 1)]
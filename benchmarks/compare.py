@@ -0,0 +1,78 @@
+"""Compare benchmark results of two revisions.
+
+Run from the repository root: python benchmarks/compare.py <base> [<head>]
+Arguments are revisions (file names in benchmarks/results) or paths to result files;
+head defaults to the current revision. Exits with 1 when a metric regressed by more
+than --threshold.
+"""
+import argparse
+import os
+import sys
+from typing import Dict, Iterator, Tuple
+
+import orjson
+
+from common import results_path
+
+# Метрика и True, если больше - лучше
+Metrics = Dict[str, Tuple[float, bool]]
+
+
+def load(name: str) -> dict:
+    path = name if os.path.exists(name) else results_path(name)
+    with open(path, 'rb') as file:
+        return orjson.loads(file.read())
+
+
+def metrics(results: dict) -> Metrics:
+    values: Metrics = {}
+    load_results = results.get('load', {})
+    if load_results:
+        total = load_results['total']
+        values['load.rps'] = (total['rps'], True)
+        values['load.p50_ms'] = (total['p50_ms'], False)
+        values['load.p99_ms'] = (total['p99_ms'], False)
+        for name, scenario in load_results['scenarios'].items():
+            values[f'load.{name}.p50_ms'] = (scenario['p50_ms'], False)
+            values[f'load.{name}.p99_ms'] = (scenario['p99_ms'], False)
+    for name, value in results.get('micro', {}).get('us', {}).items():
+        values[f'micro.{name}'] = (value, False)
+    return values
+
+
+def compare(base: Metrics, head: Metrics) -> Iterator[Tuple[str, float, float, float]]:
+    for name in sorted(base.keys() & head.keys()):
+        (before, higher_is_better), (after, _) = base[name], head[name]
+        if not before:
+            continue
+        change = (after - before) / before
+        # Положительное значение - ухудшение
+        yield name, before, after, -change if higher_is_better else change
+
+
+def main(args: argparse.Namespace) -> int:
+    base, head = load(args.base), load(args.head) if args.head else load(results_path())
+    print(f'{base["revision"]} -> {head["revision"]}')
+    for section in ('load', 'micro'):
+        if section in base and section in head and base[section].get('config') != head[section].get('config'):
+            print(f'warning: {section} was run with different settings, the comparison may be meaningless')
+
+    regressions = 0
+    print(f'{"metric":<44}{"base":>12}{"head":>12}{"change":>10}')
+    for name, before, after, regression in compare(metrics(base), metrics(head)):
+        marker = ''
+        if regression > args.threshold:
+            marker = '  REGRESSION'
+            regressions += 1
+        elif regression < -args.threshold:
+            marker = '  improved'
+        print(f'{name:<44}{before:>12.2f}{after:>12.2f}{(after - before) / before:>+10.1%}{marker}')
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('base')
+    parser.add_argument('head', nargs='?')
+    parser.add_argument('--threshold', type=float, default=0.1, help='relative change treated as a regression')
+    sys.exit(main(parser.parse_args()))
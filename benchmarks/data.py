@@ -0,0 +1,82 @@
+import random
+import uuid
+from typing import Any, Dict, List
+
+# Объём как в postgres_init/movies.sql
+FILMS = 1000
+GENRES = 26
+PERSONS = 4166
+# Средние числа связей фильма из того же дампа
+GENRES_PER_FILM = 2.2
+ACTORS_PER_FILM = 3.4
+WRITERS_PER_FILM = 1.6
+DIRECTORS_PER_FILM = 0.8
+
+WORDS = ('star', 'wars', 'trek', 'return', 'empire', 'galaxy', 'space', 'odyssey', 'last', 'night', 'dark', 'light',
+         'king', 'war', 'love', 'story', 'house', 'lost', 'world', 'time', 'city', 'dead', 'man', 'girl', 'rise')
+
+Documents = Dict[str, List[Dict[str, Any]]]
+
+
+def _uuid(rnd: random.Random) -> str:
+    return str(uuid.UUID(int=rnd.getrandbits(128), version=4))
+
+
+def _count(rnd: random.Random, mean: float) -> int:
+    whole = int(mean)
+    return whole + (rnd.random() < mean - whole)
+
+
+def _text(rnd: random.Random, words: int) -> str:
+    return ' '.join(rnd.choice(WORDS) for _ in range(words))
+
+
+def make_documents(seed: int = 42) -> Documents:
+    # Документы индексов movies, persons и genres в том виде, в каком их пишет ETL
+    rnd = random.Random(seed)
+    genres = [{'id': _uuid(rnd), 'name': f'Genre {i}'} for i in range(GENRES)]
+    persons = [{'id': _uuid(rnd), 'name': f'{_text(rnd, 1).title()} {_text(rnd, 1).title()} {i}'}
+               for i in range(PERSONS)]
+    roles: Dict[str, Dict[str, Any]] = {person['id']: {'roles': set(), 'film_ids': []} for person in persons}
+    films = []
+    for _ in range(FILMS):
+        film_genres = rnd.sample(genres, max(1, _count(rnd, GENRES_PER_FILM)))
+        cast = {
+            'actor': rnd.sample(persons, _count(rnd, ACTORS_PER_FILM)),
+            'writer': rnd.sample(persons, _count(rnd, WRITERS_PER_FILM)),
+            'director': rnd.sample(persons, _count(rnd, DIRECTORS_PER_FILM)),
+        }
+        film = {
+            'id': _uuid(rnd),
+            'imdb_rating': round(rnd.uniform(1, 10), 1) if rnd.random() > 0.05 else None,
+            'title': _text(rnd, rnd.randint(1, 4)).capitalize(),
+            'description': _text(rnd, rnd.randint(10, 60)).capitalize() if rnd.random() > 0.1 else None,
+            'genres_names': [genre['name'] for genre in film_genres],
+            'actors_names': [person['name'] for person in cast['actor']],
+            'writers_names': [person['name'] for person in cast['writer']],
+            'directors_names': [person['name'] for person in cast['director']],
+            'genres': film_genres,
+            'actors': cast['actor'],
+            'writers': cast['writer'],
+            'directors': cast['director'],
+        }
+        films.append(film)
+        for role, people in cast.items():
+            for person in people:
+                roles[person['id']]['roles'].add(role)
+                roles[person['id']]['film_ids'].append(film['id'])
+
+    return {
+        'movies': films,
+        'persons': [
+            {'id': person['id'], 'full_name': person['name'], 'roles': sorted(roles[person['id']]['roles']),
+             'film_ids': roles[person['id']]['film_ids']}
+            for person in persons
+        ],
+        'genres': [
+            {'id': genre['id'], 'name': genre['name'],
+             'filmworks': [{'id': film['id'], 'title': film['title'], 'imdb_rating': film['imdb_rating']}
+                           for film in films if genre in film['genres']]}
+            for genre in genres
+        ],
+    }
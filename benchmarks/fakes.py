@@ -0,0 +1,328 @@
+import asyncio
+import math
+import re
+import time
+from collections import Counter
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import elasticsearch.exceptions
+
+from data import Documents
+
+# Упрощённая замена Elasticsearch в памяти: get, mget, search (с search_after и point-in-time).
+# Поддерживаются запросы, которые строят сервисы: multi_match, match (и по подполю suggest), term(s), range,
+# nested, bool, и агрегации nested, terms и histogram.
+
+
+def _tokens(text: Any) -> List[str]:
+    return re.findall(r'\w+', str(text).lower()) if text is not None else []
+
+
+def _values(doc: Any, path: str) -> List[Any]:
+    # Значения поля по пути через точку, с разворачиванием списков
+    values = [doc]
+    for part in path.split('.'):
+        found = []
+        for value in values:
+            value = value.get(part) if isinstance(value, dict) else None
+            if isinstance(value, list):
+                found.extend(value)
+            elif value is not None:
+                found.append(value)
+        values = found
+    return values
+
+
+def _field(name: str) -> str:
+    return name.split('^')[0].replace('.raw', '').replace('__', '.')
+
+
+def _project(source: Dict[str, Any], includes: Optional[List[str]]) -> Dict[str, Any]:
+    if includes is None:
+        return source
+    return {key: value for key, value in source.items() if key in includes}
+
+
+def _includes(source: Any) -> Optional[List[str]]:
+    if source is None or source is True:
+        return None
+    if isinstance(source, dict):
+        source = source.get('includes')
+    if isinstance(source, str):
+        source = source.split(',')
+    return list(source) if source is not None else None
+
+
+def _as_list(value: Any) -> List[Any]:
+    return value if isinstance(value, list) else [value]
+
+
+def _candidate_ids(query: Optional[dict]) -> Optional[set]:
+    # Фильтр по id не требует перебора всего индекса
+    if not query:
+        return None
+    (kind, params), = query.items()
+    if kind in ('term', 'terms') and 'id' in params:
+        values = params['id']
+        if kind == 'term':
+            values = [values['value'] if isinstance(values, dict) else values]
+        return set(values)
+    if kind == 'bool':
+        for clause in _as_list(params.get('filter', [])) + _as_list(params.get('must', [])):
+            ids = _candidate_ids(clause)
+            if ids is not None:
+                return ids
+    if kind == 'constant_score':
+        return _candidate_ids(params['filter'])
+    return None
+
+
+class FakeElasticsearch:
+    def __init__(self, documents: Documents, latency: float = 0.0) -> None:
+        self._indexes = {index: {doc['id']: doc for doc in docs} for index, docs in documents.items()}
+        # Задержка на каждый запрос, имитирует сетевой round-trip
+        self._latency = latency
+        self._token_cache: Dict[Tuple[str, str], frozenset] = {}
+        self.requests = 0
+        # Процессорное время самой подделки: его нужно вычитать из времени приложения
+        self.cpu_time = 0.0
+
+    async def _roundtrip(self) -> None:
+        self.requests += 1
+        await asyncio.sleep(self._latency)
+
+    async def get(self, index: str, id: str, params: Optional[dict] = None, **kwargs) -> dict:
+        await self._roundtrip()
+        doc = self._indexes[index].get(id)
+        if doc is None:
+            raise elasticsearch.exceptions.NotFoundError(404, 'not_found', {'_id': id})
+        return {'_index': index, '_id': id, 'found': True,
+                '_source': _project(doc, _includes((params or {}).get('_source_includes')))}
+
+    async def mget(self, body: dict, index: str, params: Optional[dict] = None, **kwargs) -> dict:
+        await self._roundtrip()
+        includes = _includes((params or {}).get('_source_includes'))
+        docs = []
+        for doc_id in body['ids']:
+            doc = self._indexes[index].get(doc_id)
+            if doc is None:
+                docs.append({'_index': index, '_id': doc_id, 'found': False})
+            else:
+                docs.append({'_index': index, '_id': doc_id, 'found': True, '_source': _project(doc, includes)})
+        return {'docs': docs}
+
+    async def search(self, body: Optional[dict] = None, index: Optional[str] = None, **kwargs) -> dict:
+        await self._roundtrip()
+        started = time.perf_counter()
+        try:
+            return self._search(body or {}, index)
+        finally:
+            self.cpu_time += time.perf_counter() - started
+
+    def _search(self, body: dict, index: Optional[str]) -> dict:
+        pit_id = body.get('pit', {}).get('id')
+        if pit_id:
+            index = pit_id.split(':', 1)[1]
+        docs = self._indexes[index]
+        ids = _candidate_ids(body.get('query'))
+        scored = []
+        for doc in (docs[doc_id] for doc_id in ids if doc_id in docs) if ids is not None else docs.values():
+            score = self._score(body.get('query'), doc)
+            if score is not None:
+                scored.append((score, doc))
+        sort = self._sort_keys(body.get('sort'))
+        hits = [(self._sort_values(sort, score, doc), score, doc) for score, doc in scored]
+        if not sort:
+            hits.sort(key=lambda hit: hit[1], reverse=True)
+        for position in reversed(range(len(sort))):
+            # Как в Elasticsearch: документы без значения поля в конце при любом порядке
+            present = [hit for hit in hits if hit[0][position] is not None]
+            present.sort(key=lambda hit: hit[0][position], reverse=sort[position][1])
+            hits = present + [hit for hit in hits if hit[0][position] is None]
+        if 'search_after' in body:
+            after = tuple(body['search_after'])
+            hits = [hit for hit in hits if self._is_after(hit[0], after, sort)]
+        start = body.get('from', 0)
+        size = body.get('size', 10)
+        includes = _includes(body.get('_source'))
+        response = {
+            'hits': {
+                'total': {'value': len(scored), 'relation': 'eq'},
+                'hits': [
+                    {'_index': index, '_id': doc['id'], '_score': score, '_source': _project(doc, includes),
+                     **({'sort': list(values)} if sort else {})}
+                    for values, score, doc in hits[start:start + size]
+                ],
+            },
+        }
+        aggs = body.get('aggs') or body.get('aggregations')
+        if aggs:
+            response['aggregations'] = self._aggregations(aggs, [doc for _, doc in scored])
+        if pit_id:
+            response['pit_id'] = pit_id
+        return response
+
+    def _aggregations(self, aggs: dict, docs: List[dict]) -> dict:
+        result = {}
+        for name, spec in aggs.items():
+            sub = spec.get('aggs') or spec.get('aggregations') or {}
+            if 'nested' in spec:
+                path = spec['nested']['path']
+                items = [{path: item} for doc in docs for item in _values(doc, path)]
+                result[name] = {'doc_count': len(items), **self._aggregations(sub, items)}
+            elif 'terms' in spec:
+                params = spec['terms']
+                counts = Counter(value for doc in docs for value in set(_values(doc, _field(params['field']))))
+                ranked = sorted(counts.items(), key=lambda item: (-item[1], item[0]))[:params.get('size', 10)]
+                result[name] = {'buckets': [{'key': key, 'doc_count': count} for key, count in ranked]}
+            elif 'histogram' in spec:
+                params = spec['histogram']
+                interval = params['interval']
+                counts = Counter(math.floor(value / interval) * interval
+                                 for doc in docs for value in _values(doc, _field(params['field'])))
+                result[name] = {'buckets': [{'key': float(key), 'doc_count': count}
+                                            for key, count in sorted(counts.items())]}
+        return result
+
+    async def open_point_in_time(self, index: str, **kwargs) -> dict:
+        await self._roundtrip()
+        return {'id': f'pit:{index}'}
+
+    async def close_point_in_time(self, body: dict, **kwargs) -> dict:
+        await self._roundtrip()
+        return {'succeeded': True}
+
+    async def ping(self, **kwargs) -> bool:
+        await self._roundtrip()
+        return True
+
+    async def close(self) -> None:
+        pass
+
+    @staticmethod
+    def _sort_keys(sort: Optional[List[Any]]) -> List[Tuple[str, bool]]:
+        keys = []
+        for item in sort or []:
+            if isinstance(item, str):
+                item = {item.lstrip('-'): 'desc' if item.startswith('-') else {}}
+            for name, options in item.items():
+                # _score по умолчанию сортируется по убыванию
+                default = 'desc' if name == '_score' else 'asc'
+                order = options.get('order', default) if isinstance(options, dict) else options
+                keys.append((_field(name), order == 'desc'))
+        return keys
+
+    @staticmethod
+    def _sort_values(sort: List[Tuple[str, bool]], score: float, doc: dict) -> Tuple:
+        values = []
+        for name, _ in sort:
+            if name == '_score':
+                values.append(score)
+            else:
+                found = _values(doc, name)
+                values.append(found[0] if found else None)
+        return tuple(values)
+
+    @staticmethod
+    def _is_after(values: Tuple, after: Tuple, sort: List[Tuple[str, bool]]) -> bool:
+        for value, marker, (_, descending) in zip(values, after, sort):
+            if value == marker:
+                continue
+            if value is None or marker is None:
+                return marker is not None
+            return value < marker if descending else value > marker
+        return False
+
+    def _doc_tokens(self, doc: dict, name: str) -> frozenset:
+        key = (doc.get('id'), name)
+        tokens = self._token_cache.get(key)
+        if tokens is None:
+            tokens = frozenset(token for value in _values(doc, name) for token in _tokens(value))
+            if key[0] is not None:
+                self._token_cache[key] = tokens
+        return tokens
+
+    def _score(self, query: Optional[dict], doc: dict) -> Optional[float]:
+        # None - документ не подходит, иначе релевантность
+        if not query:
+            return 1.0
+        (kind, params), = query.items()
+        handler: Callable[[Any, dict], Optional[float]] = getattr(self, f'_query_{kind}')
+        return handler(params, doc)
+
+    def _query_match_all(self, params: dict, doc: dict) -> Optional[float]:
+        return 1.0
+
+    def _query_multi_match(self, params: dict, doc: dict) -> Optional[float]:
+        tokens = set(_tokens(params['query']))
+        score = 0.0
+        for name in params.get('fields', []):
+            boost = float(name.split('^')[1]) if '^' in name else 1.0
+            text = self._doc_tokens(doc, _field(name))
+            score += boost * len(tokens & text)
+        return score or None
+
+    def _query_match(self, params: dict, doc: dict) -> Optional[float]:
+        (name, query), = params.items()
+        query = query['query'] if isinstance(query, dict) else query
+        if name.endswith('.suggest'):
+            return self._query_prefixes(query, name[:-len('.suggest')], doc)
+        return self._query_multi_match({'query': query, 'fields': [name]}, doc)
+
+    def _query_prefixes(self, query: str, name: str, doc: dict) -> Optional[float]:
+        # Подполе suggest с edge-ngram: каждое слово запроса - начало какого-то слова поля
+        text = self._doc_tokens(doc, name)
+        score = 0.0
+        for token in _tokens(query):
+            if not any(word.startswith(token) for word in text):
+                return None
+            score += 1.0 / len(text)
+        return score or None
+
+    def _query_term(self, params: dict, doc: dict) -> Optional[float]:
+        (name, value), = params.items()
+        value = value['value'] if isinstance(value, dict) else value
+        return 1.0 if value in _values(doc, _field(name)) else None
+
+    def _query_terms(self, params: dict, doc: dict) -> Optional[float]:
+        (name, values), = params.items()
+        return 1.0 if set(_values(doc, _field(name))) & set(values) else None
+
+    def _query_range(self, params: dict, doc: dict) -> Optional[float]:
+        (name, bounds), = params.items()
+        checks = {'gte': lambda v, b: v >= b, 'gt': lambda v, b: v > b,
+                  'lte': lambda v, b: v <= b, 'lt': lambda v, b: v < b}
+        for value in _values(doc, _field(name)):
+            if all(check(value, bounds[op]) for op, check in checks.items() if op in bounds):
+                return 1.0
+        return None
+
+    def _query_nested(self, params: dict, doc: dict) -> Optional[float]:
+        path = params['path']
+        for item in _values(doc, path):
+            score = self._score(params['query'], {path: item})
+            if score is not None:
+                return score
+        return None
+
+    def _query_constant_score(self, params: dict, doc: dict) -> Optional[float]:
+        return 1.0 if self._score(params['filter'], doc) is not None else None
+
+    def _query_bool(self, params: dict, doc: dict) -> Optional[float]:
+        score = 0.0
+        for clause in _as_list(params.get('must', [])):
+            clause_score = self._score(clause, doc)
+            if clause_score is None:
+                return None
+            score += clause_score
+        for clause in _as_list(params.get('filter', [])):
+            if self._score(clause, doc) is None:
+                return None
+        for clause in _as_list(params.get('must_not', [])):
+            if self._score(clause, doc) is not None:
+                return None
+        should = [self._score(clause, doc) for clause in _as_list(params.get('should', []))]
+        matched = [clause_score for clause_score in should if clause_score is not None]
+        if should and not matched and not params.get('must') and not params.get('filter'):
+            return None
+        return score + sum(matched) or 1.0
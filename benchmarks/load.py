@@ -0,0 +1,220 @@
+"""Load test of the API in-process: fakeredis and an in-memory Elasticsearch stand-in.
+
+Drives a mix of detail, search and person-film requests through the ASGI app
+and reports p50/p99 latency per scenario and overall RPS. Results are saved to
+benchmarks/results/<revision>.json, compare them with compare.py.
+
+Run from the repository root: python benchmarks/load.py --requests 5000
+"""
+import argparse
+import asyncio
+import os
+import random
+import time
+from collections import defaultdict
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from urllib.parse import urlencode
+
+# Stream инвалидации не поддерживается fakeredis, в бенчмарке он не нужен
+os.environ.setdefault('CACHE_INVALIDATION_ENABLED', 'false')
+
+import orjson  # noqa: E402
+
+from common import percentile, save_results  # noqa: E402
+from data import WORDS, Documents, make_documents  # noqa: E402
+from fakes import FakeElasticsearch  # noqa: E402
+
+Request = Tuple[str, str, str, Dict[str, Any], bytes]
+
+
+async def create_app(es: FakeElasticsearch):
+    import fakeredis.aioredis
+    from db import elastic, redis
+
+    async def create_redis():
+        pool = await fakeredis.aioredis.create_redis_pool()
+        return redis.InstrumentedRedis(pool._pool_or_conn)
+
+    redis.create_redis = create_redis
+    elastic.create_elastic = lambda: es
+    import main
+    return main.app
+
+
+async def call(app, method: str, path: str, params: Dict[str, Any], body: bytes = b'') -> int:
+    scope = {
+        'type': 'http',
+        'asgi': {'version': '3.0'},
+        'http_version': '1.1',
+        'method': method,
+        'scheme': 'http',
+        'path': path,
+        'raw_path': path.encode(),
+        'root_path': '',
+        'query_string': urlencode(params).encode(),
+        'headers': [(b'host', b'benchmark'), (b'content-type', b'application/json')],
+        'client': ('127.0.0.1', 50000),
+        'server': ('benchmark', 80),
+    }
+    messages = [{'type': 'http.request', 'body': body, 'more_body': False}]
+    status = 0
+
+    async def receive():
+        if messages:
+            return messages.pop()
+        # Клиент не отключается, пока ответ не отправлен
+        await asyncio.Event().wait()
+
+    async def send(message):
+        nonlocal status
+        if message['type'] == 'http.response.start':
+            status = message['status']
+
+    await app(scope, receive, send)
+    return status
+
+
+class Workload:
+    def __init__(self, documents: Documents, seed: int) -> None:
+        self._rnd = random.Random(seed)
+        self._films = [film['id'] for film in documents['movies']]
+        self._persons = [person['id'] for person in documents['persons'] if person['film_ids']]
+        self._genres = [genre['id'] for genre in documents['genres']]
+        for ids in (self._films, self._persons, self._genres):
+            self._rnd.shuffle(ids)
+        self._scenarios: List[Tuple[str, float, Callable[[], Request]]] = [
+            ('film_detail', 0.35, self.film_detail),
+            ('film_search', 0.25, self.film_search),
+            ('person_films', 0.15, self.person_films),
+            ('person_detail', 0.10, self.person_detail),
+            ('person_search', 0.05, self.person_search),
+            ('genre_list', 0.05, self.genre_list),
+            ('film_mget', 0.05, self.film_mget),
+        ]
+
+    def _popular(self, items: List[Any]) -> Any:
+        # Перекос популярности: верхние 10% элементов получают больше половины запросов
+        return items[int(len(items) * self._rnd.random() ** 4)]
+
+    def next(self) -> Request:
+        name, _, build = self._rnd.choices(self._scenarios, weights=[weight for _, weight, _ in self._scenarios])[0]
+        return (name, *build())
+
+    def film_detail(self) -> Request:
+        return 'GET', f'/v1/film/{self._popular(self._films)}', {}, b''
+
+    def film_search(self) -> Request:
+        params: Dict[str, Any] = {'page[number]': self._popular([1, 1, 1, 2, 3])}
+        kind = self._rnd.random()
+        if kind < 0.3:
+            params['sort'] = '-imdb_rating'
+        else:
+            params['query'] = self._popular(WORDS)
+        if kind > 0.8:
+            params['filter[genre]'] = self._popular(self._genres)
+        return 'GET', '/v1/film/', params, b''
+
+    def person_films(self) -> Request:
+        return 'GET', f'/v1/person/{self._popular(self._persons)}/film', {'sort': '-imdb_rating'}, b''
+
+    def person_detail(self) -> Request:
+        return 'GET', f'/v1/person/{self._popular(self._persons)}', {}, b''
+
+    def person_search(self) -> Request:
+        return 'GET', '/v1/person/', {'query': self._popular(WORDS)}, b''
+
+    def genre_list(self) -> Request:
+        return 'GET', '/v1/genre/', {}, b''
+
+    def film_mget(self) -> Request:
+        ids = list({self._popular(self._films) for _ in range(10)})
+        return 'POST', '/v1/film/_mget', {}, orjson.dumps({'ids': ids})
+
+
+async def drive(app, workload: Workload, requests: int, concurrency: int,
+                latencies: Optional[Dict[str, List[float]]] = None,
+                statuses: Optional[Dict[str, Dict[int, int]]] = None) -> float:
+    remaining = requests
+
+    async def worker():
+        nonlocal remaining
+        while remaining > 0:
+            remaining -= 1
+            name, method, path, params, body = workload.next()
+            started = time.perf_counter()
+            status = await call(app, method, path, params, body)
+            if latencies is not None:
+                latencies[name].append(time.perf_counter() - started)
+                statuses[name][status] += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    return time.perf_counter() - started
+
+
+def report(latencies: Dict[str, List[float]], statuses: Dict[str, Dict[int, int]], elapsed: float,
+           es: FakeElasticsearch) -> Dict[str, Any]:
+    scenarios = {}
+    print(f'{"scenario":<16}{"count":>8}{"p50, ms":>10}{"p99, ms":>10}{"mean, ms":>10}  statuses')
+    for name in sorted(latencies):
+        values = latencies[name]
+        scenarios[name] = {
+            'count': len(values),
+            'p50_ms': percentile(values, 0.5) * 1000,
+            'p99_ms': percentile(values, 0.99) * 1000,
+            'mean_ms': sum(values) / len(values) * 1000,
+            'statuses': {str(status): count for status, count in sorted(statuses[name].items())},
+        }
+        row = scenarios[name]
+        print(f'{name:<16}{row["count"]:>8}{row["p50_ms"]:>10.2f}{row["p99_ms"]:>10.2f}{row["mean_ms"]:>10.2f}'
+              f'  {row["statuses"]}')
+
+    values = [value for items in latencies.values() for value in items]
+    total = {
+        'requests': len(values),
+        'elapsed_s': elapsed,
+        'rps': len(values) / elapsed,
+        'p50_ms': percentile(values, 0.5) * 1000,
+        'p99_ms': percentile(values, 0.99) * 1000,
+        'es_requests': es.requests,
+        # Процессорное время подделки Elasticsearch, которое вошло в латентность
+        'es_fake_cpu_s': es.cpu_time,
+    }
+    print(f'total: {total["requests"]} requests in {elapsed:.2f}s, {total["rps"]:.0f} rps, '
+          f'p50 {total["p50_ms"]:.2f} ms, p99 {total["p99_ms"]:.2f} ms, '
+          f'{es.requests} ES requests ({es.cpu_time:.2f}s fake ES CPU)')
+    return {'scenarios': scenarios, 'total': total}
+
+
+async def main(args: argparse.Namespace) -> None:
+    documents = make_documents(args.seed)
+    es = FakeElasticsearch(documents, latency=args.es_latency_ms / 1000)
+    app = await create_app(es)
+    await app.router.startup()
+    try:
+        workload = Workload(documents, args.seed)
+        if args.warmup:
+            await drive(app, workload, args.warmup, args.concurrency)
+        es.requests, es.cpu_time = 0, 0.0
+        latencies: Dict[str, List[float]] = defaultdict(list)
+        statuses: Dict[str, Dict[int, int]] = defaultdict(lambda: defaultdict(int))
+        elapsed = await drive(app, workload, args.requests, args.concurrency, latencies, statuses)
+    finally:
+        await app.router.shutdown()
+
+    results = report(latencies, statuses, elapsed, es)
+    if not args.no_save:
+        config = {key: value for key, value in vars(args).items() if key not in ('name', 'no_save')}
+        print('saved to', save_results('load', {'config': config, **results}, args.name))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=5000)
+    parser.add_argument('--warmup', type=int, default=1000, help='requests before measuring, not reported')
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--es-latency-ms', type=float, default=2.0, help='simulated Elasticsearch round-trip')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--name', help='results file name, current git revision by default')
+    parser.add_argument('--no-save', action='store_true')
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,90 @@
+"""Micro-benchmarks of the cache hot path: serialization, model building and key building.
+
+Results are saved to benchmarks/results/<revision>.json next to load.py results.
+
+Run from the repository root: python benchmarks/micro.py
+"""
+import argparse
+from typing import Callable, Dict, List, Tuple
+
+from common import measure, save_results
+from data import make_documents
+
+from api_v1.models import FilmDetails, FilmShort, render
+from db.cache import ModelCache, canonical_query, fingerprint_query
+from db.codecs import CODECS, COMPRESSORS, create_serializer
+from db.models import Film, FilmShort as DBFilmShort, construct
+from services.film import FilmFilter, FilmService
+
+Benchmark = Tuple[str, Callable[[], object]]
+
+
+def serialization_benchmarks(film: dict, page: List[dict]) -> List[Benchmark]:
+    benchmarks = []
+    for codec in CODECS:
+        for compression in ('', *COMPRESSORS):
+            try:
+                serializer = create_serializer(codec, compression)
+            except ValueError:
+                # Необязательная зависимость не установлена
+                continue
+            for name, value in (('film', film), ('page', page)):
+                data = serializer.dumps([0.0, 0.0, value])
+                label = f'{serializer.tag}.{name}'
+                benchmarks.append((f'dumps.{label}', lambda s=serializer, v=value: s.dumps([0.0, 0.0, v])))
+                benchmarks.append((f'loads.{label}', lambda s=serializer, d=data: s.loads(d)))
+    return benchmarks
+
+
+def model_benchmarks(film: dict, page: List[dict]) -> List[Benchmark]:
+    film_model = construct(Film, film)
+    page_models = [construct(DBFilmShort, item) for item in page]
+    return [
+        ('build.film.parse_obj', lambda: Film.parse_obj(film)),
+        ('build.film.construct', lambda: construct(Film, film)),
+        ('build.page.construct', lambda: [construct(DBFilmShort, item) for item in page]),
+        ('dict.film', lambda: film_model.dict()),
+        ('render.film', lambda: render(FilmDetails.serialize(film_model))),
+        ('render.page', lambda: render([FilmShort.serialize(item) for item in page_models])),
+    ]
+
+
+def key_benchmarks() -> List[Benchmark]:
+    service = FilmService(ModelCache(None, Film, 300), None)
+    filters = FilmFilter(genre='3d0b2e4c-1b7d-4f3c-9a3e-7e6f2b1c0d9a')
+    search = service._build_search('star wars', filters, '-imdb_rating')
+    query = service._get_paginated_query(search.source(['id', 'title', 'imdb_rating']), 2, 50)
+    cache = service.cache
+    return [
+        ('key.build_search', lambda: service._get_paginated_query(
+            service._build_search('star wars', FilmFilter(), '-imdb_rating'), 2, 50)),
+        ('key.canonical_query', lambda: canonical_query(query)),
+        ('key.fingerprint_query', lambda: fingerprint_query(query)),
+        ('key.query_key', lambda: cache.query_key(query)),
+        ('key.id_key', lambda: cache.get_full_path(cache.id_key('3d0b2e4c-1b7d-4f3c-9a3e-7e6f2b1c0d9a'))),
+    ]
+
+
+def main(args: argparse.Namespace) -> None:
+    documents = make_documents(args.seed)
+    film = documents['movies'][0]
+    page = [{key: item[key] for key in ('id', 'title', 'imdb_rating')} for item in documents['movies'][:50]]
+
+    results: Dict[str, float] = {}
+    for name, func in (*serialization_benchmarks(film, page), *model_benchmarks(film, page), *key_benchmarks()):
+        if args.filter and args.filter not in name:
+            continue
+        results[name] = measure(func, args.iterations)
+        print(f'{name:<40}{results[name]:>12.2f} us')
+    if not args.no_save:
+        print('saved to', save_results('micro', {'iterations': args.iterations, 'us': results}, args.name))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--iterations', type=int, default=2000)
+    parser.add_argument('--filter', help='run only benchmarks containing this substring')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--name', help='results file name, current git revision by default')
+    parser.add_argument('--no-save', action='store_true')
+    main(parser.parse_args())
@@ -0,0 +1,101 @@
+"""CPU cost of building a response for /v1/film/{id} and /v1/genre/.
+
+Compares the previous path (validated db model -> validated API model ->
+FastAPI response_model validation -> JSON) with the current one
+(db model built without validation -> plain dict -> orjson bytes).
+
+Run from the repository root: python benchmarks/response_path.py
+"""
+import asyncio
+import random
+import uuid
+from typing import Any, Dict, List
+
+import orjson
+from fastapi.encoders import jsonable_encoder
+from fastapi.routing import serialize_response
+from fastapi.utils import create_response_field
+
+from common import measure
+
+from api_v1.models import FilmDetails, GenreDetail, render
+from db.models import Film, Genre, construct
+
+ITERATIONS = 2000
+
+
+def _id(rnd: random.Random) -> str:
+    return str(uuid.UUID(int=rnd.getrandbits(128)))
+
+
+def make_film(rnd: random.Random) -> Dict[str, Any]:
+    people = [{'id': _id(rnd), 'name': f'Person {rnd.randrange(10 ** 6)}'} for _ in range(16)]
+    genres = [{'id': _id(rnd), 'name': f'Genre {i}'} for i in range(3)]
+    return {
+        'id': _id(rnd),
+        'imdb_rating': round(rnd.uniform(1, 10), 1),
+        'title': 'Star Wars: Episode IV - A New Hope',
+        'description': 'The Imperial Forces, under orders from cruel Darth Vader, hold Princess Leia hostage. ' * 3,
+        'actors_names': [person['name'] for person in people[:10]],
+        'writers_names': [person['name'] for person in people[10:13]],
+        'directors_names': [person['name'] for person in people[13:]],
+        'genres_names': [genre['name'] for genre in genres],
+        'actors': people[:10],
+        'writers': people[10:13],
+        'directors': people[13:],
+        'genres': genres,
+    }
+
+
+def make_genres(rnd: random.Random, count: int = 25, films: int = 200) -> List[Dict[str, Any]]:
+    return [
+        {
+            'id': _id(rnd),
+            'name': f'Genre {i}',
+            'filmworks': [{'id': _id(rnd), 'title': f'Film {j}', 'imdb_rating': round(rnd.uniform(1, 10), 1)}
+                          for j in range(films)],
+        }
+        for i in range(count)
+    ]
+
+
+def main() -> None:
+    rnd = random.Random(42)
+    film_source = make_film(rnd)
+    genres_source = make_genres(rnd)
+    loop = asyncio.new_event_loop()
+    film_field = create_response_field('response', FilmDetails)
+    genres_field = create_response_field('response', List[GenreDetail])
+
+    def film_before():
+        film = Film(**film_source)
+        content = loop.run_until_complete(serialize_response(field=film_field,
+                                                             response_content=FilmDetails.from_db_model(film)))
+        return orjson.dumps(jsonable_encoder(content))
+
+    def film_after():
+        return render(FilmDetails.serialize(construct(Film, film_source))).body
+
+    def genres_before():
+        genres = [Genre(**genre) for genre in genres_source]
+        content = loop.run_until_complete(serialize_response(
+            field=genres_field, response_content=[GenreDetail.from_db_model(genre) for genre in genres]))
+        return orjson.dumps(jsonable_encoder(content))
+
+    def genres_after():
+        return render([GenreDetail.serialize(construct(Genre, genre)) for genre in genres_source]).body
+
+    assert orjson.loads(film_before()) == orjson.loads(film_after())
+    assert orjson.loads(genres_before()) == orjson.loads(genres_after())
+
+    print(f'{"endpoint":<20}{"before, us":>14}{"after, us":>14}{"saved":>10}')
+    for name, before, after, iterations in (
+            ('/v1/film/{id}', film_before, film_after, ITERATIONS),
+            ('/v1/genre/', genres_before, genres_after, ITERATIONS // 20),
+    ):
+        before_us, after_us = measure(before, iterations), measure(after, iterations)
+        print(f'{name:<20}{before_us:>14.1f}{after_us:>14.1f}{1 - after_us / before_us:>10.0%}')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,3 +1,6 @@
 FILM_NOT_FOUND = 'film not found'
 GENRE_NOT_FOUND = 'genre not found'
 PERSON_NOT_FOUND = 'person not found'
+INVALID_CURSOR = 'invalid cursor'
+SERVICE_UNAVAILABLE = 'service temporarily unavailable'
+NEXT_CURSOR_HEADER = 'X-Next-Cursor'
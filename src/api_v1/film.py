@@ -2,39 +2,129 @@ from typing import List, Optional
 from uuid import UUID
 import logging
 
-from fastapi import APIRouter, Depends, HTTPException, Query, status
+import orjson
+from fastapi import APIRouter, Depends, HTTPException, Query, Response, status
+from fastapi.responses import StreamingResponse
 
-from api_v1.constants import FILM_NOT_FOUND
-from api_v1.models import FilmShort, FilmDetails
-from services.film import FilmService, get_film_service
+from api_v1.constants import FILM_NOT_FOUND, GENRE_NOT_FOUND, INVALID_CURSOR, NEXT_CURSOR_HEADER
+from api_v1.models import FilmShort, FilmDetails, FilmSearchPage, FilmSuggestion, IdsRequest, render
+from config import SUGGEST_MAX_SIZE
+from db.models import Film, FilmShort as DBFilmShort
+from services.base import InvalidCursor
+from services.film import FilmFilter, FilmService, get_film_service
+from services.genre import genre_exists, genre_name
 
 logger = logging.getLogger(__name__)
 router = APIRouter()
 
 
 @router.get('/{film_id:uuid}', response_model=FilmDetails)
-async def film_details(film_id: UUID, film_service: FilmService = Depends(get_film_service)) -> FilmDetails:
+async def film_details(film_id: UUID, film_service: FilmService = Depends(get_film_service)) -> Response:
     film = await film_service.get_by_id(str(film_id))
     if not film:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=FILM_NOT_FOUND)
 
-    return FilmDetails.from_db_model(film)
+    return render(FilmDetails.serialize(film))
+
+
+@router.post('/_mget', response_model=List[FilmDetails])
+async def film_mget(request: IdsRequest, film_service: FilmService = Depends(get_film_service)) -> Response:
+    films = await film_service.get_many(request.str_ids())
+    if not films:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=FILM_NOT_FOUND)
+
+    return render([FilmDetails.serialize(film) for film in films])
+
+
+@router.get('/suggest', response_model=List[FilmSuggestion])
+async def film_suggest(
+        query: str = Query(..., min_length=1, description='Начало названия, которое набирает пользователь'),
+        size: int = Query(10, ge=1, le=SUGGEST_MAX_SIZE),
+        film_service: FilmService = Depends(get_film_service)) -> Response:
+    films = await film_service.suggest(query, size)
+    return render([FilmSuggestion.serialize(film) for film in films])
+
+
+@router.get('/export', response_class=StreamingResponse,
+            responses={200: {'content': {'application/x-ndjson': {}}}})
+async def film_export(
+        detailed: bool = Query(False, description='FilmDetails вместо FilmShort'),
+        film_service: FilmService = Depends(get_film_service)) -> StreamingResponse:
+    api_model, db_model = (FilmDetails, Film) if detailed else (FilmShort, DBFilmShort)
+
+    async def lines():
+        async for films in film_service.export(db_model):
+            yield b''.join(orjson.dumps(api_model.serialize(film)) + b'\n' for film in films)
+
+    return StreamingResponse(lines(), media_type='application/x-ndjson')
+
+
+def film_filters(
+        filter_genre: Optional[UUID] = Query(None, alias='filter[genre]'),
+        filter_person: Optional[UUID] = Query(None, alias='filter[person]',
+                                              description='Фильмы, где персона - актёр, сценарист или режиссёр'),
+        rating_gte: Optional[float] = Query(None, alias='filter[imdb_rating][gte]'),
+        rating_lte: Optional[float] = Query(None, alias='filter[imdb_rating][lte]')) -> FilmFilter:
+    # Несуществующий жанр отсекается по каталогу в памяти, без запроса в Elasticsearch
+    if filter_genre and not genre_exists(str(filter_genre)):
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=GENRE_NOT_FOUND)
+
+    return FilmFilter(
+        genre=str(filter_genre) if filter_genre else None,
+        person=str(filter_person) if filter_person else None,
+        rating_gte=rating_gte,
+        rating_lte=rating_lte,
+    )
+
+
+@router.get('/search', response_model=FilmSearchPage)
+async def film_search_faceted(
+        query: Optional[str] = Query(""),
+        filters: FilmFilter = Depends(film_filters),
+        sort: Optional[str] = Query(None, regex='^-?[a-zA-Z_]+$'),
+        page_number: int = Query(1, alias='page[number]'),
+        page_size: int = Query(50, alias='page[size]'),
+        film_service: FilmService = Depends(get_film_service)) -> Response:
+    # Страница поиска вместе с total и числом фильмов по жанрам и рейтингу
+    page = await film_service.search_faceted(
+        search_query=query,
+        sort=sort,
+        filters=filters, page_size=page_size, page_number=page_number)
+    if not page.items:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=FILM_NOT_FOUND)
+
+    return render(FilmSearchPage.serialize(page, genre_name))
 
 
 @router.get('/', response_model=List[FilmShort])
 async def film_search(
         query: Optional[str] = Query(""),
-        filter_genre: Optional[UUID] = Query(None, alias='filter[genre]'),
+        filters: FilmFilter = Depends(film_filters),
         sort: Optional[str] = Query(None, regex='^-?[a-zA-Z_]+$'),
         page_number: int = Query(1, alias='page[number]'),
         page_size: int = Query(50, alias='page[size]'),
+        cursor: Optional[str] = Query(None, description='Пустое значение - первая страница, далее '
+                                                        f'значение из заголовка {NEXT_CURSOR_HEADER}'),
 
-        film_service: FilmService = Depends(get_film_service)) -> List[FilmShort]:
-    films = await film_service.search(
-        search_query=query,
-        sort=sort,
-        filter_genre=str(filter_genre) if filter_genre else None, page_size=page_size, page_number=page_number)
+        film_service: FilmService = Depends(get_film_service)) -> Response:
+    next_cursor = None
+    if cursor is not None:
+        try:
+            films, next_cursor = await film_service.search_after(
+                search_query=query,
+                sort=sort,
+                filters=filters, cursor=cursor, page_size=page_size)
+        except InvalidCursor:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=INVALID_CURSOR)
+    else:
+        films = await film_service.search(
+            search_query=query,
+            sort=sort,
+            filters=filters, page_size=page_size, page_number=page_number)
     if not films:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=FILM_NOT_FOUND)
 
-    return [FilmShort(uuid=film.id, title=film.title, imdb_rating=film.imdb_rating) for film in films]
+    response = render([FilmShort.serialize(film) for film in films])
+    if next_cursor:
+        response.headers[NEXT_CURSOR_HEADER] = next_cursor
+    return response
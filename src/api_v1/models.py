@@ -1,9 +1,12 @@
-from typing import List, Optional
+from typing import Any, Callable, Dict, List, Optional
+from uuid import UUID
 
 import orjson
-from pydantic import BaseModel
+from fastapi import Response
+from pydantic import BaseModel, Field
 
 import db.models
+from config import FACET_RATING_INTERVAL, MGET_MAX_IDS
 
 
 def orjson_dumps(v, *, default):
@@ -18,58 +21,141 @@ class APIModel(BaseModel):
         json_dumps = orjson_dumps
 
 
+class IdsRequest(APIModel):
+    ids: List[UUID] = Field(..., min_items=1, max_items=MGET_MAX_IDS)
+
+    def str_ids(self) -> List[str]:
+        return [str(instance_id) for instance_id in self.ids]
+
+
 class Person(APIModel):
     uuid: str
     full_name: str
     roles: List[str]
     film_ids: List[str]
 
+    @staticmethod
+    def serialize(person: db.models.Person) -> Dict[str, Any]:
+        return {
+            'uuid': person.id,
+            'full_name': person.full_name,
+            'roles': person.roles,
+            'film_ids': person.film_ids,
+        }
+
     @classmethod
     def from_db_model(cls, person: db.models.Person):
-        return cls(
-            uuid=person.id,
-            full_name=person.full_name,
-            roles=person.roles,
-            film_ids=person.film_ids
-        )
+        return cls(**cls.serialize(person))
+
+
+class PersonSuggestion(APIModel):
+    uuid: str
+    full_name: str
+
+    @staticmethod
+    def serialize(person: db.models.PersonName) -> Dict[str, Any]:
+        return {'uuid': person.id, 'full_name': person.full_name}
 
 
 class PersonShort(APIModel):
     uuid: str
     full_name: str
 
+    @staticmethod
+    def serialize(person: db.models.IdName) -> Dict[str, Any]:
+        return {'uuid': person.id, 'full_name': person.name}
+
 
 class Genre(APIModel):
     uuid: str
     name: str
 
+    @staticmethod
+    def serialize(genre: db.models.IdName) -> Dict[str, Any]:
+        return {'uuid': genre.id, 'name': genre.name}
+
 
 class FilmShort(APIModel):
     uuid: str
     title: str
     imdb_rating: Optional[float]
 
+    @staticmethod
+    def serialize(film: db.models.FilmShort) -> Dict[str, Any]:
+        return {'uuid': film.id, 'title': film.title, 'imdb_rating': film.imdb_rating}
+
     @classmethod
     def from_db_model(cls, film: db.models.FilmShort):
-        return cls(
-            uuid=film.id,
-            title=film.title,
-            imdb_rating=film.imdb_rating
-        )
+        return cls(**cls.serialize(film))
+
+
+class FilmSuggestion(APIModel):
+    uuid: str
+    title: str
+
+    @staticmethod
+    def serialize(film: db.models.FilmTitle) -> Dict[str, Any]:
+        return {'uuid': film.id, 'title': film.title}
+
+
+class GenreFacet(APIModel):
+    uuid: str
+    # None, если жанра нет в каталоге
+    name: Optional[str]
+    count: int
+
+
+class RatingFacet(APIModel):
+    from_: float = Field(..., alias='from')
+    to: float
+    count: int
+
+
+class FilmFacets(APIModel):
+    genres: List[GenreFacet]
+    imdb_rating: List[RatingFacet]
+
+    @staticmethod
+    def serialize(facets: Dict[str, List[List[Any]]], genre_name: Callable[[str], Optional[str]]) -> Dict[str, Any]:
+        return {
+            'genres': [{'uuid': genre_id, 'name': genre_name(genre_id), 'count': count}
+                       for genre_id, count in facets['genres']],
+            'imdb_rating': [{'from': rating, 'to': rating + FACET_RATING_INTERVAL, 'count': count}
+                            for rating, count in facets['imdb_rating']],
+        }
+
+
+class FilmSearchPage(APIModel):
+    items: List[FilmShort]
+    total: int
+    facets: FilmFacets
+
+    @staticmethod
+    def serialize(page: db.models.FacetedPage, genre_name: Callable[[str], Optional[str]]) -> Dict[str, Any]:
+        return {
+            'items': [FilmShort.serialize(film) for film in page.items],
+            'total': page.total,
+            'facets': FilmFacets.serialize(page.facets, genre_name),
+        }
 
 
 class GenreDetail(APIModel):
     uuid: str
     name: str
-    filmworks: List[FilmShort]
+    filmworks: List[FilmShort] = Field(
+        ..., description='Фильмы жанра. Если задан GENRE_TOP_FILMS - только столько фильмов с наибольшим рейтингом')
+
+    @staticmethod
+    def serialize(genre: db.models.Genre) -> Dict[str, Any]:
+        return {
+            'uuid': genre.id,
+            'name': genre.name,
+            'filmworks': [FilmShort.serialize(film) for film in genre.filmworks],
+        }
 
     @classmethod
     def from_db_model(cls, genre: db.models.Genre):
-        return cls(
-            uuid=genre.id,
-            name=genre.name,
-            filmworks=[FilmShort.from_db_model(film) for film in genre.filmworks]
-        )
+        return cls(**cls.serialize(genre))
 
 
 class FilmDetails(APIModel):
@@ -82,15 +168,24 @@ class FilmDetails(APIModel):
     writers: List[PersonShort]
     directors: List[PersonShort]
 
+    @staticmethod
+    def serialize(film: db.models.Film) -> Dict[str, Any]:
+        return {
+            'uuid': film.id,
+            'title': film.title,
+            'imdb_rating': film.imdb_rating,
+            'description': film.description,
+            'genre': [Genre.serialize(genre) for genre in film.genres],
+            'actors': [PersonShort.serialize(person) for person in film.actors],
+            'writers': [PersonShort.serialize(person) for person in film.writers],
+            'directors': [PersonShort.serialize(person) for person in film.directors],
+        }
+
     @classmethod
     def from_db_model(cls, film: db.models.Film):
-        return cls(
-            uuid=film.id,
-            title=film.title,
-            imdb_rating=film.imdb_rating,
-            description=film.description,
-            genre=[Genre(uuid=genre.id, name=genre.name) for genre in film.genres],
-            actors=[PersonShort(uuid=person.id, full_name=person.name) for person in film.actors],
-            writers=[PersonShort(uuid=person.id, full_name=person.name) for person in film.writers],
-            directors=[PersonShort(uuid=person.id, full_name=person.name) for person in film.directors]
-        )
+        return cls(**cls.serialize(film))
+
+
+def render(content: Any) -> Response:
+    # Ответ из уже сериализованных dict: FastAPI не валидирует его повторно по response_model
+    return Response(orjson.dumps(content), media_type='application/json')
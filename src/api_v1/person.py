@@ -2,10 +2,12 @@ from typing import List, Optional
 from uuid import UUID
 import logging
 
-from fastapi import APIRouter, Depends, HTTPException, Query, status
+from fastapi import APIRouter, Depends, HTTPException, Query, Response, status
 
-from api_v1.constants import PERSON_NOT_FOUND, FILM_NOT_FOUND
-from api_v1.models import FilmShort, Person
+from api_v1.constants import PERSON_NOT_FOUND, FILM_NOT_FOUND, INVALID_CURSOR, NEXT_CURSOR_HEADER
+from api_v1.models import FilmShort, IdsRequest, Person, PersonSuggestion, render
+from config import SUGGEST_MAX_SIZE
+from services.base import InvalidCursor
 from services.film import FilmService, get_film_service
 from services.person import PersonService, get_person_service
 
@@ -15,12 +17,31 @@ router = APIRouter()
 
 @router.get('/{person_id:uuid}', response_model=Person)
 async def person_details(person_id: UUID,
-                         person_service: PersonService = Depends(get_person_service)) -> Person:
+                         person_service: PersonService = Depends(get_person_service)) -> Response:
     person = await person_service.get_by_id(str(person_id))
     if not person:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=PERSON_NOT_FOUND)
 
-    return Person.from_db_model(person)
+    return render(Person.serialize(person))
+
+
+@router.post('/_mget', response_model=List[Person])
+async def person_mget(request: IdsRequest,
+                      person_service: PersonService = Depends(get_person_service)) -> Response:
+    persons = await person_service.get_many(request.str_ids())
+    if not persons:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=PERSON_NOT_FOUND)
+
+    return render([Person.serialize(person) for person in persons])
+
+
+@router.get('/suggest', response_model=List[PersonSuggestion])
+async def person_suggest(
+        query: str = Query(..., min_length=1, description='Начало имени, которое набирает пользователь'),
+        size: int = Query(10, ge=1, le=SUGGEST_MAX_SIZE),
+        person_service: PersonService = Depends(get_person_service)) -> Response:
+    persons = await person_service.suggest(query, size)
+    return render([PersonSuggestion.serialize(person) for person in persons])
 
 
 @router.get('/', response_model=List[Person])
@@ -29,26 +50,49 @@ async def person_search(
         sort: Optional[str] = Query(None, regex='^-?[a-zA-Z_]+$'),
         page_number: int = Query(1, alias='page[number]'),
         page_size: int = Query(50, alias='page[size]'),
-        person_service: PersonService = Depends(get_person_service)) -> List[Person]:
-    persons = await person_service.search(
-        search_query=query,
-        sort=sort,
-        page_size=page_size, page_number=page_number)
+        cursor: Optional[str] = Query(None, description='Пустое значение - первая страница, далее '
+                                                        f'значение из заголовка {NEXT_CURSOR_HEADER}'),
+        person_service: PersonService = Depends(get_person_service)) -> Response:
+    next_cursor = None
+    if cursor is not None:
+        try:
+            persons, next_cursor = await person_service.search_after(
+                search_query=query,
+                sort=sort,
+                cursor=cursor, page_size=page_size)
+        except InvalidCursor:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=INVALID_CURSOR)
+    else:
+        persons = await person_service.search(
+            search_query=query,
+            sort=sort,
+            page_size=page_size, page_number=page_number)
     if not persons:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=PERSON_NOT_FOUND)
 
-    return [Person(uuid=person.id, full_name=person.full_name, roles=person.roles, film_ids=person.film_ids)
-            for person in persons]
+    response = render([Person.serialize(person) for person in persons])
+    if next_cursor:
+        response.headers[NEXT_CURSOR_HEADER] = next_cursor
+    return response
 
 
 @router.get('/{person_id:uuid}/film', response_model=List[FilmShort])
 async def person_films(
         person_id: UUID,
+        sort: Optional[str] = Query(None, regex='^-?[a-zA-Z_]+$'),
+        page_number: int = Query(1, alias='page[number]'),
+        page_size: int = Query(50, alias='page[size]'),
         person_service: PersonService = Depends(get_person_service),
-        film_service: FilmService = Depends(get_film_service)) -> List[FilmShort]:
+        film_service: FilmService = Depends(get_film_service)) -> Response:
     person = await person_service.get_by_id(str(person_id))
-    person_films = await film_service.get_list(person.film_ids)
+    if not person:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=PERSON_NOT_FOUND)
+
+    person_films = await film_service.search_by_ids(
+        person.film_ids,
+        sort=sort,
+        page_size=page_size, page_number=page_number)
     if not person_films:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=FILM_NOT_FOUND)
 
-    return [FilmShort(uuid=film.id, title=film.title, imdb_rating=film.imdb_rating) for film in person_films]
+    return render([FilmShort.serialize(film) for film in person_films])
@@ -4,13 +4,157 @@ import logging.config
 # Название проекта. Используется в Swagger-документации
 PROJECT_NAME = os.getenv('PROJECT_NAME', 'Films API')
 
+# Число процессов uvicorn на узле, его выставляет server.py
+WORKERS = int(os.getenv('WORKERS', 1))
+# Сколько секунд при остановке воркер ждёт фоновые обновления кеша, прежде чем закрыть соединения
+SHUTDOWN_DRAIN_TIMEOUT = float(os.getenv('SHUTDOWN_DRAIN_TIMEOUT', 5))
+
+
+def _pool_size(name: str, budget: int, default: int) -> int:
+    # Явный размер пула на воркер; иначе бюджет соединений на узел поровну между воркерами
+    if name in os.environ:
+        return int(os.environ[name])
+    if budget:
+        return max(budget // WORKERS, 1)
+    return default
+
+
 # Настройки Redis
 REDIS_HOST = os.getenv('REDIS_HOST', '127.0.0.1')
 REDIS_PORT = int(os.getenv('REDIS_PORT', 6379))
-CACHE_TTL = 60 * 5
+# Пул соединений: minsize открывается при старте, maxsize - предел на воркер.
+# REDIS_CONNECTION_BUDGET - предел на все воркеры узла, из него считается maxsize
+REDIS_CONNECTION_BUDGET = int(os.getenv('REDIS_CONNECTION_BUDGET', 0))
+REDIS_POOL_MAX_SIZE = _pool_size('REDIS_POOL_MAX_SIZE', REDIS_CONNECTION_BUDGET, 20)
+REDIS_POOL_MIN_SIZE = min(int(os.getenv('REDIS_POOL_MIN_SIZE', 10)), REDIS_POOL_MAX_SIZE)
+REDIS_CONNECT_TIMEOUT = float(os.getenv('REDIS_CONNECT_TIMEOUT', 1))
+# При включённой инвалидации по событиям ETL TTL можно заметно поднять
+CACHE_TTL = int(os.getenv('CACHE_TTL', 60 * 5))
+# Префикс всех ключей сервиса и версия схемы: увеличение версии разом инвалидирует весь кеш
+CACHE_NAMESPACE = os.getenv('CACHE_NAMESPACE', 'films_api')
+CACHE_SCHEMA_VERSION = int(os.getenv('CACHE_SCHEMA_VERSION', 1))
+# Сколько запись живёт в Redis после мягкого TTL: в это время её можно отдать, обновляя в фоне
+CACHE_STALE_TTL = int(os.getenv('CACHE_STALE_TTL', 60))
+# Ещё столько запись хранится на случай недоступности Elasticsearch: тогда она отдаётся вместо ошибки
+CACHE_FALLBACK_TTL = int(os.getenv('CACHE_FALLBACK_TTL', 60 * 60))
+# Коэффициент вероятностного раннего обновления (XFetch), 0 - отключить
+CACHE_EARLY_REFRESH_BETA = float(os.getenv('CACHE_EARLY_REFRESH_BETA', 1.0))
+# Блокировка в Redis, чтобы ключ из Elasticsearch пересчитывал только один воркер
+CACHE_LOCK_ENABLED = os.getenv('CACHE_LOCK_ENABLED', 'false').lower() == 'true'
+CACHE_LOCK_TIMEOUT = float(os.getenv('CACHE_LOCK_TIMEOUT', 5))
+CACHE_LOCK_WAIT = float(os.getenv('CACHE_LOCK_WAIT', 2))
+# Формат записей в кеше: orjson или msgpack; сжатие: zlib, lz4 или пустая строка.
+# msgpack и lz4 - необязательные зависимости
+CACHE_CODEC = os.getenv('CACHE_CODEC', 'orjson')
+CACHE_COMPRESSION = os.getenv('CACHE_COMPRESSION', 'zlib')
+CACHE_COMPRESSION_THRESHOLD = int(os.getenv('CACHE_COMPRESSION_THRESHOLD', 4096))
+# Как кешировать результаты поиска: ids - только идентификаторы и total, страница собирается
+# из кеша по id; documents - полные документы в каждом ключе запроса
+CACHE_QUERY_MODE = os.getenv('CACHE_QUERY_MODE', 'ids')
+# Собирать модели из кеша без валидации: в кеш пишет только сам сервис
+CACHE_TRUSTED_CONSTRUCT = os.getenv('CACHE_TRUSTED_CONSTRUCT', 'true').lower() == 'true'
+# Статистика обращений к ключам ModelCache по выборке из CACHE_STATS_SAMPLE_RATE обращений: count-min sketch
+# CACHE_STATS_WIDTH x CACHE_STATS_DEPTH и CACHE_STATS_TOP_K самых частых ключей. Раз в CACHE_STATS_FLUSH_INTERVAL
+# секунд top-K каждого воркера складывается в общий zset в Redis, а счётчики уменьшаются вдвое
+CACHE_STATS_ENABLED = os.getenv('CACHE_STATS_ENABLED', 'true').lower() == 'true'
+CACHE_STATS_SAMPLE_RATE = float(os.getenv('CACHE_STATS_SAMPLE_RATE', 0.1))
+CACHE_STATS_WIDTH = int(os.getenv('CACHE_STATS_WIDTH', 4096))
+CACHE_STATS_DEPTH = int(os.getenv('CACHE_STATS_DEPTH', 4))
+CACHE_STATS_TOP_K = int(os.getenv('CACHE_STATS_TOP_K', 100))
+CACHE_STATS_FLUSH_INTERVAL = int(os.getenv('CACHE_STATS_FLUSH_INTERVAL', 60))
+# Адаптивный TTL: ключи, к которым на всех воркерах узла обращались от CACHE_HOT_KEY_HITS раз,
+# живут CACHE_TTL * CACHE_HOT_TTL_FACTOR. Остальные - обычный CACHE_TTL
+CACHE_HOT_KEY_HITS = float(os.getenv('CACHE_HOT_KEY_HITS', 20))
+CACHE_HOT_TTL_FACTOR = float(os.getenv('CACHE_HOT_TTL_FACTOR', 4))
+# Кеш готовых HTTP-ответов с ETag для горячих эндпоинтов; пути сравниваются целиком, а из запросов
+# кешируются только первые страницы каталога по рейтингу и жанру (middleware.CACHEABLE_PARAMS).
+# Жанры по умолчанию не кешируются: они отдаются из каталога в памяти (GENRE_CATALOGUE_ENABLED)
+RESPONSE_CACHE_ENABLED = os.getenv('RESPONSE_CACHE_ENABLED', 'true').lower() == 'true'
+RESPONSE_CACHE_PATHS = [path for path in os.getenv('RESPONSE_CACHE_PATHS', '/v1/film/').split(',') if path]
+
+# Сверх стольких одновременных запросов (не из кеша ответов) API отвечает 503, 0 - без ограничения
+MAX_IN_FLIGHT_REQUESTS = int(os.getenv('MAX_IN_FLIGHT_REQUESTS', 256))
+LOAD_SHED_RETRY_AFTER = int(os.getenv('LOAD_SHED_RETRY_AFTER', 1))
+
+# Настройки in-process кеша (L1) перед Redis
+LOCAL_CACHE_TTL = int(os.getenv('LOCAL_CACHE_TTL', 30))
+LOCAL_CACHE_MAX_ENTRIES = int(os.getenv('LOCAL_CACHE_MAX_ENTRIES', 1024))
+LOCAL_CACHE_MAX_SIZE = int(os.getenv('LOCAL_CACHE_MAX_SIZE', 16 * 1024 * 1024))
+# Redis stream, в который ETL пишет идентификаторы изменённых документов
+CACHE_INVALIDATION_ENABLED = os.getenv('CACHE_INVALIDATION_ENABLED', 'true').lower() == 'true'
+CACHE_INVALIDATION_STREAM = os.getenv('CACHE_INVALIDATION_STREAM', 'etl:changes')
+CACHE_INVALIDATION_GROUP = os.getenv('CACHE_INVALIDATION_GROUP', 'films_api')
+# Событие, которое столько секунд не подтверждено (воркер упал или не смог его обработать), забирает другой воркер
+CACHE_INVALIDATION_CLAIM_IDLE = float(os.getenv('CACHE_INVALIDATION_CLAIM_IDLE', 30))
+# Пауза перед переподключением подписчиков Redis после ошибки, удваивается до REDIS_RETRY_DELAY_MAX
+REDIS_RETRY_DELAY = float(os.getenv('REDIS_RETRY_DELAY', 1))
+REDIS_RETRY_DELAY_MAX = float(os.getenv('REDIS_RETRY_DELAY_MAX', 30))
+
+# Канал Redis pub/sub, через который воркеры сбрасывают друг у друга L1-записи
+LOCAL_CACHE_CHANNEL = os.getenv('LOCAL_CACHE_CHANNEL', 'cache:invalidate')
 
 # Настройки Elasticsearch
 ES_URL = os.getenv('ES_URL', 'http://127.0.0.1:9200')
+# Соединений к каждому узлу на воркер; запросы сверх предела ждут свободное соединение.
+# ES_CONNECTION_BUDGET - то же на все воркеры узла
+ES_CONNECTION_BUDGET = int(os.getenv('ES_CONNECTION_BUDGET', 0))
+ES_MAX_CONNECTIONS = _pool_size('ES_MAX_CONNECTIONS', ES_CONNECTION_BUDGET, 25)
+ES_TIMEOUT = float(os.getenv('ES_TIMEOUT', 10))
+ES_MAX_RETRIES = int(os.getenv('ES_MAX_RETRIES', 3))
+ES_RETRY_ON_TIMEOUT = os.getenv('ES_RETRY_ON_TIMEOUT', 'false').lower() == 'true'
+# Сколько секунд простаивающее соединение остаётся открытым
+ES_KEEPALIVE_TIMEOUT = float(os.getenv('ES_KEEPALIVE_TIMEOUT', 60))
+# gzip для тел запросов и ответов: меньше трафика ценой CPU
+ES_HTTP_COMPRESS = os.getenv('ES_HTTP_COMPRESS', 'false').lower() == 'true'
+# Дедлайн запроса к Elasticsearch подстраивается под наблюдаемую латентность в этих пределах,
+# отдельно для каждого вида запроса. Нижняя граница - не меньше p99 латентности Elasticsearch
+ES_DEADLINE_INITIAL = float(os.getenv('ES_DEADLINE_INITIAL', 1))
+ES_DEADLINE_MIN = float(os.getenv('ES_DEADLINE_MIN', 0.5))
+ES_DEADLINE_MAX = float(os.getenv('ES_DEADLINE_MAX', 3))
+# После стольких ошибок подряд запросы в Elasticsearch не отправляются ES_BREAKER_RESET_TIMEOUT секунд
+ES_BREAKER_FAILURES = int(os.getenv('ES_BREAKER_FAILURES', 5))
+ES_BREAKER_RESET_TIMEOUT = float(os.getenv('ES_BREAKER_RESET_TIMEOUT', 10))
+# Прогрев при старте: открыть соединения заранее и выполнить пробные запросы к индексам
+POOL_WARMUP_ENABLED = os.getenv('POOL_WARMUP_ENABLED', 'true').lower() == 'true'
+ES_WARMUP_CONNECTIONS = int(os.getenv('ES_WARMUP_CONNECTIONS', 10))
+POOL_WARMUP_TIMEOUT = float(os.getenv('POOL_WARMUP_TIMEOUT', 5))
+# Прогрев общих кешей в Redis при старте: выполняет один воркер из всех, остальные видят блокировку.
+# Повторно прогрев запускается не раньше, чем через CACHE_PREWARM_INTERVAL секунд
+CACHE_PREWARM_ENABLED = os.getenv('CACHE_PREWARM_ENABLED', 'false').lower() == 'true'
+CACHE_PREWARM_INTERVAL = int(os.getenv('CACHE_PREWARM_INTERVAL', 60 * 5))
+# Что прогревается: фильмы с наибольшим рейтингом, персоны из наибольшего числа фильмов, все жанры
+# и первые CACHE_PREWARM_PAGES страниц каталога, каждого жанра и поисков из CACHE_PREWARM_QUERIES
+CACHE_PREWARM_FILMS = int(os.getenv('CACHE_PREWARM_FILMS', 1000))
+CACHE_PREWARM_PERSONS = int(os.getenv('CACHE_PREWARM_PERSONS', 500))
+CACHE_PREWARM_PAGES = int(os.getenv('CACHE_PREWARM_PAGES', 3))
+CACHE_PREWARM_QUERIES = [query for query in os.getenv('CACHE_PREWARM_QUERIES', '').split(',') if query]
+CACHE_PREWARM_BATCH_SIZE = int(os.getenv('CACHE_PREWARM_BATCH_SIZE', 200))
+# Не больше стольких запросов в Elasticsearch в секунду, чтобы прогрев не мешал пользовательским запросам
+CACHE_PREWARM_RATE = float(os.getenv('CACHE_PREWARM_RATE', 20))
+# Собирать модели из _source без валидации: индексы со строгим маппингом наполняет наш ETL
+ES_TRUSTED_CONSTRUCT = os.getenv('ES_TRUSTED_CONSTRUCT', 'true').lower() == 'true'
+# Курсорная пагинация через point-in-time: согласованный снимок индекса на время обхода
+ES_USE_PIT = os.getenv('ES_USE_PIT', 'false').lower() == 'true'
+ES_PIT_KEEP_ALIVE = os.getenv('ES_PIT_KEEP_ALIVE', '1m')
+# Максимум идентификаторов в одном запросе _mget
+MGET_MAX_IDS = int(os.getenv('MGET_MAX_IDS', 100))
+# Подсказки при наборе (/suggest): максимум результатов и in-process кеш для коротких префиксов,
+# которые повторяются чаще всего. Записи не инвалидируются по событиям ETL и живут SUGGEST_CACHE_TTL
+SUGGEST_MAX_SIZE = int(os.getenv('SUGGEST_MAX_SIZE', 20))
+SUGGEST_CACHE_PREFIX_LENGTH = int(os.getenv('SUGGEST_CACHE_PREFIX_LENGTH', 3))
+SUGGEST_CACHE_TTL = int(os.getenv('SUGGEST_CACHE_TTL', 60))
+SUGGEST_CACHE_MAX_ENTRIES = int(os.getenv('SUGGEST_CACHE_MAX_ENTRIES', 10000))
+# Все жанры в памяти воркера: загружаются при старте и обновляются периодически и по событиям ETL
+GENRE_CATALOGUE_ENABLED = os.getenv('GENRE_CATALOGUE_ENABLED', 'true').lower() == 'true'
+GENRE_CATALOGUE_REFRESH_INTERVAL = float(os.getenv('GENRE_CATALOGUE_REFRESH_INTERVAL', 60 * 5))
+# API отдаёт у жанра только GENRE_TOP_FILMS фильмов с наибольшим рейтингом, 0 - все.
+# Ограничение одинаково для каталога, Elasticsearch и кеша
+GENRE_TOP_FILMS = int(os.getenv('GENRE_TOP_FILMS', 0))
+# Фасеты поиска фильмов: сколько жанров возвращать и шаг гистограммы рейтинга
+FACET_GENRES_SIZE = int(os.getenv('FACET_GENRES_SIZE', 50))
+FACET_RATING_INTERVAL = float(os.getenv('FACET_RATING_INTERVAL', 1))
+# Размер пачки документов при потоковой выгрузке каталога
+EXPORT_BATCH_SIZE = int(os.getenv('EXPORT_BATCH_SIZE', 1000))
 
 # Корень проекта
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
@@ -1,66 +1,715 @@
-import json
+import asyncio
+import hashlib
 import logging
-from typing import Any, List, Optional, TypeVar, Generic
+import math
+import random
+import re
+import time
+from array import array
+from collections import OrderedDict, defaultdict
+from typing import Any, Callable, Dict, Iterable, List, NamedTuple, Optional, Tuple, Type, TypeVar, Union, Generic
+from urllib.parse import parse_qsl, urlencode
+from uuid import uuid4
 
+import aioredis
+import orjson
 from aioredis import Redis
-from pydantic.tools import parse_raw_as
+
+from config import (CACHE_CODEC, CACHE_COMPRESSION, CACHE_COMPRESSION_THRESHOLD,
+                    CACHE_FALLBACK_TTL, CACHE_HOT_KEY_HITS, CACHE_HOT_TTL_FACTOR, CACHE_NAMESPACE,
+                    CACHE_SCHEMA_VERSION, CACHE_STALE_TTL, CACHE_STATS_DEPTH, CACHE_STATS_ENABLED,
+                    CACHE_STATS_SAMPLE_RATE, CACHE_STATS_TOP_K, CACHE_STATS_WIDTH, CACHE_TRUSTED_CONSTRUCT,
+                    LOCAL_CACHE_CHANNEL, LOCAL_CACHE_MAX_ENTRIES, LOCAL_CACHE_MAX_SIZE, LOCAL_CACHE_TTL,
+                    REDIS_RETRY_DELAY, REDIS_RETRY_DELAY_MAX, WORKERS)
+from db.codecs import Serializer, create_serializer
+from db.models import construct
+from metrics import CACHE_LOOKUPS
 
 T = TypeVar('T')
 
 logger = logging.getLogger(__name__)
 
+# Идентификатор процесса, чтобы воркер не сбрасывал L1 по своим же сообщениям
+WORKER_ID = uuid4().hex
+
+
+class LocalCache:
+    def __init__(self, ttl: int, max_entries: int, max_size: int) -> None:
+        self._ttl = ttl
+        self._max_entries = max_entries
+        self._max_size = max_size
+        self._size = 0
+        self._data: 'OrderedDict[str, Tuple[float, int, Any]]' = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: str) -> Any:
+        item = self._data.get(key)
+        if item is None:
+            self.misses += 1
+            return None
+        expires_at, _, value = item
+        if expires_at <= time.monotonic():
+            self.delete(key)
+            self.misses += 1
+            return None
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key: str, value: Any, size: int) -> None:
+        self.delete(key)
+        if size > self._max_size:
+            return
+        self._data[key] = (time.monotonic() + self._ttl, size, value)
+        self._size += size
+        while len(self._data) > self._max_entries or self._size > self._max_size:
+            _, (_, evicted_size, _) = self._data.popitem(last=False)
+            self._size -= evicted_size
+            self.evictions += 1
+
+    def delete(self, key: str) -> None:
+        item = self._data.pop(key, None)
+        if item is not None:
+            self._size -= item[1]
+
+    def clear(self) -> None:
+        self._data.clear()
+        self._size = 0
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'entries': len(self._data),
+            'size': self._size,
+        }
+
+
+class SizeHistogram:
+    def __init__(self) -> None:
+        # Корзины по степеням двойки: размер -> число наблюдений
+        self._buckets: Dict[int, int] = defaultdict(int)
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def observe(self, size: int) -> None:
+        self._buckets[1 << max(size - 1, 0).bit_length()] += 1
+        self.count += 1
+        self.total += size
+        self.max = max(self.max, size)
+
+    @property
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'count': self.count,
+            'avg': self.total / self.count if self.count else 0,
+            'max': self.max,
+            'buckets': {str(size): count for size, count in sorted(self._buckets.items())},
+        }
+
+
+class AccessStats:
+    # Частоты обращений к ключам по случайной выборке. Count-min sketch оценивает любой ключ
+    # (ошибка только в большую сторону), top-K хранит самые частые. decay() делит всё пополам,
+    # поэтому оценка отражает недавнюю популярность
+    def __init__(self, sample_rate: float, width: int, depth: int, top_k: int) -> None:
+        self.sample_rate = sample_rate
+        self.sampled = 0
+        self._width = width
+        self._depth = depth
+        self._rows = [array('L', [0]) * width for _ in range(depth)]
+        self._top_k = top_k
+        self._top: Dict[str, int] = {}
+        # Наименьший счётчик в заполненном top-K: ключи с меньшей оценкой в него не попадут
+        self._top_floor = 0
+
+    def _cells(self, key: str) -> Iterable[int]:
+        # Двойное хеширование: depth независимых позиций из одного hash()
+        h = hash(key)
+        h1, h2 = h & 0xFFFFFFFF, (h >> 32) | 1
+        return [(h1 + i * h2) % self._width for i in range(self._depth)]
+
+    def record(self, key: str) -> None:
+        if random.random() >= self.sample_rate:
+            return
+        self.sampled += 1
+        count = None
+        for row, cell in zip(self._rows, self._cells(key)):
+            row[cell] += 1
+            count = row[cell] if count is None else min(count, row[cell])
+
+        top = self._top
+        if key in top or len(top) < self._top_k:
+            top[key] = count
+            if len(top) == self._top_k:
+                self._top_floor = min(top.values())
+        elif count > self._top_floor:
+            coldest = min(top, key=top.get)
+            if count > top[coldest]:
+                del top[coldest]
+                top[key] = count
+            self._top_floor = min(top.values())
+
+    def samples(self, key: str) -> int:
+        # Сколько обращений к ключу попало в выборку
+        return min(row[cell] for row, cell in zip(self._rows, self._cells(key)))
+
+    def estimate(self, key: str) -> float:
+        # Оценка числа обращений с поправкой на долю выборки
+        return self.samples(key) / self.sample_rate
+
+    def top(self, limit: Optional[int] = None) -> List[Tuple[str, float]]:
+        items = sorted(self._top.items(), key=lambda item: item[1], reverse=True)[:limit]
+        return [(key, count / self.sample_rate) for key, count in items]
+
+    def decay(self) -> None:
+        self._rows = [array('L', (value >> 1 for value in row)) for row in self._rows]
+        self._top = {key: count >> 1 for key, count in self._top.items() if count > 1}
+        self._top_floor = min(self._top.values()) if len(self._top) == self._top_k else 0
+
+
+def _normalize_sort(sort: List[Any]) -> List[Any]:
+    # 'field', {'field': 'asc'} и {'field': {'order': 'asc'}} - одна и та же сортировка
+    normalized = []
+    for item in sort:
+        if isinstance(item, str):
+            item = {item.lstrip('-'): {'order': 'desc' if item.startswith('-') else 'asc'}}
+        elif isinstance(item, dict):
+            item = {field: {'order': options} if isinstance(options, str) else options
+                    for field, options in item.items()}
+        normalized.append(item)
+    return normalized
+
+
+def canonical_query(query_elastic: dict) -> bytes:
+    if 'sort' in query_elastic:
+        query_elastic = {**query_elastic, 'sort': _normalize_sort(query_elastic['sort'])}
+    return orjson.dumps(query_elastic, option=orjson.OPT_SORT_KEYS)
+
+
+def _glob_escape(value: str) -> str:
+    return re.sub(r'([*?\[\]\\])', r'\\\1', value)
+
+
+def fingerprint_query(query_elastic: Union[dict, bytes]) -> str:
+    # Принимает и уже канонический запрос, чтобы не сериализовать его второй раз
+    data = query_elastic if isinstance(query_elastic, bytes) else canonical_query(query_elastic)
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+_local_caches: Dict[str, LocalCache] = {}
+_query_sizes: Dict[str, SizeHistogram] = defaultdict(SizeHistogram)
+_key_sizes: Dict[str, SizeHistogram] = defaultdict(SizeHistogram)
+_access_stats: Dict[str, AccessStats] = {}
+# Меньше стольких попаданий в выборку ключ не считается горячим при любой доле выборки
+HOT_KEY_MIN_SAMPLES = 3
+_serializer: Optional[Serializer] = None
+
+
+def get_serializer() -> Serializer:
+    global _serializer
+    if _serializer is None:
+        _serializer = create_serializer(CACHE_CODEC, CACHE_COMPRESSION, CACHE_COMPRESSION_THRESHOLD)
+    return _serializer
+
+
+def get_local_cache(name: str, ttl: int = LOCAL_CACHE_TTL, max_entries: int = LOCAL_CACHE_MAX_ENTRIES,
+                    max_size: int = LOCAL_CACHE_MAX_SIZE) -> Optional[LocalCache]:
+    if max_entries <= 0:
+        return None
+    if name not in _local_caches:
+        _local_caches[name] = LocalCache(ttl, max_entries, max_size)
+    return _local_caches[name]
+
+
+def get_access_stats(name: str) -> Optional[AccessStats]:
+    if not CACHE_STATS_ENABLED:
+        return None
+    if name not in _access_stats:
+        _access_stats[name] = AccessStats(CACHE_STATS_SAMPLE_RATE, CACHE_STATS_WIDTH, CACHE_STATS_DEPTH,
+                                          CACHE_STATS_TOP_K)
+    return _access_stats[name]
+
+
+def get_hot_key_stats(limit: int = 20) -> Dict[str, Dict[str, Any]]:
+    return {name: {'sampled': stats.sampled, 'top': stats.top(limit)} for name, stats in _access_stats.items()}
+
+
+def _hot_keys_key(name: str, window: int) -> str:
+    return f'{CACHE_NAMESPACE}:hot:{name}:{window}'
+
+
+async def flush_access_stats(redis: Redis, window: int, interval: int) -> None:
+    # top-K воркера добавляется к общему zset окна: сумма по воркерам - частота обращений по всему сервису.
+    # Окна хранятся несколько интервалов, чтобы после перезапуска была доступна статистика прежних воркеров
+    pipe = redis.pipeline()
+    for name, stats in _access_stats.items():
+        key = _hot_keys_key(name, window)
+        for hot_key, hits in stats.top():
+            pipe.zincrby(key, hits, hot_key)
+        pipe.expire(key, interval * 3)
+        stats.decay()
+    await pipe.execute()
+
+
+async def flush_access_stats_periodically(redis: Redis, interval: int) -> None:
+    while True:
+        # По границам окон, общим для всех воркеров: каждый воркер пишет в окно один раз
+        await asyncio.sleep(interval - time.time() % interval)
+        try:
+            await flush_access_stats(redis, round(time.time() / interval) - 1, interval)
+        except Exception:
+            logger.warning('access stats flush failed', exc_info=True)
+
+
+async def get_hot_keys(redis: Redis, name: str, interval: int, limit: int) -> List[Tuple[str, float]]:
+    # Самые частые ключи за последнее завершённое окно по всем воркерам
+    window = int(time.time() // interval) - 1
+    return await redis.zrevrange(_hot_keys_key(name, window), 0, limit - 1, withscores=True, encoding='utf-8')
+
+
+def get_local_cache_stats() -> Dict[str, Dict[str, int]]:
+    return {name: local.stats for name, local in _local_caches.items()}
+
+
+def get_key_size_stats() -> Dict[str, Dict[str, Any]]:
+    return {
+        name: {'query': _query_sizes[name].stats, 'key': _key_sizes[name].stats}
+        for name in _query_sizes
+    }
+
+
+# Сообщения канала LOCAL_CACHE_CHANNEL: '<воркер>:<полный ключ>' - сбросить ключ в L1,
+# '<воркер>:!reload:<имя>' - перезагрузить данные в памяти воркера вне LocalCache (например, каталог жанров)
+RELOAD_PREFIX = '!reload:'
+_reload_handlers: Dict[str, Callable[[], None]] = {}
+
+
+def on_reload(name: str, handler: Callable[[], None]) -> None:
+    _reload_handlers[name] = handler
+
+
+def reload_local(name: str) -> None:
+    handler = _reload_handlers.get(name)
+    if handler is not None:
+        handler()
+
+
+async def publish_reload(redis: Redis, name: str) -> None:
+    # Перезагружают все воркеры, включая этот
+    await redis.publish(LOCAL_CACHE_CHANNEL, f'{WORKER_ID}:{RELOAD_PREFIX}{name}')
+    reload_local(name)
+
+
+def invalidate_local(full_key: str) -> None:
+    for local in _local_caches.values():
+        local.delete(full_key)
+
+
+async def listen_invalidations(redis: Redis) -> None:
+    # У pub/sub-соединения aioredis нет переподключения: при обрыве подписка восстанавливается здесь
+    delay = REDIS_RETRY_DELAY
+    try:
+        while True:
+            try:
+                channel, = await redis.subscribe(LOCAL_CACHE_CHANNEL)
+                # Сообщения, пришедшие без подписки, потеряны: L1 сбрасывается целиком
+                for local in _local_caches.values():
+                    local.clear()
+                delay = REDIS_RETRY_DELAY
+                async for message in channel.iter(encoding='utf-8'):
+                    worker_id, _, full_key = message.partition(':')
+                    if worker_id == WORKER_ID:
+                        continue
+                    if full_key.startswith(RELOAD_PREFIX):
+                        reload_local(full_key[len(RELOAD_PREFIX):])
+                    else:
+                        invalidate_local(full_key)
+            except (aioredis.RedisError, OSError, asyncio.TimeoutError):
+                logger.warning('local cache invalidation channel failed', exc_info=True)
+            if redis.closed:
+                return
+            logger.warning('resubscribing to %s in %.0fs', LOCAL_CACHE_CHANNEL, delay)
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, REDIS_RETRY_DELAY_MAX)
+    finally:
+        if not redis.closed:
+            await redis.unsubscribe(LOCAL_CACHE_CHANNEL)
+
+
+def _cache_path(name: str, serializer: Serializer) -> str:
+    return f'{CACHE_NAMESPACE}:{name}:s{CACHE_SCHEMA_VERSION}.{serializer.tag}'
+
+
+class CacheEntry(NamedTuple):
+    value: Any
+    # Мягкий TTL (unix time), после которого запись считается устаревшей
+    expires_at: float
+    # Сколько секунд заняло вычисление значения
+    delta: float = 0.0
+    # Размер записи в Redis, байт
+    size: int = 0
+
+    @property
+    def is_stale(self) -> bool:
+        return time.time() >= self.expires_at
+
+    @property
+    def is_expired(self) -> bool:
+        # Вышло и время, когда запись отдаётся с обновлением в фоне: дальше - только если Elasticsearch недоступен
+        return time.time() >= self.expires_at + CACHE_STALE_TTL
+
+    def should_refresh(self, beta: float) -> bool:
+        # XFetch: чем ближе мягкий TTL и чем дольше пересчёт, тем выше шанс обновить запись заранее
+        return time.time() - self.delta * beta * math.log(1.0 - random.random()) >= self.expires_at
+
+
+class CachedResponse(NamedTuple):
+    status: int
+    headers: List[Tuple[bytes, bytes]]
+    body: bytes
+    etag: str
+
+
+class QueryResult(NamedTuple):
+    ids: List[str]
+    total: int
+    # Значения сортировки последнего документа, для search_after
+    last_sort: Optional[List[Any]] = None
+    # Агрегации из того же запроса в компактном виде, см. BaseESService._facets
+    facets: Optional[Dict[str, Any]] = None
+
+
+# Добавляет ключ в множества тегов. Срок множества только продлевается: иначе запись с коротким TTL
+# сократила бы его ниже TTL горячего ключа, и инвалидация по id его бы пропустила. Заодно из множества
+# убираются несколько случайных ключей, которых уже нет в Redis, чтобы оно не росло бесконечно
+_TAG_SCRIPT = """
+local expire = tonumber(ARGV[2])
+for _, tag_key in ipairs(KEYS) do
+    redis.call('sadd', tag_key, ARGV[1])
+    if redis.call('ttl', tag_key) < expire then
+        redis.call('expire', tag_key, expire)
+    end
+    for _, member in ipairs(redis.call('srandmember', tag_key, tonumber(ARGV[3]))) do
+        if redis.call('exists', member) == 0 then
+            redis.call('srem', tag_key, member)
+        end
+    end
+end
+return 0
+"""
+
+# Сколько ключей множества тега проверяется при каждой записи
+TAG_PRUNE_SAMPLE = 4
+
+_RELEASE_LOCK_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
 
 class Cache:
-    def __init__(self, redis: Redis, path: str = '', expire: int = 60 * 5) -> None:
+    def __init__(self, redis: Redis, path: str = '', expire: int = 60 * 5,
+                 local: Optional[LocalCache] = None, serializer: Optional[Serializer] = None, name: str = '',
+                 stats: Optional[AccessStats] = None) -> None:
         self._redis = redis
+        self.name = name or path
         self._path = path
         self._ttl = expire
+        self._local = local
+        self._serializer = serializer or get_serializer()
+        self._stats = stats
 
-    def _get_full_path(self, key: str) -> str:
+    def get_full_path(self, key: str) -> str:
         if not self._path:
             return key
         return f'{self._path}:{key}'
 
-    async def get(self, key: str) -> Any:
-        full_key = self._get_full_path(key)
+    def _unpack(self, data: bytes) -> Optional[CacheEntry]:
+        try:
+            expires_at, delta, value = self._serializer.loads(data)
+        except Exception:
+            logger.warning('Failed to decode cache entry, treating it as a miss', exc_info=True)
+            return None
+        return CacheEntry(value, expires_at, delta, len(data))
+
+    async def get(self, key: str) -> Optional[CacheEntry]:
+        full_key = self.get_full_path(key)
         data = await self._redis.get(full_key)
         if not data:
             return None
-        logger.debug(f"Trying to get from cache {key=}, {data=}")
-        return data
+        logger.debug('Got %d bytes from cache for %s', len(data), key)
+        return self._unpack(data)
+
+    async def get_many(self, keys: List[str]) -> List[Optional[CacheEntry]]:
+        if not keys:
+            return []
+        data = await self._redis.mget(*[self.get_full_path(key) for key in keys])
+        logger.debug('Trying to get %d keys from cache', len(keys))
+        return [self._unpack(item) if item else None for item in data]
+
+    async def set(self, key: str, value: Any, delta: float = 0.0) -> CacheEntry:
+        return (await self.set_many({key: value}, delta))[0]
+
+    async def set_many(self, items: Dict[str, Any], delta: float = 0.0,
+                       tags: Optional[Dict[str, List[str]]] = None) -> List[CacheEntry]:
+        logger.debug('Set %d keys in cache', len(items))
+        now = time.time()
+        entries = []
+        pipe = self._redis.pipeline()
+        for key, value in items.items():
+            ttl = self._key_ttl(key)
+            expires_at = now + ttl
+            # Запись живёт в Redis дольше мягкого TTL, чтобы её можно было отдать устаревшей
+            expire = ttl + CACHE_STALE_TTL + CACHE_FALLBACK_TTL
+            full_key = self.get_full_path(key)
+            data = self._serializer.dumps([expires_at, delta, value])
+            pipe.set(full_key, data, expire=expire)
+            if self._local is not None:
+                pipe.publish(LOCAL_CACHE_CHANNEL, f'{WORKER_ID}:{full_key}')
+            # Теги - множества ключей, которые надо удалить при изменении документа с этим id
+            tag_keys = [self.get_full_path(f'tag:{tag}') for tag in (tags or {}).get(key, ())]
+            if tag_keys:
+                pipe.eval(_TAG_SCRIPT, keys=tag_keys, args=[full_key, expire, TAG_PRUNE_SAMPLE])
+            entries.append(CacheEntry(value, expires_at, delta, len(data)))
+        await pipe.execute()
+        return entries
+
+    def _key_ttl(self, key: str) -> int:
+        return self._ttl
+
+    async def _get_local_or_remote(self, key: str, parse) -> Optional[CacheEntry]:
+        if self._stats is not None:
+            self._stats.record(key)
+        full_key = self.get_full_path(key)
+        if self._local is not None:
+            entry = self._local.get(full_key)
+            if entry is not None:
+                CACHE_LOOKUPS.inc(self.name, 'local')
+                return entry
+        entry = await self.get(key)
+        if entry is None:
+            CACHE_LOOKUPS.inc(self.name, 'miss')
+            return None
+        CACHE_LOOKUPS.inc(self.name, 'redis')
+        entry = entry._replace(value=parse(entry.value))
+        if self._local is not None:
+            self._local.set(full_key, entry, entry.size)
+        return entry
+
+    async def _set_local_and_remote(self, key: str, value: Any, data: Any, delta: float,
+                                    tags: Optional[List[str]] = None) -> None:
+        await self._set_many_local_and_remote({key: (value, data)}, delta, {key: tags} if tags else None)
+
+    async def _set_many_local_and_remote(self, items: Dict[str, Tuple[Any, Any]], delta: float,
+                                         tags: Optional[Dict[str, List[str]]] = None) -> None:
+        entries = await self.set_many({key: data for key, (_, data) in items.items()}, delta, tags)
+        if self._local is None:
+            return
+        for (key, (value, _)), entry in zip(items.items(), entries):
+            self._local.set(self.get_full_path(key), entry._replace(value=value), entry.size)
 
-    async def set(self, key: str, value: Any) -> None:
-        full_key = self._get_full_path(key)
-        logger.debug(f"Set cache with {key=}")
-        await self._redis.set(full_key, value, expire=self._ttl)
+    async def delete_full_keys(self, full_keys: List[str]) -> None:
+        if not full_keys:
+            return
+        pipe = self._redis.pipeline()
+        pipe.unlink(*full_keys)
+        for full_key in full_keys:
+            pipe.publish(LOCAL_CACHE_CHANNEL, f'{WORKER_ID}:{full_key}')
+        await pipe.execute()
+        for full_key in full_keys:
+            invalidate_local(full_key)
+
+    async def delete_matching(self, pattern: str) -> int:
+        # Все ключи по шаблону SCAN пачками; L1-копии сбрасываются у всех воркеров, как при удалении по тегам
+        keys = [key.decode() async for key in self._redis.iscan(match=self.get_full_path(pattern), count=1000)]
+        for start in range(0, len(keys), 1000):
+            await self.delete_full_keys(keys[start:start + 1000])
+        return len(keys)
+
+    async def invalidate_tags(self, tags: List[str], full_keys: Iterable[str] = ()) -> List[str]:
+        tag_keys = [self.get_full_path(f'tag:{tag}') for tag in tags]
+        pipe = self._redis.pipeline()
+        for tag_key in tag_keys:
+            pipe.smembers(tag_key, encoding='utf-8')
+        tagged = await pipe.execute()
+        full_keys = set(full_keys)
+        full_keys.update(key for members in tagged for key in members)
+        full_keys.update(tag_keys)
+        await self.delete_full_keys(list(full_keys))
+        return list(full_keys)
+
+    async def acquire_lock(self, key: str, timeout: float) -> Optional[str]:
+        token = uuid4().hex
+        acquired = await self._redis.set(self.get_full_path(f'lock:{key}'), token,
+                                         pexpire=int(timeout * 1000), exist=Redis.SET_IF_NOT_EXIST)
+        return token if acquired else None
+
+    async def release_lock(self, key: str, token: str) -> None:
+        await self._redis.eval(_RELEASE_LOCK_SCRIPT, keys=[self.get_full_path(f'lock:{key}')], args=[token])
 
 
 class ModelCache(Cache, Generic[T]):
     def __init__(self, redis: Redis, model: T, ttl: int) -> None:
         self._model = model
-        super().__init__(redis, path=model.__name__, expire=ttl)
+        serializer = get_serializer()
+        super().__init__(redis, path=_cache_path(model.__name__, serializer), expire=ttl,
+                         local=get_local_cache(model.__name__), serializer=serializer, name=model.__name__,
+                         stats=get_access_stats(model.__name__))
 
-    def parse_raw_model(self, data: Optional[str]) -> Optional[T]:
-        if not data:
-            return None
-        return self._model.parse_raw(data)
+    def for_model(self, model: Type) -> 'ModelCache':
+        return ModelCache(self._redis, model, self._ttl)
 
-    async def get_by_id(self, film_id: str) -> Optional[T]:
-        key = f'id:{film_id}'
-        data = await self.get(key)
-        return self.parse_raw_model(data)
+    def _key_ttl(self, key: str) -> int:
+        # Горячие ключи живут дольше. Статистика у каждого воркера своя и видит примерно 1/WORKERS
+        # обращений, а одно-два обращения в выборке - ещё шум, а не популярность
+        if self._stats is None:
+            return self._ttl
+        samples = self._stats.samples(key)
+        if samples >= HOT_KEY_MIN_SAMPLES and samples / self._stats.sample_rate >= CACHE_HOT_KEY_HITS / WORKERS:
+            return int(self._ttl * CACHE_HOT_TTL_FACTOR)
+        return self._ttl
 
-    async def set_by_id(self, film_id: str, value: T) -> None:
-        key = f'id:{film_id}'
-        await self.set(key=key, value=value.json())
+    def build_model(self, data: Dict[str, Any]) -> T:
+        if CACHE_TRUSTED_CONSTRUCT:
+            return construct(self._model, data)
+        return self._model.parse_obj(data)
 
-    async def get_by_elastic_query(self, query_elastic: dict) -> Optional[T]:
-        key = f'query:{str(query_elastic)}'
-        data = await self.get(key)
-        if not data:
-            return None
-        return parse_raw_as(List[self._model], data)
+    def build_models(self, data: List[Dict[str, Any]]) -> List[T]:
+        return [self.build_model(item) for item in data]
+
+    @staticmethod
+    def id_key(instance_id: str) -> str:
+        return f'id:{instance_id}'
+
+    def query_key(self, query_elastic: dict) -> str:
+        # Хеш запроса задаёт только fingerprint_query: по нему же строятся курсоры
+        data = canonical_query(query_elastic)
+        key = f'query:{fingerprint_query(data)}'
+        name = self._model.__name__
+        _query_sizes[name].observe(len(data))
+        _key_sizes[name].observe(len(self.get_full_path(key)))
+        return key
+
+    async def get_entry_by_id(self, instance_id: str) -> Optional[CacheEntry]:
+        return await self._get_local_or_remote(self.id_key(instance_id), self.build_model)
+
+    async def get_by_id(self, instance_id: str) -> Optional[T]:
+        entry = await self.get_entry_by_id(instance_id)
+        return entry.value if entry else None
+
+    async def set_by_id(self, instance_id: str, value: T, delta: float = 0.0) -> None:
+        await self._set_local_and_remote(self.id_key(instance_id), value, value.dict(), delta)
+
+    async def get_many_entries_by_id(self, ids: List[str]) -> Dict[str, CacheEntry]:
+        if self._stats is not None:
+            for instance_id in ids:
+                self._stats.record(self.id_key(instance_id))
+        entries = {}
+        missing = []
+        for instance_id in ids:
+            entry = self._local.get(self.get_full_path(self.id_key(instance_id))) if self._local is not None else None
+            if entry is not None:
+                entries[instance_id] = entry
+            else:
+                missing.append(instance_id)
+        remote = await self.get_many([self.id_key(instance_id) for instance_id in missing])
+        for instance_id, entry in zip(missing, remote):
+            if entry is None:
+                continue
+            entry = entry._replace(value=self.build_model(entry.value))
+            if self._local is not None:
+                self._local.set(self.get_full_path(self.id_key(instance_id)), entry, entry.size)
+            entries[instance_id] = entry
+        local_hits = len(ids) - len(missing)
+        CACHE_LOOKUPS.inc(self.name, 'local', amount=local_hits)
+        CACHE_LOOKUPS.inc(self.name, 'redis', amount=len(entries) - local_hits)
+        CACHE_LOOKUPS.inc(self.name, 'miss', amount=len(ids) - len(entries))
+        return entries
+
+    async def get_many_by_id(self, ids: List[str]) -> Dict[str, T]:
+        entries = await self.get_many_entries_by_id(ids)
+        return {instance_id: entry.value for instance_id, entry in entries.items()}
+
+    async def set_many_by_id(self, values: Dict[str, T], delta: float = 0.0) -> None:
+        if not values:
+            return
+        await self._set_many_local_and_remote(
+            {self.id_key(instance_id): (value, value.dict()) for instance_id, value in values.items()}, delta)
+
+    async def get_entry_by_query_key(self, key: str) -> Optional[CacheEntry]:
+        return await self._get_local_or_remote(key, self.build_models)
+
+    async def set_by_query_key(self, key: str, values: List[T], delta: float = 0.0) -> None:
+        await self._set_local_and_remote(key, values, [value.dict() for value in values], delta,
+                                         tags=[value.id for value in values])
+
+    async def get_entry_ids_by_query_key(self, key: str) -> Optional[CacheEntry]:
+        return await self._get_local_or_remote(key, lambda data: QueryResult(**data))
+
+    async def set_ids_by_query_key(self, key: str, result: QueryResult, delta: float = 0.0) -> None:
+        await self._set_local_and_remote(key, result, result._asdict(), delta, tags=result.ids)
+
+    async def get_hot_ids(self, interval: int, limit: int) -> List[str]:
+        prefix = self.id_key('')
+        hot_keys = await get_hot_keys(self._redis, self.name, interval, limit)
+        return [key[len(prefix):] for key, _ in hot_keys if key.startswith(prefix)]
+
+    async def invalidate_ids(self, ids: List[str]) -> None:
+        # Удаляются сами документы и все страницы поиска, в которых они встречались
+        await self.invalidate_tags(ids, [self.get_full_path(self.id_key(instance_id)) for instance_id in ids])
+
+    async def invalidate_queries(self) -> int:
+        # Все страницы поиска модели: теги по id не помогут, если документ добавлен, а не изменён
+        return await self.delete_matching('query:*')
+
+
+class ResponseCache(Cache):
+    # Готовые HTTP-ответы. Ключи, TTL и теги устроены как в ModelCache: ответ удаляется
+    # вместе с документами, которые в него попали
+    def __init__(self, redis: Redis, ttl: int) -> None:
+        serializer = get_serializer()
+        super().__init__(redis, path=_cache_path('Response', serializer), expire=ttl,
+                         local=get_local_cache('Response'), serializer=serializer, name='Response')
+
+    @staticmethod
+    def request_key(path: str, query_string: bytes) -> str:
+        # Порядок параметров запроса не влияет на ключ. Путь хранится открыто, чтобы сбрасывать ответы по префиксу
+        params = urlencode(sorted(parse_qsl(query_string.decode('latin-1'), keep_blank_values=True)))
+        return f'response:{path}:{hashlib.blake2b(params.encode(), digest_size=16).hexdigest()}'
+
+    @staticmethod
+    def _parse_response(data: Dict[str, Any]) -> CachedResponse:
+        return CachedResponse(
+            status=data['status'],
+            headers=[(name.encode('latin-1'), value.encode('latin-1')) for name, value in data['headers']],
+            body=data['body'].encode(),
+            etag=data['etag'],
+        )
+
+    async def get_response(self, key: str) -> Optional[CacheEntry]:
+        return await self._get_local_or_remote(key, self._parse_response)
+
+    async def set_response(self, key: str, response: CachedResponse, delta: float = 0.0,
+                           tags: Optional[List[str]] = None) -> None:
+        data = {
+            'status': response.status,
+            'headers': [(name.decode('latin-1'), value.decode('latin-1')) for name, value in response.headers],
+            'body': response.body.decode(),
+            'etag': response.etag,
+        }
+        await self._set_local_and_remote(key, response, data, delta, tags=tags)
+
+    async def invalidate_ids(self, ids: List[str]) -> None:
+        await self.invalidate_tags(ids)
 
-    async def set_by_elastic_query(self, query_elastic: dict, values: List[T]) -> None:
-        key = f'query:{str(query_elastic)}'
-        await self.set(key=key, value=json.dumps([value.dict() for value in values]))
+    async def invalidate_prefix(self, path_prefix: str) -> int:
+        # Все ответы на пути, начинающиеся с path_prefix
+        return await self.delete_matching(f'response:{_glob_escape(path_prefix)}*')
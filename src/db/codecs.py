@@ -0,0 +1,137 @@
+import zlib
+from typing import Any, Dict, Optional
+
+import orjson
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+# Меняется при несовместимом изменении формата записей в кеше
+FORMAT_VERSION = 1
+
+
+class Codec:
+    name = ''
+
+    def dumps(self, obj: Any) -> bytes:
+        raise NotImplementedError
+
+    def loads(self, data: bytes) -> Any:
+        raise NotImplementedError
+
+
+class OrjsonCodec(Codec):
+    name = 'orjson'
+
+    def dumps(self, obj: Any) -> bytes:
+        return orjson.dumps(obj)
+
+    def loads(self, data: bytes) -> Any:
+        return orjson.loads(data)
+
+
+class MsgpackCodec(Codec):
+    name = 'msgpack'
+
+    def dumps(self, obj: Any) -> bytes:
+        return msgpack.packb(obj, use_bin_type=True)
+
+    def loads(self, data: bytes) -> Any:
+        return msgpack.unpackb(data, raw=False)
+
+
+class Compressor:
+    name = ''
+    # Первый байт записи, по которому понятно, как её распаковать
+    marker = b''
+
+    def compress(self, data: bytes) -> bytes:
+        raise NotImplementedError
+
+    def decompress(self, data: bytes) -> bytes:
+        raise NotImplementedError
+
+
+class ZlibCompressor(Compressor):
+    name = 'zlib'
+    marker = b'z'
+
+    def compress(self, data: bytes) -> bytes:
+        return zlib.compress(data, 1)
+
+    def decompress(self, data: bytes) -> bytes:
+        return zlib.decompress(data)
+
+
+class Lz4Compressor(Compressor):
+    name = 'lz4'
+    marker = b'l'
+
+    def compress(self, data: bytes) -> bytes:
+        return lz4.frame.compress(data)
+
+    def decompress(self, data: bytes) -> bytes:
+        return lz4.frame.decompress(data)
+
+
+RAW_MARKER = b'-'
+
+CODECS = {
+    OrjsonCodec.name: OrjsonCodec,
+    MsgpackCodec.name: MsgpackCodec,
+}
+COMPRESSORS = {
+    ZlibCompressor.name: ZlibCompressor,
+    Lz4Compressor.name: Lz4Compressor,
+}
+_DEPENDENCIES = {
+    MsgpackCodec.name: lambda: msgpack,
+    Lz4Compressor.name: lambda: lz4,
+}
+
+
+class Serializer:
+    def __init__(self, codec: Codec, compressor: Optional[Compressor] = None, threshold: int = 0) -> None:
+        self._codec = codec
+        self._compressor = compressor
+        self._threshold = threshold
+        self._decompressors: Dict[bytes, Compressor] = {}
+        if compressor is not None:
+            self._decompressors[compressor.marker] = compressor
+
+    @property
+    def tag(self) -> str:
+        # Входит в ключ кеша: смена формата не читает записи, сохранённые в старом
+        compression = self._compressor.name if self._compressor else 'raw'
+        return f'v{FORMAT_VERSION}.{self._codec.name}.{compression}'
+
+    def dumps(self, obj: Any) -> bytes:
+        data = self._codec.dumps(obj)
+        if self._compressor is not None and len(data) >= self._threshold:
+            return self._compressor.marker + self._compressor.compress(data)
+        return RAW_MARKER + data
+
+    def loads(self, data: bytes) -> Any:
+        marker, payload = data[:1], data[1:]
+        if marker != RAW_MARKER:
+            payload = self._decompressors[marker].decompress(payload)
+        return self._codec.loads(payload)
+
+
+def create_serializer(codec: str, compression: str = '', threshold: int = 0) -> Serializer:
+    for name in (codec, compression):
+        if name in _DEPENDENCIES and _DEPENDENCIES[name]() is None:
+            raise ValueError(f'Cache backend {name} is not installed')
+    if codec not in CODECS:
+        raise ValueError(f'Unknown cache codec {codec}')
+    if compression and compression not in COMPRESSORS:
+        raise ValueError(f'Unknown cache compression {compression}')
+    compressor = COMPRESSORS[compression]() if compression else None
+    return Serializer(CODECS[codec](), compressor, threshold)
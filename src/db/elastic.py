@@ -1,9 +1,174 @@
-from typing import Optional
+import asyncio
+import logging
+import time
+from typing import Dict, Optional
 
-from elasticsearch import AsyncElasticsearch
+import aiohttp
+import elasticsearch.exceptions
+from elasticsearch import AIOHttpConnection, AsyncElasticsearch
+from elasticsearch._async.http_aiohttp import ESClientResponse
+
+from config import (ES_BREAKER_FAILURES, ES_BREAKER_RESET_TIMEOUT, ES_DEADLINE_INITIAL, ES_DEADLINE_MAX,
+                    ES_DEADLINE_MIN, ES_HTTP_COMPRESS, ES_KEEPALIVE_TIMEOUT, ES_MAX_CONNECTIONS, ES_MAX_RETRIES,
+                    ES_RETRY_ON_TIMEOUT, ES_TIMEOUT, ES_URL, ES_WARMUP_CONNECTIONS)
+from metrics import ES_FAILURES, ES_LATENCY, Gauge, Labels
+from resilience import AdaptiveTimeout, CircuitBreaker
+
+logger = logging.getLogger(__name__)
 
 es: Optional[AsyncElasticsearch] = None
 
+# Индексы, по которым делается пробный запрос при прогреве
+WARMUP_INDEXES = ('movies', 'persons', 'genres')
+
+
+class ElasticUnavailable(Exception):
+    # Elasticsearch не ответил в срок, вернул ошибку сервера или отключён автоматом
+    def __init__(self, retry_after: float) -> None:
+        super().__init__(f'elasticsearch is unavailable, retry after {retry_after:.1f}s')
+        self.retry_after = retry_after
+
+
+# Общий на процесс автомат: при серии ошибок запросы сразу получают ElasticUnavailable
+breaker = CircuitBreaker(ES_BREAKER_FAILURES, ES_BREAKER_RESET_TIMEOUT)
+
+
+def _fail(operation: str, reason: str) -> ElasticUnavailable:
+    ES_FAILURES.inc(operation, reason)
+    if reason != 'circuit_open':
+        breaker.record_failure()
+    return ElasticUnavailable(max(breaker.retry_after(), 1.0))
+
+
+def is_filter_only(query: dict) -> bool:
+    # Запрос без полнотекстовой части: только фильтры и сортировка
+    kind, params = next(iter(query.get('query', {'match_all': {}}).items()))
+    return kind in ('match_all', 'constant_score') or (kind == 'bool' and set(params) <= {'filter', 'must_not'})
+
+
+def _query_class(operation: str, kwargs: dict) -> str:
+    # Латентность get по id и поиска с агрегациями различается на порядки: у каждого вида свой дедлайн
+    if operation != 'search':
+        return operation
+    body = kwargs.get('body') or {}
+    if 'aggs' in body or 'aggregations' in body:
+        kind = 'aggs'
+    else:
+        kind = 'filter' if is_filter_only(body) else 'text'
+    return f'search:{kwargs.get("index")}:{kind}'
+
+
+def _guarded(operation: str):
+    method = getattr(AsyncElasticsearch, operation)
+    deadlines: Dict[str, AdaptiveTimeout] = {}
+
+    async def wrapper(self, *args, **kwargs):
+        # Пробный запрос полуоткрытого автомата получает максимальный дедлайн: проверяется,
+        # жив ли Elasticsearch, а не укладывается ли он в прежнюю латентность
+        trial = breaker.state == CircuitBreaker.HALF_OPEN
+        if not breaker.allow():
+            raise _fail(operation, 'circuit_open')
+        query_class = _query_class(operation, kwargs)
+        deadline = deadlines.get(query_class)
+        if deadline is None:
+            deadline = deadlines[query_class] = AdaptiveTimeout(ES_DEADLINE_INITIAL, ES_DEADLINE_MIN, ES_DEADLINE_MAX)
+        # Явный request_timeout (например, у выгрузки и прогрева) заменяет адаптивный дедлайн
+        timeout = kwargs.get('request_timeout') or (ES_DEADLINE_MAX if trial else deadline.timeout)
+        started = time.perf_counter()
+        try:
+            result = await asyncio.wait_for(method(self, *args, **kwargs), timeout)
+        except asyncio.TimeoutError:
+            if 'request_timeout' not in kwargs:
+                deadline.on_timeout()
+            raise _fail(operation, 'timeout')
+        except elasticsearch.exceptions.ConnectionError as exc:
+            raise _fail(operation, 'connection') from exc
+        except elasticsearch.exceptions.TransportError as exc:
+            if isinstance(exc.status_code, int) and (exc.status_code >= 500 or exc.status_code == 429):
+                raise _fail(operation, 'status') from exc
+            # 404 и ошибки запроса - Elasticsearch исправен
+            breaker.record_success()
+            raise
+        finally:
+            ES_LATENCY.observe(time.perf_counter() - started, operation)
+        breaker.record_success()
+        deadline.observe(time.perf_counter() - started)
+        return result
+
+    wrapper.__name__ = operation
+    return wrapper
+
+
+class InstrumentedElasticsearch(AsyncElasticsearch):
+    # Запросы сервисов проходят через дедлайн и автомат, их время попадает в ES_LATENCY
+    get = _guarded('get')
+    mget = _guarded('mget')
+    search = _guarded('search')
+    open_point_in_time = _guarded('open_point_in_time')
+    close_point_in_time = _guarded('close_point_in_time')
+    ping = _guarded('ping')
+
+
+class KeepAliveConnection(AIOHttpConnection):
+    # Та же сессия aiohttp, что и в AIOHttpConnection, но с настраиваемым keep-alive
+    async def _create_aiohttp_session(self):
+        if self.loop is None:
+            self.loop = asyncio.get_running_loop()
+        self.session = aiohttp.ClientSession(
+            headers=self.headers,
+            auto_decompress=True,
+            loop=self.loop,
+            cookie_jar=aiohttp.DummyCookieJar(),
+            response_class=ESClientResponse,
+            connector=aiohttp.TCPConnector(limit=self._limit, use_dns_cache=True, ssl=self._ssl_context,
+                                           keepalive_timeout=ES_KEEPALIVE_TIMEOUT),
+        )
+
+
+def create_elastic() -> AsyncElasticsearch:
+    return InstrumentedElasticsearch(
+        ES_URL,
+        connection_class=KeepAliveConnection,
+        maxsize=ES_MAX_CONNECTIONS,
+        timeout=ES_TIMEOUT,
+        max_retries=ES_MAX_RETRIES,
+        retry_on_timeout=ES_RETRY_ON_TIMEOUT,
+        http_compress=ES_HTTP_COMPRESS,
+    )
+
+
+async def warm_up(client: AsyncElasticsearch) -> None:
+    # Параллельные запросы открывают сразу несколько соединений, пробный поиск прогревает индексы
+    started = time.monotonic()
+    await asyncio.gather(*[client.ping() for _ in range(min(ES_WARMUP_CONNECTIONS, ES_MAX_CONNECTIONS))])
+    await asyncio.gather(*[client.search(index=index, body={'size': 1}, ignore_unavailable=True)
+                           for index in WARMUP_INDEXES])
+    logger.info('elasticsearch pool warmed up in %.3fs', time.monotonic() - started)
+
+
+def _pool_stats() -> Dict[Labels, float]:
+    stats = {('open',): 0, ('in_use',): 0, ('max',): 0, ('waiting',): 0}
+    transport = getattr(es, 'transport', None)
+    for connection in getattr(getattr(transport, 'connection_pool', None), 'connections', ()):
+        connector = getattr(getattr(connection, 'session', None), 'connector', None)
+        if connector is None:
+            continue
+        in_use = len(getattr(connector, '_acquired', ()))
+        idle = sum(len(conns) for conns in getattr(connector, '_conns', {}).values())
+        stats[('open',)] += in_use + idle
+        stats[('in_use',)] += in_use
+        stats[('max',)] += connector.limit
+        # Запросы, ждущие свободного соединения: признак того, что пул мал
+        stats[('waiting',)] += sum(len(waiters) for waiters in getattr(connector, '_waiters', {}).values())
+    return stats
+
+
+BREAKER_STATES = (CircuitBreaker.CLOSED, CircuitBreaker.HALF_OPEN, CircuitBreaker.OPEN)
+ES_BREAKER = Gauge('elasticsearch_circuit_state', 'Circuit breaker state: 0 closed, 1 half-open, 2 open', (),
+                   collect=lambda: {(): BREAKER_STATES.index(breaker.state)})
+ES_POOL = Gauge('elasticsearch_pool_connections', 'Elasticsearch pool connections by state', ('state',),
+                collect=_pool_stats)
+
 
 async def get_elastic() -> AsyncElasticsearch:
     return es
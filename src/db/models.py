@@ -1,10 +1,30 @@
-from typing import Optional, List
+from typing import Any, Dict, NamedTuple, Optional, List, Type, TypeVar
 
 from pydantic import BaseModel
+from pydantic.fields import SHAPE_SINGLETON
 
 ObjectId = str
 ObjectName = str
 
+M = TypeVar('M', bound=BaseModel)
+
+
+def construct(model: Type[M], data: Dict[str, Any]) -> M:
+    # Сборка модели без валидации, рекурсивно для вложенных моделей.
+    # Только для данных, которые уже прошли валидацию: записаны самим сервисом.
+    values = {}
+    for name, field in model.__fields__.items():
+        if name not in data:
+            continue
+        value = data[name]
+        if value is not None and isinstance(field.type_, type) and issubclass(field.type_, BaseModel):
+            if field.shape == SHAPE_SINGLETON:
+                value = construct(field.type_, value)
+            else:
+                value = [construct(field.type_, item) for item in value]
+        values[name] = value
+    return model.construct(**values)
+
 
 class IdName(BaseModel):
     id: str
@@ -33,6 +53,18 @@ class FilmShort(BaseModel):
     imdb_rating: Optional[float]
 
 
+class FacetedPage(NamedTuple):
+    items: List[FilmShort]
+    total: int
+    # genres: [[id жанра, число фильмов], ...]; imdb_rating: [[нижняя граница корзины, число фильмов], ...]
+    facets: Dict[str, List[List[Any]]]
+
+
+class FilmTitle(BaseModel):
+    id: str
+    title: str
+
+
 class Genre(BaseModel):
     id: str
     name: str
@@ -44,3 +76,8 @@ class Person(BaseModel):
     full_name: str
     roles: List[str]
     film_ids: List[str]
+
+
+class PersonName(BaseModel):
+    id: str
+    full_name: str
@@ -1,9 +1,89 @@
-from typing import Optional
+import logging
+import time
+from typing import Dict, Optional
 
+import aioredis
 from aioredis import Redis
+from aioredis.commands import Pipeline
+
+from config import REDIS_CONNECT_TIMEOUT, REDIS_HOST, REDIS_POOL_MAX_SIZE, REDIS_POOL_MIN_SIZE, REDIS_PORT
+from metrics import REDIS_LATENCY, Gauge, Labels
+
+logger = logging.getLogger(__name__)
 
 redis: Optional[Redis] = None
 
 
+class InstrumentedPipeline(Pipeline):
+    async def execute(self, *, return_exceptions=False):
+        with REDIS_LATENCY.time('pipeline'):
+            return await super().execute(return_exceptions=return_exceptions)
+
+
+class InstrumentedRedis(Redis):
+    # commands_factory для aioredis.create_redis_pool: время каждой команды попадает в REDIS_LATENCY
+    def execute(self, command, *args, **kwargs):
+        started = time.perf_counter()
+        name = command.decode() if isinstance(command, bytes) else command
+        result = self._pool_or_conn.execute(command, *args, **kwargs)
+        if hasattr(result, 'add_done_callback'):
+            result.add_done_callback(lambda _: REDIS_LATENCY.observe(time.perf_counter() - started, name.lower()))
+            return result
+        return self._observe(result, name.lower(), started)
+
+    @staticmethod
+    async def _observe(coro, name: str, started: float):
+        # Пул без свободных соединений возвращает корутину, а не future
+        try:
+            return await coro
+        finally:
+            REDIS_LATENCY.observe(time.perf_counter() - started, name)
+
+    def pipeline(self) -> Pipeline:
+        # Команды внутри pipeline не замеряются по отдельности, только весь pipeline целиком
+        return InstrumentedPipeline(self._pool_or_conn, Redis)
+
+
+async def create_redis() -> Redis:
+    return await aioredis.create_redis_pool(
+        (REDIS_HOST, REDIS_PORT),
+        minsize=REDIS_POOL_MIN_SIZE,
+        maxsize=REDIS_POOL_MAX_SIZE,
+        timeout=REDIS_CONNECT_TIMEOUT,
+        commands_factory=InstrumentedRedis,
+    )
+
+
+async def create_connection() -> Redis:
+    # Отдельное соединение для блокирующих команд: пул раздаёт соединения по кругу, не проверяя занятость,
+    # и XREADGROUP с BLOCK задерживал бы команды кеша
+    return await aioredis.create_redis((REDIS_HOST, REDIS_PORT), timeout=REDIS_CONNECT_TIMEOUT)
+
+
+async def warm_up(client: Redis) -> None:
+    # minsize соединений пул открывает сам, проверяем, что сервер отвечает
+    started = time.monotonic()
+    await client.ping()
+    logger.info('redis pool warmed up in %.3fs: %d connections', time.monotonic() - started,
+                getattr(client.connection, 'size', 1))
+
+
+def _pool_stats() -> Dict[Labels, float]:
+    pool = getattr(redis, 'connection', None)
+    if pool is None or not hasattr(pool, 'freesize'):
+        return {}
+    cond = getattr(pool, '_cond', None)
+    return {
+        ('open',): pool.size,
+        ('free',): pool.freesize,
+        ('max',): pool.maxsize,
+        # Ожидающие свободного соединения: признак того, что пул мал
+        ('waiting',): len(getattr(cond, '_waiters', None) or ()),
+    }
+
+
+REDIS_POOL = Gauge('redis_pool_connections', 'Redis pool connections by state', ('state',), collect=_pool_stats)
+
+
 async def get_redis() -> Redis:
     return redis
@@ -0,0 +1,32 @@
+import argparse
+import asyncio
+
+import aioredis
+
+import config
+from services.invalidation import invalidate_queries, publish_changes
+
+
+async def main(index: str, ids: list, queries: bool) -> None:
+    redis = await aioredis.create_redis((config.REDIS_HOST, config.REDIS_PORT))
+    try:
+        if ids:
+            await publish_changes(redis, index, ids)
+        if queries:
+            await invalidate_queries(redis, index)
+    finally:
+        redis.close()
+        await redis.wait_closed()
+
+
+if __name__ == '__main__':
+    # Замена ETL для локальной разработки: публикует изменённые документы в stream инвалидации
+    parser = argparse.ArgumentParser(description='Publish changed documents to the cache invalidation stream')
+    parser.add_argument('index', choices=['movies', 'persons', 'genres'])
+    parser.add_argument('ids', nargs='*')
+    parser.add_argument('--queries', action='store_true',
+                        help='also drop all cached search pages of the index, e.g. after documents were added')
+    args = parser.parse_args()
+    if not args.ids and not args.queries:
+        parser.error('pass document ids, --queries or both')
+    asyncio.run(main(args.index, args.ids, args.queries))
@@ -1,14 +1,23 @@
+import asyncio
 import logging
+import math
+from typing import List
 
-import aioredis
 import uvicorn as uvicorn
-from elasticsearch import AsyncElasticsearch
-from fastapi import FastAPI
+from fastapi import FastAPI, Request, Response, status
 from fastapi.responses import ORJSONResponse
 
 from api_v1 import film, genre, person
+from api_v1.constants import SERVICE_UNAVAILABLE
 import config
-from db import elastic, redis
+import metrics
+from db import cache, elastic, redis
+from middleware import LoadSheddingMiddleware, MetricsMiddleware, ResponseCacheMiddleware
+from services import invalidation
+from services.base import wait_background_tasks
+from services.genre import (CATALOGUE_RELOAD, refresh_catalogue, refresh_catalogue_periodically,
+                            request_catalogue_refresh)
+import warmup
 
 app = FastAPI(
     title=config.PROJECT_NAME,
@@ -17,23 +26,103 @@ app = FastAPI(
     default_response_class=ORJSONResponse,
 )
 
+if config.MAX_IN_FLIGHT_REQUESTS:
+    app.add_middleware(LoadSheddingMiddleware, max_in_flight=config.MAX_IN_FLIGHT_REQUESTS,
+                       retry_after=config.LOAD_SHED_RETRY_AFTER, exempt=('/metrics', '/internal/cache'))
+if config.RESPONSE_CACHE_ENABLED:
+    app.add_middleware(ResponseCacheMiddleware, paths=config.RESPONSE_CACHE_PATHS, ttl=config.CACHE_TTL)
+# Добавляется последним, чтобы учитывать и ответы из кеша
+app.add_middleware(MetricsMiddleware, routes=app.routes)
+
+logger = logging.getLogger(__name__)
+
+background_tasks: List[asyncio.Task] = []
+
+
+async def warm_up():
+    # Недоступный Elasticsearch или Redis не мешает старту: соединения откроются по первым запросам
+    results = await asyncio.gather(
+        asyncio.wait_for(redis.warm_up(redis.redis), config.POOL_WARMUP_TIMEOUT),
+        asyncio.wait_for(elastic.warm_up(elastic.es), config.POOL_WARMUP_TIMEOUT),
+        return_exceptions=True,
+    )
+    for name, result in zip(('redis', 'elasticsearch'), results):
+        if isinstance(result, Exception):
+            logger.warning('%s warm-up failed: %r', name, result)
+
+
+async def load_genre_catalogue():
+    try:
+        await asyncio.wait_for(refresh_catalogue(elastic.es), config.POOL_WARMUP_TIMEOUT)
+    except Exception as exc:
+        # Пока каталог не загружен, жанры читаются из Elasticsearch
+        logger.warning('genre catalogue load failed: %r', exc)
+    cache.on_reload(CATALOGUE_RELOAD, lambda: request_catalogue_refresh(elastic.es))
+    background_tasks.append(asyncio.create_task(
+        refresh_catalogue_periodically(elastic.es, config.GENRE_CATALOGUE_REFRESH_INTERVAL)))
+
+
+async def prewarm_caches():
+    try:
+        await warmup.prewarm(redis.redis, elastic.es)
+    except Exception as exc:
+        logger.warning('cache prewarm failed: %r', exc)
+
 
 @app.on_event('startup')
 async def startup():
-    redis.redis = await aioredis.create_redis_pool((config.REDIS_HOST, config.REDIS_PORT), minsize=10, maxsize=20)
-    elastic.es = AsyncElasticsearch(config.ES_URL)
+    redis.redis = await redis.create_redis()
+    elastic.es = elastic.create_elastic()
+    if config.POOL_WARMUP_ENABLED:
+        await warm_up()
+    if config.GENRE_CATALOGUE_ENABLED:
+        await load_genre_catalogue()
+    if config.CACHE_PREWARM_ENABLED:
+        # В фоне: воркер начинает принимать запросы, не дожидаясь прогрева
+        background_tasks.append(asyncio.create_task(prewarm_caches()))
+    background_tasks.append(asyncio.create_task(cache.listen_invalidations(redis.redis)))
+    if config.CACHE_STATS_ENABLED:
+        background_tasks.append(asyncio.create_task(
+            cache.flush_access_stats_periodically(redis.redis, config.CACHE_STATS_FLUSH_INTERVAL)))
+    if config.CACHE_INVALIDATION_ENABLED:
+        background_tasks.append(asyncio.create_task(invalidation.consume_changes(redis.redis)))
 
 
 @app.on_event('shutdown')
 async def shutdown():
-    await redis.redis.close()
+    # Новые запросы уже не принимаются, а начатые uvicorn дождался. Фоновые обновления кеша
+    # должны успеть записать результат, пока соединения открыты
+    await wait_background_tasks(config.SHUTDOWN_DRAIN_TIMEOUT)
+    for task in background_tasks:
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    redis.redis.close()
+    await redis.redis.wait_closed()
     await elastic.es.close()
 
 
+@app.exception_handler(elastic.ElasticUnavailable)
+async def elastic_unavailable_handler(request: Request, exc: elastic.ElasticUnavailable) -> ORJSONResponse:
+    return ORJSONResponse({'detail': SERVICE_UNAVAILABLE}, status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                          headers={'Retry-After': str(math.ceil(exc.retry_after))})
+
+
 app.include_router(film.router, prefix='/v1/film', tags=['film'])
 app.include_router(person.router, prefix='/v1/person', tags=['person'])
 app.include_router(genre.router, prefix='/v1/genre', tags=['genre'])
 
+
+@app.get('/internal/cache', include_in_schema=False)
+async def cache_stats():
+    return {'local': cache.get_local_cache_stats(), 'key_sizes': cache.get_key_size_stats(),
+            'hot_keys': cache.get_hot_key_stats()}
+
+
+@app.get('/metrics', include_in_schema=False)
+async def metrics_endpoint():
+    return Response(metrics.render(), media_type='text/plain; version=0.0.4')
+
+
 if __name__ == '__main__':
     uvicorn.run(
         'main:app',
@@ -0,0 +1,164 @@
+import time
+from bisect import bisect_left
+from collections import defaultdict
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+# Метрики в текстовом формате Prometheus. Значения хранятся в памяти процесса,
+# каждый воркер отдаёт свои
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+Labels = Tuple[str, ...]
+
+
+def _format_labels(names: Sequence[str], values: Labels, extra: str = '') -> str:
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value: float) -> str:
+    return repr(float(value)) if value != float('inf') else '+Inf'
+
+
+class Metric:
+    type = ''
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        _registry.append(self)
+
+    def samples(self) -> Iterable[Tuple[str, Labels, str, float]]:
+        raise NotImplementedError
+
+    def render(self) -> List[str]:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type}']
+        for suffix, labels, extra, value in self.samples():
+            lines.append(f'{self.name}{suffix}{_format_labels(self.labelnames, labels, extra)} {_format_value(value)}')
+        return lines
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> None:
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[Labels, float] = defaultdict(float)
+
+    def inc(self, *labels: str, amount: float = 1) -> None:
+        self._values[labels] += amount
+
+    def get(self, *labels: str) -> float:
+        return self._values.get(labels, 0)
+
+    def samples(self) -> Iterable[Tuple[str, Labels, str, float]]:
+        for labels, value in sorted(self._values.items()):
+            yield '_total', labels, '', value
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 collect: Optional[Callable[[], Dict[Labels, float]]] = None) -> None:
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[Labels, float] = defaultdict(float)
+        # Значения, которые вычисляются в момент запроса /metrics
+        self._collect = collect
+
+    def inc(self, *labels: str, amount: float = 1) -> None:
+        self._values[labels] += amount
+
+    def dec(self, *labels: str, amount: float = 1) -> None:
+        self._values[labels] -= amount
+
+    def set(self, value: float, *labels: str) -> None:
+        self._values[labels] = value
+
+    def samples(self) -> Iterable[Tuple[str, Labels, str, float]]:
+        values = self._collect() if self._collect else self._values
+        for labels, value in sorted(values.items()):
+            yield '', labels, '', value
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS) -> None:
+        super().__init__(name, documentation, labelnames)
+        self._buckets = tuple(buckets)
+        # labels -> [количество в каждой корзине (не накопительно) и за последней, сумма]
+        self._values: Dict[Labels, list] = {}
+
+    def observe(self, value: float, *labels: str) -> None:
+        data = self._values.get(labels)
+        if data is None:
+            data = self._values[labels] = [[0] * (len(self._buckets) + 1), 0.0]
+        data[0][bisect_left(self._buckets, value)] += 1
+        data[1] += value
+
+    def time(self, *labels: str) -> 'Timer':
+        return Timer(self, labels)
+
+    def samples(self) -> Iterable[Tuple[str, Labels, str, float]]:
+        for labels, (counts, total) in sorted(self._values.items()):
+            cumulative = 0
+            for bound, count in zip((*self._buckets, float('inf')), counts):
+                cumulative += count
+                yield '_bucket', labels, f'le="{_format_value(bound)}"', cumulative
+            yield '_sum', labels, '', total
+            yield '_count', labels, '', cumulative
+
+
+class Timer:
+    __slots__ = ('_histogram', '_labels', '_started')
+
+    def __init__(self, histogram: Histogram, labels: Labels) -> None:
+        self._histogram = histogram
+        self._labels = labels
+
+    def __enter__(self) -> 'Timer':
+        self._started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self._histogram.observe(time.perf_counter() - self._started, *self._labels)
+
+
+_registry: List[Metric] = []
+
+
+def render() -> str:
+    return '\n'.join(line for metric in _registry for line in metric.render()) + '\n'
+
+
+REQUEST_LATENCY = Histogram('http_request_duration_seconds', 'HTTP request latency',
+                            ('method', 'route', 'status'))
+REQUESTS_IN_PROGRESS = Gauge('http_requests_in_progress', 'HTTP requests being processed', ('method', 'route'))
+ES_LATENCY = Histogram('elasticsearch_request_duration_seconds', 'Elasticsearch request latency', ('operation',))
+# reason: timeout, connection, status, circuit_open
+ES_FAILURES = Counter('elasticsearch_failures', 'Elasticsearch requests that failed or were not sent',
+                      ('operation', 'reason'))
+REDIS_LATENCY = Histogram('redis_command_duration_seconds', 'Redis command latency', ('command',))
+# result: local - найдено в L1, redis - в Redis, miss - нигде
+CACHE_LOOKUPS = Counter('cache_lookups', 'Cache lookups by result', ('cache', 'result'))
+# Запросы, на которые ответили записью из кеша с истёкшим сроком, потому что Elasticsearch недоступен
+CACHE_FALLBACKS = Counter('cache_fallbacks', 'Expired cache entries served while Elasticsearch is unavailable',
+                          ('cache',))
+LOAD_SHED = Counter('load_shed_requests', 'Requests rejected with 503 because too many are in flight')
+
+
+def _cache_hit_ratio() -> Dict[Labels, float]:
+    totals: Dict[str, List[float]] = defaultdict(lambda: [0.0, 0.0])
+    for (name, result), value in CACHE_LOOKUPS._values.items():
+        totals[name][1] += value
+        if result != 'miss':
+            totals[name][0] += value
+    return {(name,): hits / lookups for name, (hits, lookups) in totals.items() if lookups}
+
+
+CACHE_HIT_RATIO = Gauge('cache_hit_ratio', 'Share of cache lookups served from L1 or Redis', ('cache',),
+                        collect=_cache_hit_ratio)
@@ -0,0 +1,190 @@
+import hashlib
+import time
+from typing import Any, Dict, FrozenSet, Iterable, List, Optional, Sequence
+from urllib.parse import parse_qsl
+
+import orjson
+from starlette.datastructures import Headers
+from starlette.routing import BaseRoute, Match
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from api_v1.constants import SERVICE_UNAVAILABLE
+from config import CACHE_STALE_TTL
+from db import elastic, redis
+from db.cache import CachedResponse, ResponseCache
+from metrics import LOAD_SHED, REQUEST_LATENCY, REQUESTS_IN_PROGRESS
+
+
+def _etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    for candidate in if_none_match.split(','):
+        candidate = candidate.strip()
+        if candidate.startswith('W/'):
+            candidate = candidate[2:]
+        if candidate in ('*', etag):
+            return True
+    return False
+
+
+# Кешируются только частые запросы каталога: первая страница по рейтингу, в том числе внутри жанра.
+# Значение None - любое значение параметра. Полнотекстовый поиск и прочие фильтры остаются в кеше страниц
+# ModelCache, а курсорные страницы не кешируются вовсе: их X-Next-Cursor может ссылаться на истёкший point-in-time
+CACHEABLE_PARAMS: Dict[str, Optional[FrozenSet[str]]] = {
+    'query': frozenset({''}),
+    'sort': frozenset({'', '-imdb_rating'}),
+    'filter[genre]': None,
+    'page[number]': frozenset({'1'}),
+    'page[size]': None,
+}
+
+
+def _is_cacheable(query_string: bytes) -> bool:
+    params = parse_qsl(query_string.decode('latin-1'), keep_blank_values=True)
+    if len({name for name, _ in params}) != len(params):
+        return False
+    for name, value in params:
+        if name not in CACHEABLE_PARAMS:
+            return False
+        allowed = CACHEABLE_PARAMS[name]
+        if allowed is not None and value not in allowed:
+            return False
+    return True
+
+
+def _document_ids(body: bytes) -> List[str]:
+    # Теги ответа - uuid документов списка или items страницы, как у страниц поиска в ModelCache
+    try:
+        content: Any = orjson.loads(body)
+    except orjson.JSONDecodeError:
+        return []
+    if isinstance(content, dict) and isinstance(content.get('items'), list):
+        content = content['items']
+    items = content if isinstance(content, list) else [content]
+    return [item['uuid'] for item in items if isinstance(item, dict) and isinstance(item.get('uuid'), str)]
+
+
+class ResponseCacheMiddleware:
+    # Кеширует готовые ответы на GET-запросы к paths с параметрами из CACHEABLE_PARAMS вместе с ETag
+    # и отвечает 304 на If-None-Match
+    def __init__(self, app: ASGIApp, paths: Iterable[str], ttl: int) -> None:
+        self.app = app
+        self._paths = frozenset(paths)
+        self._ttl = ttl
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if (scope['type'] != 'http' or scope['method'] != 'GET' or scope['path'] not in self._paths
+                or not _is_cacheable(scope['query_string'])):
+            await self.app(scope, receive, send)
+            return
+
+        cache = ResponseCache(redis.redis, self._ttl)
+        key = cache.request_key(scope['path'], scope['query_string'])
+        if_none_match = Headers(scope=scope).get('if-none-match')
+        entry = await cache.get_response(key)
+        # Пока автомат Elasticsearch разомкнут, устаревший ответ отдаётся без обращения к сервисам
+        if entry is not None and (not entry.is_stale or elastic.breaker.state == elastic.breaker.OPEN):
+            await self._send(send, entry.value, entry.expires_at, if_none_match)
+            return
+
+        messages: List[Message] = []
+
+        async def capture(message: Message) -> None:
+            messages.append(message)
+
+        started = time.monotonic()
+        await self.app(scope, receive, capture)
+        start, *body_messages = messages
+        if start['status'] != 200:
+            for message in messages:
+                await send(message)
+            return
+
+        body = b''.join(message.get('body', b'') for message in body_messages)
+        response = CachedResponse(
+            status=start['status'],
+            headers=list(start.get('headers', [])),
+            body=body,
+            etag=f'"{hashlib.blake2b(body, digest_size=16).hexdigest()}"',
+        )
+        await cache.set_response(key, response, time.monotonic() - started, tags=_document_ids(body))
+        await self._send(send, response, time.time() + self._ttl, if_none_match)
+
+    @staticmethod
+    async def _send(send: Send, response: CachedResponse, expires_at: float, if_none_match: Optional[str]) -> None:
+        max_age = max(int(expires_at - time.time()), 0)
+        cache_headers = [
+            (b'etag', response.etag.encode()),
+            (b'cache-control', f'public, max-age={max_age}, stale-while-revalidate={CACHE_STALE_TTL}'.encode()),
+        ]
+        if _etag_matches(if_none_match, response.etag):
+            await send({'type': 'http.response.start', 'status': 304, 'headers': cache_headers})
+            await send({'type': 'http.response.body', 'body': b''})
+            return
+        await send({'type': 'http.response.start', 'status': response.status,
+                    'headers': response.headers + cache_headers})
+        await send({'type': 'http.response.body', 'body': response.body})
+
+
+class LoadSheddingMiddleware:
+    # Сверх max_in_flight одновременных запросов сразу отвечает 503: очередь не растёт, p99 остаётся ограниченным
+    def __init__(self, app: ASGIApp, max_in_flight: int, retry_after: int, exempt: Iterable[str] = ()) -> None:
+        self.app = app
+        self._max_in_flight = max_in_flight
+        self._retry_after = retry_after
+        self._exempt = frozenset(exempt)
+        self._in_flight = 0
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope['type'] != 'http' or scope['path'] in self._exempt:
+            await self.app(scope, receive, send)
+            return
+        if self._in_flight >= self._max_in_flight:
+            LOAD_SHED.inc()
+            await send({'type': 'http.response.start', 'status': 503, 'headers': [
+                (b'content-type', b'application/json'),
+                (b'retry-after', str(self._retry_after).encode()),
+            ]})
+            await send({'type': 'http.response.body', 'body': orjson.dumps({'detail': SERVICE_UNAVAILABLE})})
+            return
+        self._in_flight += 1
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            self._in_flight -= 1
+
+
+class MetricsMiddleware:
+    # Латентность и число запросов в обработке по шаблону маршрута, а не по пути: id не раздувают число серий
+    def __init__(self, app: ASGIApp, routes: Sequence[BaseRoute]) -> None:
+        self.app = app
+        self._routes = routes
+
+    def _route(self, scope: Scope) -> str:
+        for route in self._routes:
+            match, _ = route.matches(scope)
+            if match == Match.FULL:
+                return getattr(route, 'path', '')
+        return 'unmatched'
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        method, route = scope['method'], self._route(scope)
+        status = 500
+
+        async def send_with_status(message: Message) -> None:
+            nonlocal status
+            if message['type'] == 'http.response.start':
+                status = message['status']
+            await send(message)
+
+        started = time.perf_counter()
+        REQUESTS_IN_PROGRESS.inc(method, route)
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            REQUESTS_IN_PROGRESS.dec(method, route)
+            REQUEST_LATENCY.observe(time.perf_counter() - started, method, route, str(status))
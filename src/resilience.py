@@ -0,0 +1,86 @@
+import time
+from typing import Optional
+
+
+class AdaptiveTimeout:
+    # Дедлайн по наблюдаемой латентности, как RTO в TCP: сглаженное среднее плюс четыре отклонения
+    def __init__(self, initial: float, minimum: float, maximum: float) -> None:
+        self._initial = initial
+        self._minimum = minimum
+        self._maximum = maximum
+        self._average: Optional[float] = None
+        self._deviation = 0.0
+        # Множитель после таймаутов: сами таймауты латентность не измеряют, поэтому дедлайн
+        # удваивается, пока запрос снова не уложится в него (как RTO в TCP)
+        self._backoff = 1
+
+    def observe(self, latency: float) -> None:
+        self._backoff = 1
+        if self._average is None:
+            self._average, self._deviation = latency, latency / 2
+            return
+        self._deviation = 0.75 * self._deviation + 0.25 * abs(self._average - latency)
+        self._average = 0.875 * self._average + 0.125 * latency
+
+    def on_timeout(self) -> None:
+        if self.timeout < self._maximum:
+            self._backoff *= 2
+
+    @property
+    def timeout(self) -> float:
+        if self._average is None:
+            estimate = self._initial
+        else:
+            estimate = max(self._average + 4 * self._deviation, self._minimum)
+        return min(estimate * self._backoff, self._maximum)
+
+
+class CircuitBreaker:
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_threshold: int, reset_timeout: float) -> None:
+        self._failure_threshold = failure_threshold
+        self._reset_timeout = reset_timeout
+        self._failures = 0
+        self._opened_at: Optional[float] = None
+        self._trial_started: Optional[float] = None
+
+    @property
+    def state(self) -> str:
+        if self._opened_at is None:
+            return self.CLOSED
+        if time.monotonic() < self._opened_at + self._reset_timeout:
+            return self.OPEN
+        return self.HALF_OPEN
+
+    def allow(self) -> bool:
+        state = self.state
+        if state == self.CLOSED:
+            return True
+        if state == self.OPEN:
+            return False
+        # Полуоткрытое состояние: пропускаем один пробный запрос. Если он не завершился
+        # за reset_timeout (например, отменён), пропускаем следующий
+        now = time.monotonic()
+        if self._trial_started is None or now >= self._trial_started + self._reset_timeout:
+            self._trial_started = now
+            return True
+        return False
+
+    def retry_after(self) -> float:
+        if self._opened_at is None:
+            return 0.0
+        return max(self._opened_at + self._reset_timeout - time.monotonic(), 0.0)
+
+    def record_success(self) -> None:
+        self._failures = 0
+        self._opened_at = None
+        self._trial_started = None
+
+    def record_failure(self) -> None:
+        self._failures += 1
+        self._trial_started = None
+        if self._opened_at is not None or self._failures >= self._failure_threshold:
+            self._opened_at = time.monotonic()
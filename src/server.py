@@ -0,0 +1,39 @@
+import argparse
+import os
+
+import uvicorn
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Запуск API в нескольких процессах')
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=8888)
+    parser.add_argument('--workers', type=int, default=int(os.getenv('WORKERS', 0)) or os.cpu_count() or 1)
+    parser.add_argument('--log-level', default='info')
+    # Без uvloop и httptools запуск падает, а не переходит молча на asyncio и h11.
+    # Где они не ставятся (Windows), можно явно передать --loop asyncio --http h11
+    parser.add_argument('--loop', default='uvloop', choices=['uvloop', 'asyncio'])
+    parser.add_argument('--http', default='httptools', choices=['httptools', 'h11'])
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    # До импорта config: воркеры наследуют окружение и делят бюджеты соединений на число процессов
+    os.environ['WORKERS'] = str(args.workers)
+    import config
+
+    uvicorn.run(
+        'main:app',
+        host=args.host,
+        port=args.port,
+        workers=args.workers,
+        loop=args.loop,
+        http=args.http,
+        log_config=config.LOGGING,
+        log_level=args.log_level,
+    )
+
+
+if __name__ == '__main__':
+    main()
@@ -1,65 +1,440 @@
+import asyncio
+import base64
+import copy
 import logging
+import time
 from abc import ABC
-from typing import List
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional, Tuple, Type
 
 import elasticsearch.exceptions
-import elasticsearch.exceptions
+import orjson
 from elasticsearch import AsyncElasticsearch
 from elasticsearch_dsl.search import Search
 
-from db.cache import ModelCache
+from config import (CACHE_EARLY_REFRESH_BETA, CACHE_LOCK_ENABLED, CACHE_LOCK_TIMEOUT, CACHE_LOCK_WAIT,
+                    CACHE_QUERY_MODE, ES_PIT_KEEP_ALIVE, ES_TIMEOUT, ES_TRUSTED_CONSTRUCT, ES_USE_PIT,
+                    SUGGEST_CACHE_MAX_ENTRIES, SUGGEST_CACHE_PREFIX_LENGTH, SUGGEST_CACHE_TTL)
+from db.cache import CacheEntry, ModelCache, QueryResult, fingerprint_query, get_local_cache
+from db.elastic import ElasticUnavailable, is_filter_only
+from db.models import construct
+from metrics import CACHE_FALLBACKS, CACHE_LOOKUPS
 
 logger = logging.getLogger(__name__)
 
+Loader = Callable[[], Awaitable[Any]]
+Storer = Callable[[Any, float], Awaitable[None]]
+EntryGetter = Callable[[], Awaitable[Optional[CacheEntry]]]
+
+
+class SingleFlight:
+    def __init__(self) -> None:
+        self._calls: Dict[str, asyncio.Future] = {}
+
+    def in_flight(self, key: str) -> bool:
+        return key in self._calls
+
+    def do(self, key: str, func: Loader) -> Awaitable[Any]:
+        # Один запрос в Elasticsearch на ключ: остальные ждут ту же задачу.
+        # Отмена одного из ожидающих не отменяет общую задачу.
+        task = self._calls.get(key)
+        if task is None:
+            task = asyncio.ensure_future(func())
+            self._calls[key] = task
+            task.add_done_callback(lambda _: self._forget(key, task))
+        return asyncio.shield(task)
+
+    def _forget(self, key: str, task: asyncio.Future) -> None:
+        if self._calls.get(key) is task:
+            del self._calls[key]
+
+
+# Общий на процесс: сервисы могут создаваться на каждый запрос
+single_flight = SingleFlight()
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def encode_cursor(query_id: str, after: List[Any], pit_id: Optional[str] = None) -> str:
+    position = {'q': query_id, 'after': after}
+    if pit_id:
+        position['pit'] = pit_id
+    return base64.urlsafe_b64encode(orjson.dumps(position)).decode().rstrip('=')
+
+
+def decode_cursor(cursor: str, query_id: str) -> Dict[str, Any]:
+    try:
+        position = orjson.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+    except (ValueError, TypeError):
+        raise InvalidCursor(cursor)
+    # Курсор действителен только для того же запроса, в котором он получен
+    if not isinstance(position, dict) or position.get('q') != query_id or not isinstance(position.get('after'), list):
+        raise InvalidCursor(cursor)
+    return position
+
+
+def _log_background_error(task: asyncio.Future) -> None:
+    if task.cancelled() or task.exception() is None:
+        return
+    if isinstance(task.exception(), ElasticUnavailable):
+        # Недоступность Elasticsearch видна в метриках, трассировка на каждый запрос не нужна
+        logger.debug('background cache refresh skipped: %s', task.exception())
+        return
+    logger.error('background cache refresh failed', exc_info=task.exception())
+
+
+_background_tasks = set()
+
+
+def run_in_background(coro: Awaitable[Any]) -> None:
+    task = asyncio.ensure_future(coro)
+    # Держим ссылку, иначе задачу может собрать сборщик мусора
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    task.add_done_callback(_log_background_error)
+
+
+async def wait_background_tasks(timeout: float) -> None:
+    # Фоновые обновления кеша и общие загрузки single-flight, которые ещё не завершились
+    tasks = [*_background_tasks, *single_flight._calls.values()]
+    if tasks:
+        await asyncio.wait(tasks, timeout=timeout)
+
+
+# Подсказки по коротким префиксам: их немного, а запрашиваются они на каждое нажатие клавиши
+_suggest_cache = get_local_cache('Suggest', SUGGEST_CACHE_TTL, SUGGEST_CACHE_MAX_ENTRIES)
+
 
 class BaseESService(ABC):
     model = None
     index = None
+    # Поля _source, которые запрашиваются из Elasticsearch; None - документ целиком
+    source: Optional[List[str]] = None
+    # Поле с edge-ngram подполем suggest и модель подсказок
+    suggest_field: Optional[str] = None
+    suggest_model: Optional[Type] = None
 
     def __init__(self, cache: ModelCache, elastic: AsyncElasticsearch):
         self.cache = cache
         self.elastic = elastic
+        self._projections: Dict[Type, 'BaseESService'] = {}
 
         if not self.model or not self.index:
             raise ValueError('Must set model and index value')
 
+    def with_projection(self, model: Type) -> 'BaseESService':
+        # Тот же сервис, который читает из индекса только поля модели model и кеширует её же
+        if model not in self._projections:
+            projection = copy.copy(self)
+            projection.model = model
+            projection.source = list(model.__fields__)
+            projection.cache = self.cache.for_model(model)
+            projection._projections = {}
+            self._projections[model] = projection
+        return self._projections[model]
+
+    def _build_model(self, source: Dict[str, Any]):
+        if ES_TRUSTED_CONSTRUCT:
+            return construct(self.model, source)
+        return self.model(**source)
+
+    def _source_params(self) -> Dict[str, str]:
+        return {'_source_includes': ','.join(self.source)} if self.source else {}
+
+    @classmethod
+    def cached_models(cls) -> List[Type]:
+        # Модели, которые сервис кладёт в кеш по документам своего индекса
+        return [cls.model]
+
     async def search(self):
         raise NotImplementedError
 
+    async def suggest(self, prefix: str, size: int) -> List:
+        prefix = ' '.join(prefix.lower().split())
+        if not prefix or not self.suggest_field:
+            return []
+        key = f'suggest:{self.index}:{size}:{prefix}'
+        cacheable = _suggest_cache is not None and len(prefix) <= SUGGEST_CACHE_PREFIX_LENGTH
+        if cacheable:
+            items = _suggest_cache.get(key)
+            CACHE_LOOKUPS.inc('Suggest', 'local' if items is not None else 'miss')
+            if items is not None:
+                return items
+
+        async def load():
+            items = await self.with_projection(self.suggest_model)._suggest_in_elastic(prefix, size)
+            if cacheable:
+                _suggest_cache.set(key, items, sum(len(item.json()) for item in items))
+            return items
+
+        # Не в Redis: сетевой round-trip и запись на каждый новый префикс дороже запроса по edge-ngram
+        return await single_flight.do(key, load)
+
+    def _build_suggest(self, prefix: str) -> Search:
+        return Search(using=self.elastic, index=self.index).query(
+            'match', **{f'{self.suggest_field}.suggest': {'query': prefix, 'operator': 'and'}})
+
+    async def _suggest_in_elastic(self, prefix: str, size: int) -> List:
+        s = self._build_suggest(prefix).source(self.source)
+        return await self._search_in_elastic(s[:size].to_dict())
+
     async def get_by_id(self, instance_id: str):
-        instance = await self.cache.get_by_id(instance_id)
-        if not instance:
-            instance = await self._get_from_elastic(instance_id, self.index)
-            logger.debug(f'got {instance.__class__.__name__} from elastic: {instance}')
-            if not instance:
-                return None
-            await self.cache.set_by_id(instance_id, instance)
-        return instance
+        return await self._get_cached(
+            self.cache.id_key(instance_id),
+            lambda: self.cache.get_entry_by_id(instance_id),
+            lambda: self._get_from_elastic(instance_id, self.index),
+            lambda instance, delta: self.cache.set_by_id(instance_id, instance, delta),
+        )
 
     async def _get_from_elastic(self, instance_id: str, index: str):
         try:
-            doc = await self.elastic.get(index, instance_id)
+            doc = await self.elastic.get(index, instance_id, params=self._source_params())
         except elasticsearch.exceptions.NotFoundError:
             return None
-        return self.model(**doc['_source'])
+        return self._build_model(doc['_source'])
 
     async def _search(self, search: Search, page_number: int, page_size: int):
+        if self.source:
+            search = search.source(self.source)
         query = self._get_paginated_query(search, page_number, page_size)
-        items = await self.cache.get_by_elastic_query(query)
-        if not items:
-            search_result = await self.elastic.search(index=self.index, body=query)
-            items = [self.model(**hit['_source']) for hit in search_result['hits']['hits']]
-            await self.cache.set_by_elastic_query(query, items)
-        return items
-
-    async def _get_list_from_elastic(self, ids: List[str]) -> List:
+        key = self.cache.query_key(query)
+        if CACHE_QUERY_MODE == 'ids':
+            result = await self._get_cached_ids(key, query)
+            # Страница собирается из кеша по id, промахи добираются одним mget
+            return await self.get_many(result.ids)
+        return await self._get_cached(
+            key,
+            lambda: self.cache.get_entry_by_query_key(key),
+            lambda: self._search_in_elastic(query),
+            lambda items, delta: self.cache.set_by_query_key(key, items, delta),
+        )
+
+    async def _search_page(self, search: Search, page_number: int, page_size: int) -> Tuple[List, QueryResult]:
+        # Страница вместе с total и агрегациями поиска: всё из одного запроса и одной записи кеша.
+        # Кешируются всегда идентификаторы, независимо от CACHE_QUERY_MODE
+        if self.source:
+            search = search.source(self.source)
+        query = self._get_paginated_query(search, page_number, page_size)
+        result = await self._get_cached_ids(self.cache.query_key(query), query)
+        return await self.get_many(result.ids), result
+
+    async def _get_cached_ids(self, key: str, query: dict) -> QueryResult:
+        return await self._get_cached(
+            key,
+            lambda: self.cache.get_entry_ids_by_query_key(key),
+            lambda: self._search_ids_in_elastic(query),
+            lambda ids, delta: self.cache.set_ids_by_query_key(key, ids, delta),
+        )
+
+    @staticmethod
+    def _search_params(query: dict) -> Dict[str, str]:
+        # Запросы без полнотекстовой части (только фильтры и сортировка) - самые частые при просмотре каталога.
+        # Elasticsearch кеширует ответы с hits в shard request cache, только если попросить явно
+        if is_filter_only(query):
+            return {'request_cache': 'true'}
+        return {}
+
+    async def _search_in_elastic(self, query: dict) -> List:
+        search_result = await self.elastic.search(index=self.index, body=query, **self._search_params(query))
+        return [self._build_model(hit['_source']) for hit in search_result['hits']['hits']]
+
+    async def _search_ids_in_elastic(self, query: dict) -> QueryResult:
+        started = time.monotonic()
+        search_result = await self.elastic.search(index=self.index, body=query, **self._search_params(query))
+        return await self._store_hits(search_result, time.monotonic() - started)
+
+    async def warm_cache(self, search: Search, limit: int, batch_size: int) -> AsyncIterator[int]:
+        # Первые limit документов поиска пачками из Elasticsearch прямо в кеш по id, без чтения кеша.
+        # Отдаёт число записанных документов после каждой пачки
+        if self.source:
+            search = search.source(self.source)
+        for start in range(0, limit, batch_size):
+            size = min(batch_size, limit - start)
+            # Пачки прогрева тяжелее пользовательских запросов и не должны влиять на их дедлайн
+            started = time.monotonic()
+            search_result = await self.elastic.search(index=self.index, body=search[start: start + size].to_dict(),
+                                                      request_timeout=ES_TIMEOUT)
+            result = await self._store_hits(search_result, time.monotonic() - started)
+            yield len(result.ids)
+            if len(result.ids) < size:
+                break
+
+    async def _store_hits(self, search_result: dict, delta: float) -> QueryResult:
+        hits = search_result['hits']['hits']
+        instances = {hit['_id']: self._build_model(hit['_source']) for hit in hits}
+        await self.cache.set_many_by_id(instances, delta)
+        total = search_result['hits']['total']
+        aggregations = search_result.get('aggregations')
+        return QueryResult(
+            ids=list(instances),
+            total=total['value'] if isinstance(total, dict) else total,
+            last_sort=hits[-1].get('sort') if hits else None,
+            facets=self._facets(aggregations) if aggregations else None,
+        )
+
+    def _facets(self, aggregations: Dict[str, Any]) -> Dict[str, Any]:
+        # Сервисы с агрегациями сворачивают ответ Elasticsearch до того, что нужно хранить в кеше
+        return aggregations
+
+    async def _search_after(self, search: Search, cursor: str, page_size: int) -> Tuple[List, Optional[str]]:
+        # Курсорная пагинация: стоимость любой страницы как у первой, нет ограничения max_result_window
+        if self.source:
+            search = search.source(self.source)
+        query = search.extra(size=page_size).to_dict()
+        query['sort'] = [*query.get('sort', ['_score']), {'id': {'order': 'asc'}}]
+        query_id = fingerprint_query(query)[:16]
+        position = decode_cursor(cursor, query_id) if cursor else {}
+        if 'after' in position:
+            query['search_after'] = position['after']
+
+        pit_id = None
+        if ES_USE_PIT:
+            # Мимо кеша страниц и request_cache: в запросе id point-in-time этого клиента, поэтому
+            # одинаковых запросов у разных клиентов не бывает. Документы страницы всё равно попадают в кеш по id
+            started = time.monotonic()
+            try:
+                search_result, pit_id = await self._search_point_in_time(query, position.get('pit'))
+            except elasticsearch.exceptions.NotFoundError:
+                if not position.get('pit'):
+                    raise
+                # Point-in-time из курсора истёк или закрыт: страница продолжается с той же позиции в новом
+                logger.debug('point-in-time from cursor expired, reopening')
+                search_result, pit_id = await self._search_point_in_time(query, None)
+            result = await self._store_hits(search_result, time.monotonic() - started)
+        else:
+            result = await self._get_cached_ids(self.cache.query_key(query), query)
+
+        next_cursor = None
+        if len(result.ids) == page_size and result.last_sort:
+            next_cursor = encode_cursor(query_id, result.last_sort, pit_id)
+        elif pit_id:
+            await self.elastic.close_point_in_time(body={'id': pit_id})
+        return await self.get_many(result.ids), next_cursor
+
+    async def _iterate(self, search: Search, batch_size: int) -> AsyncIterator[List]:
+        # Обход всего индекса пачками через point-in-time и search_after, в обход кеша.
+        # Следующая пачка запрашивается только после того, как потребитель забрал предыдущую.
+        if self.source:
+            search = search.source(self.source)
+        query = search.extra(size=batch_size).to_dict()
+        query['sort'] = [{'id': {'order': 'asc'}}]
+        pit_id = await self._open_point_in_time()
         try:
-            res = await self.elastic.mget(body={'ids': ids}, index=self.index)
+            while True:
+                query['pit'] = {'id': pit_id, 'keep_alive': ES_PIT_KEEP_ALIVE}
+                search_result = await self.elastic.search(body=query, request_timeout=ES_TIMEOUT)
+                pit_id = search_result.get('pit_id', pit_id)
+                hits = search_result['hits']['hits']
+                if hits:
+                    yield [self._build_model(hit['_source']) for hit in hits]
+                if len(hits) < batch_size:
+                    break
+                query['search_after'] = hits[-1]['sort']
+        finally:
+            await self.elastic.close_point_in_time(body={'id': pit_id})
+
+    async def _search_point_in_time(self, query: dict, pit_id: Optional[str]) -> Tuple[Dict[str, Any], str]:
+        pit_id = pit_id or await self._open_point_in_time()
+        query['pit'] = {'id': pit_id, 'keep_alive': ES_PIT_KEEP_ALIVE}
+        search_result = await self.elastic.search(body=query)
+        return search_result, search_result.get('pit_id', pit_id)
+
+    async def _open_point_in_time(self) -> str:
+        response = await self.elastic.open_point_in_time(index=self.index, keep_alive=ES_PIT_KEEP_ALIVE)
+        return response['id']
+
+    async def get_many(self, ids: List[str]) -> List:
+        ids = list(dict.fromkeys(ids))
+        entries = await self.cache.get_many_entries_by_id(ids)
+        instances = {instance_id: entry.value for instance_id, entry in entries.items() if not entry.is_expired}
+
+        missing = [instance_id for instance_id in ids if instance_id not in instances]
+        if missing:
+            try:
+                instances.update(await self._load_many_and_store(missing))
+            except ElasticUnavailable:
+                expired = {instance_id: entries[instance_id].value for instance_id in missing if instance_id in entries}
+                if not expired and not instances:
+                    raise
+                CACHE_FALLBACKS.inc(self.cache.name, amount=len(expired))
+                instances.update(expired)
+
+        stale = [instance_id for instance_id, entry in entries.items() if entry.is_stale and not entry.is_expired]
+        if stale:
+            run_in_background(self._load_many_and_store(stale))
+
+        return [instances[instance_id] for instance_id in ids if instance_id in instances]
+
+    async def _load_many_and_store(self, ids: List[str]) -> Dict[str, Any]:
+        started = time.monotonic()
+        instances = await self._get_many_from_elastic(ids)
+        await self.cache.set_many_by_id(instances, time.monotonic() - started)
+        return instances
+
+    async def _get_many_from_elastic(self, ids: List[str]) -> Dict[str, Any]:
+        try:
+            res = await self.elastic.mget(body={'ids': ids}, index=self.index, params=self._source_params())
         except elasticsearch.exceptions.NotFoundError:
-            return []
-        return [self.model(**doc['_source']) for doc in res['docs']]
+            return {}
+        return {doc['_id']: self._build_model(doc['_source']) for doc in res['docs'] if doc.get('found')}
 
     @staticmethod
     def _get_paginated_query(search: Search, page_number: int, page_size: int) -> dict:
         start = (page_number - 1) * page_size
         return search[start: start + page_size].to_dict()
+
+    async def _get_cached(self, key: str, get_entry: EntryGetter, load: Loader, store: Storer):
+        entry = await get_entry()
+        if entry is not None and not entry.is_expired:
+            if entry.is_stale or (CACHE_EARLY_REFRESH_BETA and entry.should_refresh(CACHE_EARLY_REFRESH_BETA)):
+                self._refresh_in_background(key, load, store)
+            return entry.value
+        flight_key = self.cache.get_full_path(key)
+        try:
+            return await single_flight.do(flight_key, lambda: self._load_and_store(key, load, store, get_entry))
+        except ElasticUnavailable:
+            if entry is None:
+                raise
+            # Пока Elasticsearch недоступен, устаревшая запись лучше ошибки
+            CACHE_FALLBACKS.inc(self.cache.name)
+            return entry.value
+
+    async def _load_and_store(self, key: str, load: Loader, store: Storer,
+                              get_entry: Optional[EntryGetter] = None):
+        token = None
+        if CACHE_LOCK_ENABLED:
+            token = await self.cache.acquire_lock(key, CACHE_LOCK_TIMEOUT)
+            if token is None:
+                # Значение уже вычисляет другой воркер: ждём его, а не идём в Elasticsearch
+                if get_entry is None:
+                    return None
+                entry = await self._wait_for_entry(get_entry)
+                if entry is not None:
+                    return entry.value
+        try:
+            started = time.monotonic()
+            value = await load()
+            if value is not None:
+                await store(value, time.monotonic() - started)
+            return value
+        finally:
+            if token is not None:
+                await self.cache.release_lock(key, token)
+
+    @staticmethod
+    async def _wait_for_entry(get_entry: EntryGetter) -> Optional[CacheEntry]:
+        deadline = time.monotonic() + CACHE_LOCK_WAIT
+        while time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+            entry = await get_entry()
+            if entry is not None and not entry.is_expired:
+                return entry
+        return None
+
+    def _refresh_in_background(self, key: str, load: Loader, store: Storer) -> None:
+        flight_key = self.cache.get_full_path(key)
+        if single_flight.in_flight(flight_key):
+            return
+        refresh = single_flight.do(flight_key, lambda: self._load_and_store(key, load, store))
+        refresh.add_done_callback(_log_background_error)
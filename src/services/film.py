@@ -1,60 +1,140 @@
-import asyncio
 import logging
+from collections import Counter
 from functools import cache
-from typing import Optional, List
+from typing import Any, AsyncIterator, Dict, NamedTuple, Optional, List, Tuple, Type
 
 from aioredis import Redis
 from elasticsearch import AsyncElasticsearch
 from elasticsearch_dsl import Search, Q
 from fastapi import Depends
 
-from config import CACHE_TTL
+from config import CACHE_TTL, ES_TIMEOUT, EXPORT_BATCH_SIZE, FACET_GENRES_SIZE, FACET_RATING_INTERVAL
 from db.cache import ModelCache
 from db.elastic import get_elastic
-from db.models import Film
+from db.models import FacetedPage, Film, FilmShort, FilmTitle
 from db.redis import get_redis
 from services.base import BaseESService
 
 logger = logging.getLogger(__name__)
 
 
+class FilmFilter(NamedTuple):
+    genre: Optional[str] = None
+    # Фильмы, в которых персона участвовала в любой роли
+    person: Optional[str] = None
+    rating_gte: Optional[float] = None
+    rating_lte: Optional[float] = None
+
+
+# Роли персоны в фильме: nested-поля индекса movies
+PERSON_ROLES = ('actors', 'writers', 'directors')
+
+
 class FilmService(BaseESService):
     model = Film
     index = 'movies'
+    suggest_field = 'title'
+    suggest_model = FilmTitle
+
+    @classmethod
+    def cached_models(cls) -> List[Type]:
+        return [Film, FilmShort]
+
+    def _build_suggest(self, prefix: str) -> Search:
+        # При равной релевантности выше фильмы с большим рейтингом
+        return super()._build_suggest(prefix).sort('_score', {'imdb_rating': {'order': 'desc'}})
 
     async def search(self, search_query: str = "",
-                     filter_genre: Optional[str] = None,
+                     filters: FilmFilter = FilmFilter(),
                      sort: Optional[str] = None,
                      page_number: int = 1,
-                     page_size: int = 50) -> List[Film]:
+                     page_size: int = 50) -> List[FilmShort]:
+        s = self._build_search(search_query, filters, sort)
+        return await self.with_projection(FilmShort)._search(s, page_number, page_size)
 
+    async def search_faceted(self, search_query: str = "",
+                             filters: FilmFilter = FilmFilter(),
+                             sort: Optional[str] = None,
+                             page_number: int = 1,
+                             page_size: int = 50) -> FacetedPage:
+        # Агрегации считаются в том же запросе, что и страница, и кешируются вместе с ней
+        s = self._build_search(search_query, filters, sort).extra(track_total_hits=True)
+        s.aggs.bucket('genres', 'nested', path='genres').bucket('ids', 'terms', field='genres.id',
+                                                                size=FACET_GENRES_SIZE)
+        s.aggs.bucket('imdb_rating', 'histogram', field='imdb_rating', interval=FACET_RATING_INTERVAL,
+                      min_doc_count=1)
+        items, result = await self.with_projection(FilmShort)._search_page(s, page_number, page_size)
+        return FacetedPage(items, result.total, result.facets or {'genres': [], 'imdb_rating': []})
+
+    def _facets(self, aggregations: Dict[str, Any]) -> Dict[str, Any]:
+        return {
+            'genres': [[bucket['key'], bucket['doc_count']] for bucket in aggregations['genres']['ids']['buckets']],
+            'imdb_rating': [[bucket['key'], bucket['doc_count']] for bucket in aggregations['imdb_rating']['buckets']],
+        }
+
+    async def search_after(self, search_query: str = "",
+                           filters: FilmFilter = FilmFilter(),
+                           sort: Optional[str] = None,
+                           cursor: str = "",
+                           page_size: int = 50) -> Tuple[List[FilmShort], Optional[str]]:
+        s = self._build_search(search_query, filters, sort)
+        return await self.with_projection(FilmShort)._search_after(s, cursor, page_size)
+
+    def export(self, model: Type = FilmShort) -> AsyncIterator[List]:
         s = Search(using=self.elastic, index=self.index)
+        return self.with_projection(model)._iterate(s, EXPORT_BATCH_SIZE)
+
+    def warm_top_rated(self, limit: int, batch_size: int) -> AsyncIterator[int]:
+        s = Search(using=self.elastic, index=self.index).sort({'imdb_rating': {'order': 'desc'}})
+        return self.warm_cache(s, limit, batch_size)
+
+    async def popular_person_ids(self, limit: int) -> List[str]:
+        # Персоны, которые встречаются в наибольшем числе фильмов во всех ролях, одним запросом агрегаций
+        s = Search(using=self.elastic, index=self.index).extra(size=0)
+        for role in PERSON_ROLES:
+            s.aggs.bucket(role, 'nested', path=role).bucket('ids', 'terms', field=f'{role}.id', size=limit)
+        search_result = await self.elastic.search(index=self.index, body=s.to_dict(), request_timeout=ES_TIMEOUT)
+        counts = Counter()
+        for role in PERSON_ROLES:
+            for bucket in search_result['aggregations'][role]['ids']['buckets']:
+                counts[bucket['key']] += bucket['doc_count']
+        return [person_id for person_id, _ in counts.most_common(limit)]
+
+    async def search_by_ids(self, film_ids: List[str],
+                            sort: Optional[str] = None,
+                            page_number: int = 1,
+                            page_size: int = 50) -> List[FilmShort]:
+        # Один terms-запрос вместо mget по всем фильмам: страница, сортировка и кеш на уровне запроса
+        s = Search(using=self.elastic, index=self.index).filter('terms', id=film_ids)
+        if sort:
+            s = s.sort(sort)
+        return await self.with_projection(FilmShort)._search(s, page_number, page_size)
+
+    def _build_search(self, search_query: str, filters: FilmFilter, sort: Optional[str]) -> Search:
+        s = Search(using=self.elastic, index=self.index)
+        # Фильтры - в контексте filter: они не влияют на релевантность, не считают score
+        # и их битсеты кешируются на шардах между запросами
+        clauses = []
+        if filters.genre:
+            clauses.append(Q('nested', path='genres', query=Q('term', genres__id=filters.genre)))
+        if filters.person:
+            clauses.append(Q('bool', minimum_should_match=1, should=[
+                Q('nested', path=role, query=Q('term', **{f'{role}__id': filters.person})) for role in PERSON_ROLES]))
+        if filters.rating_gte is not None or filters.rating_lte is not None:
+            bounds = {'gte': filters.rating_gte, 'lte': filters.rating_lte}
+            clauses.append(Q('range', imdb_rating={op: value for op, value in bounds.items() if value is not None}))
+
         if search_query:
             multi_match_fields = ["title^4", "description^3", "genres_names^2", "actors_names^4", "writers_names",
                                   "directors_names^3"]
-            s = s.query('multi_match', query=search_query, fields=multi_match_fields)
-        if filter_genre:
-            s = s.query('nested', path='genres', query=Q('bool', filter=Q('term', genres__id=filter_genre)))
+            s = s.query('bool', must=Q('multi_match', query=search_query, fields=multi_match_fields),
+                        filter=clauses)
+        elif clauses:
+            # Без текста релевантность не нужна: constant_score не считает score совсем
+            s = s.query('constant_score', filter=Q('bool', filter=clauses))
         if sort:
             s = s.sort(sort)
-        return await self._search(s, page_number, page_size)
-
-    async def get_list(self, film_ids: List[str]) -> List[Film]:
-        # noinspection PyTypeChecker
-        films: List[Optional[Film]] = await asyncio.gather(*[self.cache.get_by_id(film_id) for film_id in film_ids])
-
-        films = [film for film in films if film is not None]
-        film_id_mapping = {film.id: film for film in films}
-        not_cached_ids = [film_id for film_id in film_ids if film_id not in film_id_mapping]
-
-        not_cached_films: List[Film] = await self._get_list_from_elastic(not_cached_ids)
-        if not_cached_films:
-            await asyncio.gather(*[self.cache.set_by_id(film.id, film) for film in not_cached_films])
-        films.extend(not_cached_films)
-        if not films:
-            return []
-
-        return films
+        return s
 
 
 @cache
@@ -1,15 +1,113 @@
-from typing import List, Optional
+import asyncio
+import logging
+from types import MappingProxyType
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
 
+import orjson
 from aioredis import Redis
 from elasticsearch_dsl.search import Search
 from fastapi import Depends
 
-from config import CACHE_TTL
+from config import CACHE_TTL, ES_TIMEOUT, ES_TRUSTED_CONSTRUCT, EXPORT_BATCH_SIZE, GENRE_TOP_FILMS
 from db.cache import ModelCache
 from db.elastic import AsyncElasticsearch, get_elastic
 from db.redis import get_redis
-from db.models import Genre
-from services.base import BaseESService
+from db.models import Genre, construct
+from services.base import BaseESService, run_in_background
+
+logger = logging.getLogger(__name__)
+
+# Порядки, в которых можно запросить список жанров
+GENRE_SORTS = ('id', '-id', 'name', '-name')
+# Сколько готовых тел ответов хранит снимок каталога
+RENDERED_PAGES_MAX = 1024
+# Имя перезагрузки каталога в канале L1 (db.cache.publish_reload)
+CATALOGUE_RELOAD = 'GenreCatalogue'
+
+
+def _top_films(genre: Genre) -> Genre:
+    if not GENRE_TOP_FILMS or len(genre.filmworks) <= GENRE_TOP_FILMS:
+        return genre
+    # Фильмы без рейтинга - в конце
+    ranked = sorted(genre.filmworks, key=lambda film: (film.imdb_rating is None, -(film.imdb_rating or 0)))
+    return genre.copy(update={'filmworks': ranked[:GENRE_TOP_FILMS]})
+
+
+def _build_genre(source: Dict[str, Any]) -> Genre:
+    # Единственное место, где жанр собирается из документа Elasticsearch: каталог, запросы
+    # в обход каталога и кеш получают один и тот же список фильмов
+    return _top_films(construct(Genre, source) if ES_TRUSTED_CONSTRUCT else Genre(**source))
+
+
+async def load_genres(elastic: AsyncElasticsearch) -> List[Genre]:
+    # Жанров немного: весь индекс читается пачками по id, без point-in-time
+    genres = []
+    query = {'size': EXPORT_BATCH_SIZE, 'sort': [{'id': {'order': 'asc'}}]}
+    while True:
+        search_result = await elastic.search(index=GenreService.index, body=query, request_timeout=ES_TIMEOUT)
+        hits = search_result['hits']['hits']
+        genres.extend(_build_genre(hit['_source']) for hit in hits)
+        if len(hits) < EXPORT_BATCH_SIZE:
+            return genres
+        query['search_after'] = hits[-1]['sort']
+
+
+class GenreCatalogue:
+    # Неизменяемый снимок всех жанров в памяти воркера. Обновление не меняет снимок, а подменяет его целиком,
+    # поэтому запросы читают его без блокировок
+    def __init__(self, genres: Iterable[Genre]) -> None:
+        self.genres: Tuple[Genre, ...] = tuple(genres)
+        self._by_id = MappingProxyType({genre.id: genre for genre in self.genres})
+        self._sorted: Dict[str, Tuple[Genre, ...]] = {'': self.genres}
+        for sort in GENRE_SORTS:
+            field = sort.lstrip('-')
+            self._sorted[sort] = tuple(
+                sorted(self.genres, key=lambda genre: getattr(genre, field), reverse=sort.startswith('-')))
+        self._rendered: Dict[Tuple[str, int, int], bytes] = {}
+
+    def __contains__(self, genre_id: str) -> bool:
+        return genre_id in self._by_id
+
+    def __len__(self) -> int:
+        return len(self.genres)
+
+    def get(self, genre_id: str) -> Optional[Genre]:
+        return self._by_id.get(genre_id)
+
+    def get_many(self, ids: List[str]) -> List[Genre]:
+        return [self._by_id[genre_id] for genre_id in dict.fromkeys(ids) if genre_id in self._by_id]
+
+    def page(self, sort: Optional[str], page_number: int, page_size: int) -> List[Genre]:
+        start = (page_number - 1) * page_size
+        return list(self._sorted[sort or ''][start:start + page_size])
+
+    def render_page(self, sort: Optional[str], page_number: int, page_size: int,
+                    serialize: Callable[[Genre], Any]) -> Optional[bytes]:
+        # Снимок не меняется, поэтому каждая страница сериализуется один раз
+        key = (sort or '', page_number, page_size)
+        body = self._rendered.get(key)
+        if body is None:
+            genres = self.page(sort, page_number, page_size)
+            if not genres:
+                return None
+            body = orjson.dumps([serialize(genre) for genre in genres])
+            if len(self._rendered) < RENDERED_PAGES_MAX:
+                self._rendered[key] = body
+        return body
+
+
+# Текущий снимок; None - ещё не загружен, тогда жанры читаются из Elasticsearch
+catalogue: Optional[GenreCatalogue] = None
+
+
+def genre_name(genre_id: str) -> Optional[str]:
+    genre = catalogue.get(genre_id) if catalogue is not None else None
+    return genre.name if genre is not None else None
+
+
+def genre_exists(genre_id: str) -> bool:
+    # Без загруженного каталога проверить нельзя: считаем, что жанр есть, и решает Elasticsearch
+    return catalogue is None or genre_id in catalogue
 
 
 class GenreService(BaseESService):
@@ -19,6 +117,9 @@ class GenreService(BaseESService):
     def __init__(self, cache: ModelCache[Genre], elastic: AsyncElasticsearch):
         super().__init__(cache, elastic)
 
+    def _build_model(self, source: Dict[str, Any]) -> Genre:
+        return _build_genre(source)
+
     async def search(
         self,
         search_query: str = "",
@@ -26,13 +127,55 @@ class GenreService(BaseESService):
         page_number: int = 1,
         page_size: int = 50
     ) -> List[Genre]:
+        if catalogue is not None and not search_query:
+            return catalogue.page(sort, page_number, page_size)
         s = Search(using=self.elastic, index=self.index)
         if search_query:
-            s.query('match', full_name=search_query)
+            s = s.query('match', name=search_query)
         if sort:
-            s.sort(sort)
+            # name - текстовое поле, сортировать можно только по keyword-подполю
+            s = s.sort(sort.replace('name', 'name.raw'))
         return await self._search(s, page_number, page_size)
 
+    async def render_page(self, sort: Optional[str], page_number: int, page_size: int,
+                          serialize: Callable[[Genre], Any]) -> Optional[bytes]:
+        # Готовое тело ответа со страницей жанров; None - страница пуста
+        snapshot = catalogue
+        if snapshot is not None:
+            return snapshot.render_page(sort, page_number, page_size, serialize)
+        genres = await self.search(sort=sort, page_number=page_number, page_size=page_size)
+        return orjson.dumps([serialize(genre) for genre in genres]) if genres else None
+
+    async def get_by_id(self, instance_id: str) -> Optional[Genre]:
+        if catalogue is not None:
+            return catalogue.get(instance_id)
+        return await super().get_by_id(instance_id)
+
+    async def get_many(self, ids: List[str]) -> List[Genre]:
+        if catalogue is not None:
+            return catalogue.get_many(ids)
+        return await super().get_many(ids)
+
+
+async def refresh_catalogue(elastic: AsyncElasticsearch) -> None:
+    global catalogue
+    catalogue = GenreCatalogue(await load_genres(elastic))
+    logger.info('genre catalogue loaded: %d genres', len(catalogue))
+
+
+def request_catalogue_refresh(elastic: AsyncElasticsearch) -> None:
+    run_in_background(refresh_catalogue(elastic))
+
+
+async def refresh_catalogue_periodically(elastic: AsyncElasticsearch, interval: float) -> None:
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await refresh_catalogue(elastic)
+        except Exception:
+            # Остаётся предыдущий снимок
+            logger.warning('genre catalogue refresh failed', exc_info=True)
+
 
 def get_genre_service(
     redis: Redis = Depends(get_redis),
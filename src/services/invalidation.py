@@ -0,0 +1,178 @@
+import asyncio
+import logging
+import time
+from collections import defaultdict
+from typing import Dict, Iterable, List, Tuple
+
+import aioredis
+from aioredis import Redis
+
+from config import (CACHE_INVALIDATION_CLAIM_IDLE, CACHE_INVALIDATION_GROUP, CACHE_INVALIDATION_STREAM, CACHE_TTL,
+                    REDIS_RETRY_DELAY, REDIS_RETRY_DELAY_MAX)
+from db.cache import WORKER_ID, ModelCache, ResponseCache, publish_reload
+from db.redis import create_connection
+from services.film import FilmService
+from services.genre import CATALOGUE_RELOAD, GenreService
+from services.person import PersonService
+
+logger = logging.getLogger(__name__)
+
+SERVICES = (FilmService, PersonService, GenreService)
+
+# Ограничение длины stream, чтобы он не рос бесконечно
+STREAM_MAX_LEN = 100000
+# Живой консьюмер читает stream каждые несколько секунд: простаивающий дольше - от упавшего воркера
+DEAD_CONSUMER_IDLE = 600
+
+# Префиксы API-путей, ответы на которых собраны из документов индекса (см. роутеры в main.py)
+RESPONSE_PATHS = {
+    FilmService.index: '/v1/film/',
+    PersonService.index: '/v1/person/',
+    GenreService.index: '/v1/genre/',
+}
+
+
+async def publish_changes(redis: Redis, index: str, ids: Iterable[str]) -> None:
+    await redis.xadd(CACHE_INVALIDATION_STREAM, {'index': index, 'ids': ','.join(ids)}, max_len=STREAM_MAX_LEN)
+
+
+async def invalidate(redis: Redis, index: str, ids: List[str]) -> None:
+    for service in SERVICES:
+        if service.index != index:
+            continue
+        for model in service.cached_models():
+            await ModelCache(redis, model, CACHE_TTL).invalidate_ids(ids)
+    await ResponseCache(redis, CACHE_TTL).invalidate_ids(ids)
+    if index == GenreService.index:
+        # Каталог жанров в памяти перезагружают все воркеры, включая этот
+        await publish_reload(redis, CATALOGUE_RELOAD)
+    logger.info('invalidated %d %s documents', len(ids), index)
+
+
+async def invalidate_queries(redis: Redis, index: str) -> int:
+    count = 0
+    for service in SERVICES:
+        if service.index != index:
+            continue
+        for model in service.cached_models():
+            count += await ModelCache(redis, model, CACHE_TTL).invalidate_queries()
+    # Готовые ответы на списки и поиск тоже устарели, иначе они отдаются со старым ETag до конца TTL
+    if index in RESPONSE_PATHS:
+        count += await ResponseCache(redis, CACHE_TTL).invalidate_prefix(RESPONSE_PATHS[index])
+    logger.info('invalidated %d %s query pages and responses', count, index)
+    return count
+
+
+async def _create_group(redis: Redis) -> None:
+    try:
+        await redis.xgroup_create(CACHE_INVALIDATION_STREAM, CACHE_INVALIDATION_GROUP, latest_id='$', mkstream=True)
+    except aioredis.ReplyError as exc:
+        if 'BUSYGROUP' not in str(exc):
+            raise
+
+
+def _parse(fields: Dict[bytes, bytes]) -> Tuple[str, List[str]]:
+    ids = fields.get(b'ids', b'').decode()
+    return fields.get(b'index', b'').decode(), list(filter(None, ids.split(',')))
+
+
+async def process_changes(redis: Redis, messages: List[Tuple[bytes, Dict[bytes, bytes]]]) -> List[bytes]:
+    # Возвращает идентификаторы обработанных событий: события индекса, который не удалось
+    # инвалидировать, остаются неподтверждёнными и будут обработаны повторно
+    changes: Dict[str, Tuple[List[str], List[bytes]]] = defaultdict(lambda: ([], []))
+    for message_id, fields in messages:
+        index, ids = _parse(fields)
+        changes[index][0].extend(ids)
+        changes[index][1].append(message_id)
+    processed = []
+    for index, (ids, message_ids) in changes.items():
+        if ids:
+            try:
+                await invalidate(redis, index, ids)
+            except aioredis.RedisError:
+                logger.exception('failed to invalidate %s documents', index)
+                continue
+        processed.extend(message_ids)
+    return processed
+
+
+async def _claim_pending(conn: Redis) -> List[Tuple[bytes, Dict[bytes, bytes]]]:
+    # События, которые другой воркер (или этот до перезапуска) получил, но так и не подтвердил
+    idle = int(CACHE_INVALIDATION_CLAIM_IDLE * 1000)
+    pending = await conn.xpending(CACHE_INVALIDATION_STREAM, CACHE_INVALIDATION_GROUP, '-', '+', 100)
+    message_ids = [message_id for message_id, _, idle_time, _ in pending if idle_time >= idle]
+    if not message_ids:
+        return []
+    messages = await conn.xclaim(CACHE_INVALIDATION_STREAM, CACHE_INVALIDATION_GROUP, WORKER_ID, idle, *message_ids)
+    # Событий, вытесненных из stream по STREAM_MAX_LEN, уже нет: обработать их нельзя, только подтвердить
+    trimmed = set(message_ids) - {message_id for message_id, _ in messages}
+    if trimmed:
+        await conn.xack(CACHE_INVALIDATION_STREAM, CACHE_INVALIDATION_GROUP, *trimmed)
+    return messages
+
+
+async def _remove_dead_consumers(conn: Redis) -> None:
+    # WORKER_ID у каждого процесса свой, поэтому консьюмеры воркеров, упавших без остановки, сами не исчезнут.
+    # Удаляются только те, за кем не осталось событий: их события к этому времени уже забраны XCLAIM
+    idle = DEAD_CONSUMER_IDLE * 1000
+    for consumer in await conn.xinfo_consumers(CACHE_INVALIDATION_STREAM, CACHE_INVALIDATION_GROUP):
+        name = consumer[b'name'].decode()
+        if name != WORKER_ID and not consumer[b'pending'] and consumer[b'idle'] >= idle:
+            await conn.xgroup_delconsumer(CACHE_INVALIDATION_STREAM, CACHE_INVALIDATION_GROUP, name)
+
+
+async def leave_group(redis: Redis) -> None:
+    # При остановке воркер удаляет своего консьюмера из группы, если за ним нет неподтверждённых событий:
+    # после перезапуска у процесса будет другой WORKER_ID. Неподтверждённые заберёт другой воркер
+    try:
+        pending = await redis.xpending(CACHE_INVALIDATION_STREAM, CACHE_INVALIDATION_GROUP, '-', '+', 1, WORKER_ID)
+        if not pending:
+            await redis.xgroup_delconsumer(CACHE_INVALIDATION_STREAM, CACHE_INVALIDATION_GROUP, WORKER_ID)
+    except (aioredis.RedisError, OSError):
+        logger.warning('failed to leave cache invalidation group', exc_info=True)
+
+
+async def _read_changes(conn: Redis) -> List[Tuple[bytes, Dict[bytes, bytes]]]:
+    messages = await conn.xread_group(CACHE_INVALIDATION_GROUP, WORKER_ID, [CACHE_INVALIDATION_STREAM],
+                                      timeout=5000, count=100, latest_ids=['>'])
+    return [(message_id, fields) for _, message_id, fields in messages]
+
+
+async def consume_changes(redis: Redis) -> None:
+    # Воркеры читают stream одной группой: каждое событие обрабатывает один из них,
+    # а L1-копии у остальных сбрасываются через pub/sub.
+    # Чтение блокирующее, поэтому идёт через своё соединение; инвалидация - через общий пул
+    conn = None
+    delay = REDIS_RETRY_DELAY
+    next_claim = 0.0
+    try:
+        while True:
+            try:
+                if conn is None or conn.closed:
+                    conn = await create_connection()
+                    await _create_group(conn)
+                messages = []
+                if time.monotonic() >= next_claim:
+                    messages = await _claim_pending(conn)
+                    await _remove_dead_consumers(conn)
+                    next_claim = time.monotonic() + CACHE_INVALIDATION_CLAIM_IDLE / 2
+                if not messages:
+                    messages = await _read_changes(conn)
+                if messages:
+                    processed = await process_changes(redis, messages)
+                    if processed:
+                        await conn.xack(CACHE_INVALIDATION_STREAM, CACHE_INVALIDATION_GROUP, *processed)
+                delay = REDIS_RETRY_DELAY
+            except (aioredis.RedisError, OSError, asyncio.TimeoutError):
+                logger.warning('cache invalidation consumer failed, retrying in %.0fs', delay, exc_info=True)
+                # Соединение открывается заново, а группа создаётся заново, если stream удалили
+                if conn is not None:
+                    conn.close()
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, REDIS_RETRY_DELAY_MAX)
+    finally:
+        # Через общий пул: на своём соединении может ещё ждать ответа блокирующий XREADGROUP
+        if conn is not None:
+            await leave_group(redis)
+            conn.close()
+            await conn.wait_closed()
@@ -1,6 +1,6 @@
 import logging
 from functools import cache
-from typing import Optional, List
+from typing import Optional, List, Tuple
 
 from aioredis import Redis
 from elasticsearch import AsyncElasticsearch
@@ -11,7 +11,7 @@ from config import CACHE_TTL
 from db.cache import ModelCache
 from db.elastic import get_elastic
 from db.redis import get_redis
-from db.models import Person
+from db.models import Person, PersonName
 from services.base import BaseESService
 
 logger = logging.getLogger(__name__)
@@ -20,19 +20,31 @@ logger = logging.getLogger(__name__)
 class PersonService(BaseESService):
     model = Person
     index = 'persons'
+    suggest_field = 'full_name'
+    suggest_model = PersonName
 
     async def search(self, search_query: str = "",
                      filter_genre: Optional[str] = None,
                      sort: Optional[str] = None,
                      page_number: int = 1,
                      page_size: int = 50) -> List[Person]:
+        s = self._build_search(search_query, sort)
+        return await self._search(s, page_number, page_size)
+
+    async def search_after(self, search_query: str = "",
+                           sort: Optional[str] = None,
+                           cursor: str = "",
+                           page_size: int = 50) -> Tuple[List[Person], Optional[str]]:
+        s = self._build_search(search_query, sort)
+        return await self._search_after(s, cursor, page_size)
 
+    def _build_search(self, search_query: str, sort: Optional[str]) -> Search:
         s = Search(using=self.elastic, index=self.index)
         if search_query:
             s = s.query('match', full_name=search_query)
         if sort:
             s = s.sort(sort)
-        return await self._search(s, page_number, page_size)
+        return s
 
 
 @cache
@@ -0,0 +1,183 @@
+import argparse
+import asyncio
+import logging
+import time
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from aioredis import Redis
+from elasticsearch import AsyncElasticsearch
+
+from config import (CACHE_NAMESPACE, CACHE_PREWARM_BATCH_SIZE, CACHE_PREWARM_FILMS, CACHE_PREWARM_INTERVAL,
+                    CACHE_PREWARM_PAGES, CACHE_PREWARM_PERSONS, CACHE_PREWARM_QUERIES, CACHE_PREWARM_RATE,
+                    CACHE_STATS_FLUSH_INTERVAL)
+from db import elastic as elastic_db, redis as redis_db
+from db.cache import Cache
+from db.models import FilmShort, Genre
+from services.film import FilmFilter, get_film_service
+from services.genre import get_genre_service, load_genres
+from services.person import get_person_service
+
+logger = logging.getLogger(__name__)
+
+PREWARM_LOCK = 'prewarm'
+TARGETS = ('genres', 'films', 'persons', 'queries', 'hot')
+
+
+class RateLimiter:
+    # Равномерно распределяет запросы: не больше rate в секунду, без всплесков
+    def __init__(self, rate: float) -> None:
+        self._interval = 1 / rate if rate > 0 else 0.0
+        self._next = 0.0
+
+    async def wait(self) -> None:
+        now = time.monotonic()
+        if self._next > now:
+            await asyncio.sleep(self._next - now)
+        self._next = max(self._next, now) + self._interval
+
+
+class Progress:
+    def __init__(self, target: str, total: int) -> None:
+        self.target = target
+        self.total = total
+        self.done = 0
+        self._started = time.monotonic()
+
+    def advance(self, count: int = 1) -> None:
+        self.done += count
+        logger.info('warmup %s: %d/%d, %.1fs', self.target, self.done, self.total, time.monotonic() - self._started)
+
+
+async def warm_genres(redis: Redis, elastic: AsyncElasticsearch, limiter: RateLimiter) -> List[Genre]:
+    # Из индекса, а не из каталога воркера: в кеш попадают те же документы, что и при промахе
+    await limiter.wait()
+    genres = await load_genres(elastic)
+    await get_genre_service(redis, elastic).cache.set_many_by_id({item.id: item for item in genres})
+    Progress('genres', len(genres)).advance(len(genres))
+    return genres
+
+
+async def warm_films(redis: Redis, elastic: AsyncElasticsearch, limiter: RateLimiter) -> int:
+    progress = Progress('films', CACHE_PREWARM_FILMS)
+    async for count in get_film_service(redis, elastic).warm_top_rated(CACHE_PREWARM_FILMS, CACHE_PREWARM_BATCH_SIZE):
+        progress.advance(count)
+        await limiter.wait()
+    return progress.done
+
+
+async def warm_persons(redis: Redis, elastic: AsyncElasticsearch, limiter: RateLimiter) -> int:
+    await limiter.wait()
+    ids = await get_film_service(redis, elastic).popular_person_ids(CACHE_PREWARM_PERSONS)
+    person_service = get_person_service(redis, elastic)
+    progress = Progress('persons', len(ids))
+    for start in range(0, len(ids), CACHE_PREWARM_BATCH_SIZE):
+        await limiter.wait()
+        # Уже закешированные персоны не перечитываются, остальные - одним mget на пачку
+        await person_service.get_many(ids[start:start + CACHE_PREWARM_BATCH_SIZE])
+        progress.advance(min(CACHE_PREWARM_BATCH_SIZE, len(ids) - start))
+    return progress.done
+
+
+async def warm_hot(redis: Redis, elastic: AsyncElasticsearch, limiter: RateLimiter) -> int:
+    # Документы, к которым чаще всего обращались за последнее окно статистики на всех воркерах.
+    # Страницы поиска так не прогреть: в статистике только хеши их запросов
+    film_service = get_film_service(redis, elastic)
+    services = [
+        (film_service, CACHE_PREWARM_FILMS),
+        (film_service.with_projection(FilmShort), CACHE_PREWARM_FILMS),
+        (get_person_service(redis, elastic), CACHE_PREWARM_PERSONS),
+    ]
+    progress = Progress('hot', 0)
+    for service, limit in services:
+        ids = await service.cache.get_hot_ids(CACHE_STATS_FLUSH_INTERVAL, limit)
+        progress.total += len(ids)
+        for start in range(0, len(ids), CACHE_PREWARM_BATCH_SIZE):
+            await limiter.wait()
+            await service.get_many(ids[start:start + CACHE_PREWARM_BATCH_SIZE])
+            progress.advance(min(CACHE_PREWARM_BATCH_SIZE, len(ids) - start))
+    return progress.done
+
+
+def common_queries(genres: Iterable[Genre]) -> List[Tuple[str, FilmFilter, Optional[str]]]:
+    # Параметры film_service.search, как их передаёт API: каталог по рейтингу, каталог каждого жанра
+    # и полнотекстовые поиски из настроек
+    return [
+        ('', FilmFilter(), '-imdb_rating'),
+        *(('', FilmFilter(genre=item.id), '-imdb_rating') for item in genres),
+        *((query, FilmFilter(), None) for query in CACHE_PREWARM_QUERIES),
+    ]
+
+
+async def warm_queries(redis: Redis, elastic: AsyncElasticsearch, limiter: RateLimiter,
+                       genres: Iterable[Genre]) -> int:
+    film_service = get_film_service(redis, elastic)
+    queries = common_queries(genres)
+    progress = Progress('queries', len(queries))
+    for search_query, filters, sort in queries:
+        for page_number in range(1, CACHE_PREWARM_PAGES + 1):
+            await limiter.wait()
+            films = await film_service.search(search_query=search_query, filters=filters, sort=sort,
+                                              page_number=page_number)
+            if not films:
+                break
+        progress.advance()
+    return progress.done
+
+
+async def warm_caches(redis: Redis, elastic: AsyncElasticsearch, targets: Iterable[str] = TARGETS) -> Dict[str, int]:
+    started = time.monotonic()
+    limiter = RateLimiter(CACHE_PREWARM_RATE)
+    targets = set(targets)
+    counts = {}
+    genres: List[Genre] = []
+    if 'genres' in targets:
+        genres = await warm_genres(redis, elastic, limiter)
+        counts['genres'] = len(genres)
+    elif 'queries' in targets:
+        # Для страниц фильмов по жанрам нужен только список жанров, без записи в кеш
+        await limiter.wait()
+        genres = await load_genres(elastic)
+    if 'films' in targets:
+        counts['films'] = await warm_films(redis, elastic, limiter)
+    if 'persons' in targets:
+        counts['persons'] = await warm_persons(redis, elastic, limiter)
+    if 'queries' in targets:
+        counts['queries'] = await warm_queries(redis, elastic, limiter, genres)
+    if 'hot' in targets:
+        counts['hot'] = await warm_hot(redis, elastic, limiter)
+    logger.info('cache prewarmed in %.1fs: %s', time.monotonic() - started, counts)
+    return counts
+
+
+async def prewarm(redis: Redis, elastic: AsyncElasticsearch, targets: Iterable[str] = TARGETS,
+                  force: bool = False) -> bool:
+    # Кеши в Redis общие для всех воркеров и узлов: прогревает тот, кто первым взял блокировку.
+    # Блокировка не снимается и истекает сама, чтобы перезапуск воркеров не повторял прогрев
+    token = await Cache(redis, CACHE_NAMESPACE).acquire_lock(PREWARM_LOCK, CACHE_PREWARM_INTERVAL)
+    if token is None and not force:
+        logger.info('cache prewarm skipped: already done by another worker')
+        return False
+
+    await warm_caches(redis, elastic, targets)
+    return True
+
+
+async def main(targets: List[str], force: bool) -> None:
+    redis = await redis_db.create_redis()
+    elastic = elastic_db.create_elastic()
+    try:
+        await prewarm(redis, elastic, targets, force)
+    finally:
+        redis.close()
+        await redis.wait_closed()
+        await elastic.close()
+
+
+if __name__ == '__main__':
+    # После деплоя или очистки Redis: заполнить кеш, не дожидаясь, пока это сделают пользовательские запросы
+    parser = argparse.ArgumentParser(description='Warm up the Redis cache with the most requested documents and pages')
+    parser.add_argument('--targets', nargs='+', choices=TARGETS, default=list(TARGETS))
+    parser.add_argument('--force', action='store_true', help='warm up even if a worker did it recently')
+    args = parser.parse_args()
+    logger.setLevel(logging.INFO)
+    asyncio.run(main(args.targets, args.force))
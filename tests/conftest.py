@@ -0,0 +1,38 @@
+import asyncio
+import os
+import sys
+
+import pytest
+
+# Код приложения импортируется так же, как при запуске из src
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
+
+
+@pytest.fixture
+def run():
+    # aioredis 1.3 берёт цикл через get_event_loop()
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    yield loop.run_until_complete
+    asyncio.set_event_loop(None)
+    loop.close()
+
+
+@pytest.fixture
+def redis(run):
+    import fakeredis.aioredis
+
+    client = run(fakeredis.aioredis.create_redis_pool())
+    yield client
+    client.close()
+    run(client.wait_closed())
+
+
+@pytest.fixture(autouse=True)
+def clear_local_caches():
+    # L1 общий на процесс: записи одного теста не должны попадать в другой
+    from db import cache
+
+    yield
+    for local in cache._local_caches.values():
+        local.clear()
@@ -0,0 +1,65 @@
+import random
+
+import pytest
+
+from config import CACHE_HOT_KEY_HITS, CACHE_HOT_TTL_FACTOR, CACHE_TTL
+from db import cache
+from db.cache import AccessStats, ModelCache
+from db.models import Film
+
+SAMPLE_RATE = 0.1
+
+
+@pytest.fixture
+def model_cache(monkeypatch):
+    random.seed(42)
+    monkeypatch.setattr(cache, 'WORKERS', 1)
+    model_cache = ModelCache(None, Film, CACHE_TTL)
+    model_cache._stats = AccessStats(SAMPLE_RATE, 1024, 4, 16)
+    return model_cache
+
+
+def read(model_cache: ModelCache, key: str, times: int) -> None:
+    for _ in range(times):
+        model_cache._stats.record(key)
+
+
+def test_unseen_key_keeps_base_ttl(model_cache):
+    assert model_cache._key_ttl('query:never-read') == CACHE_TTL
+
+
+def test_rarely_read_query_keeps_base_ttl(model_cache):
+    # Страница, прочитанная пару раз, не укорачивается и почти никогда не считается горячей:
+    # горячей она станет, только если в выборку попали все её обращения
+    keys = [f'query:{i}' for i in range(1000)]
+    for key in keys:
+        read(model_cache, key, 3)
+    ttls = [model_cache._key_ttl(key) for key in keys]
+    assert min(ttls) == CACHE_TTL
+    assert ttls.count(CACHE_TTL) >= len(keys) * 0.99
+
+
+def test_hot_key_ttl_extended(model_cache):
+    read(model_cache, 'film-1', int(CACHE_HOT_KEY_HITS * 10))
+    assert model_cache._key_ttl('film-1') == int(CACHE_TTL * CACHE_HOT_TTL_FACTOR)
+
+
+def test_single_sample_is_not_hot(model_cache):
+    # При малой доле выборки одно попадание даёт оценку 1 / SAMPLE_RATE, но это ещё шум
+    model_cache._stats.sample_rate = 1 / CACHE_HOT_KEY_HITS
+    random.seed(0)
+    while not model_cache._stats.samples('film-2'):
+        model_cache._stats.record('film-2')
+    assert model_cache._stats.estimate('film-2') >= CACHE_HOT_KEY_HITS
+    assert model_cache._key_ttl('film-2') == CACHE_TTL
+
+
+def test_hot_threshold_split_between_workers(model_cache, monkeypatch):
+    model_cache._stats.sample_rate = 1.0
+    hits = int(CACHE_HOT_KEY_HITS / 4)
+    read(model_cache, 'film-3', hits)
+    assert model_cache._key_ttl('film-3') == CACHE_TTL
+
+    # Каждый из 4 воркеров видит четверть обращений
+    monkeypatch.setattr(cache, 'WORKERS', 4)
+    assert model_cache._key_ttl('film-3') == int(CACHE_TTL * CACHE_HOT_TTL_FACTOR)
@@ -0,0 +1,73 @@
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from api_v1 import genre as genre_api
+from db import cache
+from db.cache import ModelCache
+from db.models import Genre
+from services import genre, invalidation
+
+
+def genre_source(films: int) -> dict:
+    return {
+        'id': 'g1',
+        'name': 'Drama',
+        'filmworks': [{'id': f'f{i}', 'title': f'Film {i}', 'imdb_rating': i / 10} for i in range(films)],
+    }
+
+
+class GenreElastic:
+    # Индекс genres из одного документа
+    def __init__(self, source: dict) -> None:
+        self.source = source
+
+    async def search(self, index, body, **kwargs):
+        hits = [] if 'search_after' in body else [{'_id': self.source['id'], '_source': self.source, 'sort': ['g1']}]
+        return {'hits': {'hits': hits}}
+
+    async def get(self, index, id, **kwargs):
+        return {'_id': id, '_source': self.source}
+
+
+@pytest.fixture(autouse=True)
+def no_catalogue(monkeypatch):
+    monkeypatch.setattr(genre, 'catalogue', None)
+
+
+def test_catalogue_keeps_all_films_by_default(run):
+    run(genre.refresh_catalogue(GenreElastic(genre_source(90))))
+
+    assert len(genre.catalogue.get('g1').filmworks) == 90
+
+
+def test_film_limit_is_the_same_with_and_without_catalogue(run, redis, monkeypatch):
+    monkeypatch.setattr(genre, 'GENRE_TOP_FILMS', 50)
+    elastic = GenreElastic(genre_source(90))
+    service = genre.GenreService(ModelCache(redis, Genre, 60), elastic)
+
+    from_elastic = run(service.get_by_id('g1'))
+    run(genre.refresh_catalogue(elastic))
+    from_catalogue = run(service.get_by_id('g1'))
+
+    assert from_elastic.filmworks == from_catalogue.filmworks
+    assert len(from_catalogue.filmworks) == 50
+    assert from_catalogue.filmworks[0].imdb_rating == pytest.approx(8.9)
+
+
+def test_genre_changes_reload_catalogue(run, redis, monkeypatch):
+    reloads = []
+    monkeypatch.setitem(cache._reload_handlers, genre.CATALOGUE_RELOAD, lambda: reloads.append(True))
+
+    run(invalidation.invalidate(redis, 'genres', ['g1']))
+
+    assert reloads == [True]
+
+
+@pytest.mark.parametrize('params', [{'page[number]': 0}, {'page[number]': -1}, {'page[size]': 0}])
+def test_genre_list_rejects_bad_pages(params):
+    app = FastAPI()
+    app.include_router(genre_api.router, prefix='/v1/genre')
+    app.dependency_overrides[genre.get_genre_service] = lambda: None
+
+    assert TestClient(app).get('/v1/genre/', params=params).status_code == 422
@@ -0,0 +1,213 @@
+import asyncio
+
+import aioredis
+import pytest
+
+import middleware as middleware_module
+from db.cache import WORKER_ID, ModelCache, QueryResult, fingerprint_query, get_local_cache
+from db.models import FilmShort
+from middleware import ResponseCacheMiddleware
+from services import invalidation
+from services.invalidation import invalidate_queries
+
+
+def film(film_id: str) -> FilmShort:
+    return FilmShort(id=film_id, title=f'Film {film_id}', imdb_rating=5.0)
+
+
+def test_invalidate_queries_drops_only_query_pages(run, redis):
+    cache = ModelCache(redis, FilmShort, 60)
+    run(cache.set_many_by_id({'1': film('1'), '2': film('2')}))
+    key = cache.query_key({'query': {'match_all': {}}, 'from': 0, 'size': 2})
+    run(cache.set_ids_by_query_key(key, QueryResult(ids=['1', '2'], total=2)))
+
+    assert run(invalidate_queries(redis, 'movies')) == 1
+
+    assert run(cache.get_entry_ids_by_query_key(key)) is None
+    assert set(run(cache.get_many_by_id(['1', '2']))) == {'1', '2'}
+
+
+def test_query_key_uses_query_fingerprint():
+    cache = ModelCache(None, FilmShort, 60)
+    query = {'query': {'match_all': {}}, 'sort': ['-imdb_rating'], 'size': 1}
+    assert cache.query_key(query) == f'query:{fingerprint_query(query)}'
+    assert cache.query_key(query) == cache.query_key({**query, 'sort': [{'imdb_rating': 'desc'}]})
+
+
+def test_invalidate_queries_clears_local_copies(run, redis):
+    cache = ModelCache(redis, FilmShort, 60)
+    key = cache.query_key({'query': {'match_all': {}}, 'from': 0, 'size': 1})
+    run(cache.set_ids_by_query_key(key, QueryResult(ids=['1'], total=1)))
+    assert get_local_cache('FilmShort').get(cache.get_full_path(key)) is not None
+
+    run(cache.invalidate_queries())
+
+    assert get_local_cache('FilmShort').get(cache.get_full_path(key)) is None
+
+
+async def call(command):
+    # Команды aioredis отправляются сразу при вызове, поэтому вызываются внутри цикла
+    return await command()
+
+
+def message(message_id: bytes, index: str, ids: str):
+    return message_id, {b'index': index.encode(), b'ids': ids.encode()}
+
+
+def test_process_changes_acks_only_invalidated_indexes(run, redis, monkeypatch):
+    invalidated = []
+
+    async def invalidate(redis, index, ids):
+        if index == 'persons':
+            raise aioredis.ConnectionClosedError('connection lost')
+        invalidated.append((index, ids))
+
+    monkeypatch.setattr(invalidation, 'invalidate', invalidate)
+    messages = [message(b'1-0', 'movies', 'a,b'), message(b'2-0', 'persons', 'c'), message(b'3-0', 'movies', 'd'),
+                message(b'4-0', 'genres', '')]
+
+    processed = run(invalidation.process_changes(redis, messages))
+
+    assert invalidated == [('movies', ['a', 'b', 'd'])]
+    assert sorted(processed) == [b'1-0', b'3-0', b'4-0']
+
+
+class FakeStreamConnection:
+    # Соединение с stream: чтения по очереди отдают reads, исключения из reads выбрасываются
+    async def xgroup_create(self, *args, **kwargs):
+        pass
+
+    def __init__(self, reads=(), consumers=()):
+        self.reads = list(reads)
+        self.consumers = list(consumers)
+        self.acked = []
+        self.deleted = []
+        self.closed = False
+
+    async def xpending(self, *args):
+        return []
+
+    async def xinfo_consumers(self, stream, group):
+        return self.consumers
+
+    async def xgroup_delconsumer(self, stream, group, consumer):
+        self.deleted.append(consumer)
+
+    async def xread_group(self, *args, **kwargs):
+        result = self.reads.pop(0)
+        if isinstance(result, BaseException):
+            raise result
+        return result
+
+    async def xack(self, stream, group, *message_ids):
+        self.acked.extend(message_ids)
+
+    def close(self):
+        self.closed = True
+
+    async def wait_closed(self):
+        pass
+
+
+def test_consume_changes_reconnects_after_error(run, monkeypatch):
+    connections = [
+        FakeStreamConnection([aioredis.ConnectionClosedError('connection lost')]),
+        FakeStreamConnection([[(b'stream', b'1-0', {b'index': b'movies', b'ids': b'a'})], asyncio.CancelledError()]),
+    ]
+    created = list(connections)
+
+    async def create_connection():
+        return created.pop(0)
+
+    async def invalidate(redis, index, ids):
+        pass
+
+    monkeypatch.setattr(invalidation, 'create_connection', create_connection)
+    monkeypatch.setattr(invalidation, 'invalidate', invalidate)
+    monkeypatch.setattr(invalidation, 'REDIS_RETRY_DELAY', 0)
+
+    pool = FakeStreamConnection()
+    with pytest.raises(asyncio.CancelledError):
+        run(invalidation.consume_changes(pool))
+
+    assert connections[0].closed and connections[1].closed
+    assert connections[1].acked == [b'1-0']
+    # При остановке консьюмер уходит из группы
+    assert pool.deleted == [WORKER_ID]
+
+
+def test_dead_consumers_removed_from_group(run):
+    idle = invalidation.DEAD_CONSUMER_IDLE * 1000
+    conn = FakeStreamConnection(consumers=[
+        {b'name': b'dead', b'pending': 0, b'idle': idle},
+        {b'name': b'dead-with-pending', b'pending': 2, b'idle': idle},
+        {b'name': b'alive', b'pending': 0, b'idle': 1000},
+        {b'name': WORKER_ID.encode(), b'pending': 0, b'idle': idle},
+    ])
+
+    run(invalidation._remove_dead_consumers(conn))
+
+    assert conn.deleted == ['dead']
+
+
+def test_invalidate_queries_drops_cached_responses(run, redis, monkeypatch):
+    calls = []
+
+    async def app(scope, receive, send):
+        calls.append(scope['query_string'])
+        await send({'type': 'http.response.start', 'status': 200, 'headers': []})
+        await send({'type': 'http.response.body', 'body': b'[{"uuid": "1"}]'})
+
+    async def get(middleware):
+        messages = []
+
+        async def send(message):
+            messages.append(message)
+
+        scope = {'type': 'http', 'method': 'GET', 'path': '/v1/film/', 'query_string': b'sort=-imdb_rating',
+                 'headers': []}
+        await middleware(scope, None, send)
+        return messages
+
+    monkeypatch.setattr(middleware_module.redis, 'redis', redis)
+    middleware = ResponseCacheMiddleware(app, paths=['/v1/film/'], ttl=60)
+    run(get(middleware))
+    run(get(middleware))
+    assert len(calls) == 1
+
+    assert run(invalidate_queries(redis, 'movies')) == 1
+
+    run(get(middleware))
+    assert len(calls) == 2
+
+
+def test_tag_set_expiry_is_only_extended(run, redis):
+    cache = ModelCache(redis, FilmShort, 600)
+    long_key = cache.query_key({'query': {'match_all': {}}, 'size': 1})
+    run(cache.set_ids_by_query_key(long_key, QueryResult(ids=['1'], total=1)))
+    tag_key = cache.get_full_path('tag:1')
+    ttl = run(call(lambda: redis.ttl(tag_key)))
+
+    short_key = cache.query_key({'query': {'match_all': {}}, 'size': 2})
+    run(ModelCache(redis, FilmShort, 10).set_ids_by_query_key(short_key, QueryResult(ids=['1'], total=1)))
+
+    assert run(call(lambda: redis.ttl(tag_key))) >= ttl - 1
+    run(cache.invalidate_ids(['1']))
+    assert not run(cache.get_entry_ids_by_query_key(long_key))
+
+
+def test_tag_set_drops_deleted_keys(run, redis):
+    cache = ModelCache(redis, FilmShort, 60)
+    keys = [cache.query_key({'query': {'match_all': {}}, 'from': i}) for i in range(20)]
+    for key in keys:
+        run(cache.set_ids_by_query_key(key, QueryResult(ids=['1'], total=1)))
+    run(cache.delete_full_keys([cache.get_full_path(key) for key in keys]))
+
+    live = [cache.query_key({'query': {'match_all': {}}, 'size': i}) for i in range(20)]
+    for key in live:
+        run(cache.set_ids_by_query_key(key, QueryResult(ids=['1'], total=1)))
+
+    # Проверяются случайные ключи, поэтому удалённые убираются постепенно, а живые остаются все
+    members = set(run(call(lambda: redis.smembers(cache.get_full_path('tag:1'), encoding='utf-8'))))
+    assert {cache.get_full_path(key) for key in live} <= members
+    assert len(members) < len(keys) + len(live)
@@ -0,0 +1,57 @@
+import pytest
+
+import middleware
+from middleware import ResponseCacheMiddleware, _document_ids, _is_cacheable
+
+
+@pytest.mark.parametrize('query_string', [
+    b'',
+    b'sort=-imdb_rating',
+    b'sort=-imdb_rating&filter[genre]=6c162475-c7ed-4461-9184-001ef3d9f26e&page[number]=1&page[size]=20',
+    b'query=&sort=',
+])
+def test_catalogue_pages_are_cacheable(query_string):
+    assert _is_cacheable(query_string)
+
+
+@pytest.mark.parametrize('query_string', [
+    b'query=star',
+    b'sort=title',
+    b'page[number]=2',
+    b'cursor=',
+    b'sort=-imdb_rating&cursor=eyJxIjoiYSJ9',
+    b'filter[person]=6c162475-c7ed-4461-9184-001ef3d9f26e',
+    b'sort=-imdb_rating&sort=-imdb_rating',
+])
+def test_other_requests_are_not_cacheable(query_string):
+    assert not _is_cacheable(query_string)
+
+
+def test_document_ids_from_list_and_page():
+    assert _document_ids(b'[{"uuid": "1"}, {"uuid": "2"}]') == ['1', '2']
+    assert _document_ids(b'{"uuid": "1", "title": "x"}') == ['1']
+    assert _document_ids(b'{"items": [{"uuid": "1"}], "total": 1, "facets": {}}') == ['1']
+
+
+def test_cursor_pages_bypass_cache(run, redis, monkeypatch):
+    calls = []
+
+    async def app(scope, receive, send):
+        calls.append(scope['query_string'])
+        await send({'type': 'http.response.start', 'status': 200, 'headers': [(b'x-next-cursor', b'abc')]})
+        await send({'type': 'http.response.body', 'body': b'[{"uuid": "1"}]'})
+
+    async def get(query_string):
+        async def send(message):
+            pass
+
+        scope = {'type': 'http', 'method': 'GET', 'path': '/v1/film/', 'query_string': query_string, 'headers': []}
+        await cache_middleware(scope, None, send)
+
+    monkeypatch.setattr(middleware.redis, 'redis', redis)
+    cache_middleware = ResponseCacheMiddleware(app, paths=['/v1/film/'], ttl=60)
+    for _ in range(2):
+        run(get(b'cursor='))
+        run(get(b'sort=-imdb_rating'))
+
+    assert calls == [b'cursor=', b'sort=-imdb_rating', b'cursor=']
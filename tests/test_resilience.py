@@ -0,0 +1,114 @@
+import asyncio
+
+import pytest
+from elasticsearch import AsyncElasticsearch
+
+from db import elastic
+from resilience import AdaptiveTimeout, CircuitBreaker
+
+
+def test_deadline_backs_off_on_timeouts_up_to_maximum():
+    deadline = AdaptiveTimeout(initial=1, minimum=0.1, maximum=1.5)
+    for _ in range(50):
+        deadline.observe(0.005)
+    assert deadline.timeout == pytest.approx(0.1)
+
+    deadline.on_timeout()
+    assert deadline.timeout == pytest.approx(0.2)
+    for _ in range(10):
+        deadline.on_timeout()
+    assert deadline.timeout == pytest.approx(1.5)
+
+
+def test_deadline_follows_latency_after_backoff():
+    deadline = AdaptiveTimeout(initial=1, minimum=0.1, maximum=3)
+    for _ in range(50):
+        deadline.observe(0.005)
+    for _ in range(3):
+        deadline.on_timeout()
+
+    # Первый же успешный ответ с новой латентностью поднимает оценку выше неё
+    deadline.observe(0.5)
+    assert deadline.timeout > 0.5
+
+
+def test_breaker_opens_and_lets_one_trial_through():
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=0.05)
+    breaker.record_failure()
+    assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN
+    assert not breaker.allow()
+
+    asyncio.run(asyncio.sleep(0.06))
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    assert breaker.allow()
+    assert not breaker.allow()
+    breaker.record_success()
+    assert breaker.state == CircuitBreaker.CLOSED
+
+
+class SlowElastic:
+    # Подменяет AsyncElasticsearch.search: отвечает с заданной задержкой
+    def __init__(self, latency: float) -> None:
+        self.latency = latency
+
+    async def search(self, client, *args, **kwargs):
+        await asyncio.sleep(self.latency)
+        return {'hits': {'hits': []}}
+
+
+@pytest.fixture
+def guarded_search(monkeypatch):
+    fake = SlowElastic(0.001)
+    monkeypatch.setattr(AsyncElasticsearch, 'search', fake.search)
+    monkeypatch.setattr(elastic, 'ES_DEADLINE_INITIAL', 0.02)
+    monkeypatch.setattr(elastic, 'ES_DEADLINE_MIN', 0.02)
+    monkeypatch.setattr(elastic, 'ES_DEADLINE_MAX', 0.2)
+    monkeypatch.setattr(elastic, 'breaker', CircuitBreaker(failure_threshold=3, reset_timeout=0.05))
+    search = elastic._guarded('search')
+    return fake, lambda **kwargs: search(None, index='movies', body={}, **kwargs)
+
+
+async def attempts(search, count: int):
+    outcomes = []
+    for _ in range(count):
+        try:
+            await search()
+            outcomes.append('ok')
+        except elastic.ElasticUnavailable:
+            outcomes.append('unavailable')
+    return outcomes
+
+
+def test_slower_elastic_raises_deadline_before_breaker_opens(run, guarded_search):
+    fake, search = guarded_search
+    run(attempts(search, 20))
+
+    fake.latency = 0.05
+    # Дедлайн 0.02 -> 0.04 -> 0.08: третий запрос укладывается, автомат остаётся закрытым
+    assert run(attempts(search, 4)) == ['unavailable', 'unavailable', 'ok', 'ok']
+    assert elastic.breaker.state == CircuitBreaker.CLOSED
+
+
+def test_breaker_recovers_when_elastic_is_back(run, guarded_search):
+    fake, search = guarded_search
+    fake.latency = 1
+    assert run(attempts(search, 4)) == ['unavailable'] * 4
+    assert elastic.breaker.state == CircuitBreaker.OPEN
+
+    fake.latency = 0.1
+    run(asyncio.sleep(0.06))
+    # Пробный запрос получает максимальный дедлайн, хотя оценка по прежним ответам меньше
+    assert run(attempts(search, 2)) == ['ok', 'ok']
+    assert elastic.breaker.state == CircuitBreaker.CLOSED
+
+
+def test_explicit_request_timeout_does_not_touch_deadline(run, guarded_search):
+    fake, search = guarded_search
+    fake.latency = 0.05
+    with pytest.raises(elastic.ElasticUnavailable):
+        run(search(request_timeout=0.01))
+    # Адаптивный дедлайн не удвоился: обычный запрос по-прежнему получает 0.02
+    fake.latency = 0.03
+    assert run(attempts(search, 1)) == ['unavailable']
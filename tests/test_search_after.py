@@ -0,0 +1,50 @@
+import base64
+
+import elasticsearch.exceptions
+import orjson
+
+from db.cache import ModelCache
+from db.models import Film
+from services import base
+from services.base import encode_cursor
+from services.film import FilmService
+
+
+class PitElastic:
+    # Индекс из двух фильмов; point-in-time 'expired' уже закрыт
+    def __init__(self) -> None:
+        self.searches = []
+        self.opened = 0
+
+    async def open_point_in_time(self, index, keep_alive):
+        self.opened += 1
+        return {'id': f'pit-{self.opened}'}
+
+    async def close_point_in_time(self, body):
+        pass
+
+    async def search(self, body, **kwargs):
+        self.searches.append(body['pit']['id'])
+        if body['pit']['id'] == 'expired':
+            raise elasticsearch.exceptions.NotFoundError(404, 'search_context_missing_exception', {})
+        hits = [{'_id': film_id, '_source': {'id': film_id, 'title': film_id, 'imdb_rating': 1.0}, 'sort': [film_id]}
+                for film_id in ('b', 'c')]
+        return {'hits': {'hits': hits, 'total': {'value': 3}}, 'pit_id': body['pit']['id']}
+
+
+def with_pit(cursor: str, pit_id: str) -> str:
+    position = orjson.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+    return encode_cursor(position['q'], position['after'], pit_id)
+
+
+def test_expired_point_in_time_is_reopened(run, redis, monkeypatch):
+    monkeypatch.setattr(base, 'ES_USE_PIT', True)
+    elastic = PitElastic()
+    service = FilmService(ModelCache(redis, Film, 60), elastic)
+    _, cursor = run(service.search_after(cursor='', page_size=2))
+
+    films, next_cursor = run(service.search_after(cursor=with_pit(cursor, 'expired'), page_size=2))
+
+    assert [film.id for film in films] == ['b', 'c']
+    assert elastic.searches == ['pit-1', 'expired', 'pit-2']
+    assert next_cursor
@@ -0,0 +1,31 @@
+import pytest
+
+import warmup
+
+
+@pytest.fixture
+def calls(monkeypatch):
+    calls = []
+
+    def fake(name, result):
+        async def target(*args):
+            calls.append(name)
+            return result
+        return target
+
+    monkeypatch.setattr(warmup, 'warm_genres', fake('warm_genres', ['genre']))
+    monkeypatch.setattr(warmup, 'load_genres', fake('load_genres', ['genre']))
+    monkeypatch.setattr(warmup, 'warm_persons', fake('warm_persons', 1))
+    monkeypatch.setattr(warmup, 'warm_queries', fake('warm_queries', 1))
+    monkeypatch.setattr(warmup, 'CACHE_PREWARM_RATE', 0)
+    return calls
+
+
+@pytest.mark.parametrize('targets, expected', [
+    (['genres', 'queries'], ['warm_genres', 'warm_queries']),
+    (['queries'], ['load_genres', 'warm_queries']),
+    (['persons'], ['warm_persons']),
+])
+def test_genres_are_cached_only_when_requested(run, calls, targets, expected):
+    run(warmup.warm_caches(None, None, targets))
+    assert calls == expected